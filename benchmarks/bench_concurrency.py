@@ -0,0 +1,106 @@
+"""Concurrency benchmark for the non-streaming /v1/messages path.
+
+Fires N parallel non-streaming requests at the proxy app (in-process, over
+ASGI) while LiteLLM is replaced by a fake upstream that takes a fixed amount of
+time to answer. With a non-blocking upstream call the whole batch should finish
+in roughly one upstream latency; the "blocking" mode reproduces the old inline
+litellm.completion call for comparison.
+
+Usage:
+    python benchmarks/bench_concurrency.py --requests 20 --latency 0.5
+"""
+import argparse
+import asyncio
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+os.environ.setdefault("LITELLM_LOCAL_MODEL_COST_MAP", "True")
+
+import httpx
+import litellm
+from litellm import ModelResponse
+
+import server
+
+UPSTREAM_LATENCY = 0.5
+
+
+def fake_response(**kwargs):
+    return ModelResponse(
+        id="chatcmpl-bench",
+        choices=[{"index": 0, "message": {"role": "assistant", "content": "ok"}, "finish_reason": "stop"}],
+        usage={"prompt_tokens": 10, "completion_tokens": 1, "total_tokens": 11},
+    )
+
+
+async def fake_acompletion(**kwargs):
+    await asyncio.sleep(UPSTREAM_LATENCY)
+    return fake_response(**kwargs)
+
+
+def fake_completion(**kwargs):
+    time.sleep(UPSTREAM_LATENCY)
+    return fake_response(**kwargs)
+
+
+async def blocking_call(litellm_request):
+    # Old behaviour: the synchronous client called directly inside the handler
+    return litellm.completion(**litellm_request)
+
+
+async def run_batch(num_requests: int) -> float:
+    transport = httpx.ASGITransport(app=server.app)
+    payload = {
+        "model": "claude-3-5-sonnet-20241022",
+        "max_tokens": 64,
+        "messages": [{"role": "user", "content": "ping"}],
+    }
+    async with httpx.AsyncClient(transport=transport, base_url="http://proxy") as client:
+        start = time.perf_counter()
+        responses = await asyncio.gather(
+            *(client.post("/v1/messages", json=payload) for _ in range(num_requests))
+        )
+        elapsed = time.perf_counter() - start
+    failed = [r.status_code for r in responses if r.status_code != 200]
+    if failed:
+        raise RuntimeError(f"{len(failed)} requests failed: {failed[:5]}")
+    return elapsed
+
+
+def main():
+    global UPSTREAM_LATENCY
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--requests", type=int, default=20, help="number of parallel requests")
+    parser.add_argument("--latency", type=float, default=0.5, help="fake upstream latency in seconds")
+    parser.add_argument("--modes", default="async,thread,blocking", help="comma separated modes to run")
+    args = parser.parse_args()
+    UPSTREAM_LATENCY = args.latency
+
+    litellm.acompletion = fake_acompletion
+    litellm.completion = fake_completion
+    # Keep the request log lines out of the benchmark output
+    server.log_request_beautifully = lambda *a, **k: None
+
+    original_call = server.call_litellm_completion
+    results = {}
+    for mode in args.modes.split(","):
+        if mode == "blocking":
+            server.call_litellm_completion = blocking_call
+        else:
+            server.call_litellm_completion = original_call
+            server.UPSTREAM_CALL_MODE = mode
+        elapsed = asyncio.run(run_batch(args.requests))
+        results[mode] = {
+            "requests": args.requests,
+            "upstream_latency_s": args.latency,
+            "wall_time_s": round(elapsed, 3),
+            "latencies_per_batch": round(elapsed / args.latency, 2),
+        }
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,122 @@
+"""Tail time to first token with and without hedged streaming calls.
+
+Starts two replicas of benchmarks/fake_upstream.py that stall the first token
+of --stall-rate of their requests by --stall-ms, and a proxy process load
+balancing over both. Streams --requests requests through the proxy with and
+without UPSTREAM_HEDGING and reports p50/p95/p99 time to first text delta,
+plus how many upstream calls were made and how many hedges won.
+
+Usage:
+    python benchmarks/bench_hedging.py --requests 300 --stall-rate 0.05 --hedge-delay-ms 300
+"""
+import argparse
+import asyncio
+import json
+import os
+import re
+import sys
+import time
+
+import httpx
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, ROOT)
+
+from benchmarks.fake_upstream import free_port
+from benchmarks.loadtest import spawn_fake_upstream, spawn_proxy, summarize_ms
+
+
+def metric_total(text: str, name: str, **labels) -> float:
+    """Sum of the samples of a metric whose labels include the given ones."""
+    total = 0.0
+    for line in text.splitlines():
+        match = re.match(rf"{name}(\{{.*\}})? (\S+)$", line)
+        if match and all(f'{key}="{value}"' in (match.group(1) or "") for key, value in labels.items()):
+            total += float(match.group(2))
+    return total
+
+
+async def run_load(proxy_url: str, args) -> dict:
+    ttfts = []
+    async with httpx.AsyncClient(base_url=proxy_url, timeout=60) as client:
+        semaphore = asyncio.Semaphore(args.concurrency)
+
+        async def one(i: int):
+            body = {
+                "model": "gpt-4o",
+                "max_tokens": 256,
+                "stream": True,
+                "messages": [{"role": "user", "content": f"request {i}"}],
+            }
+            async with semaphore:
+                start = time.perf_counter()
+                first = None
+                async with client.stream("POST", "/v1/messages", json=body) as response:
+                    async for chunk in response.aiter_text():
+                        if first is None and "text_delta" in chunk:
+                            first = time.perf_counter() - start
+                if first is not None:
+                    ttfts.append(first)
+
+        # Warm up the proxy (imports, connections) before measuring
+        await one(-1)
+        ttfts.clear()
+        await asyncio.gather(*(one(i) for i in range(args.requests)))
+        metrics = (await client.get("/metrics")).text
+    return {
+        "ttft_ms": summarize_ms(ttfts),
+        "over_1s": sum(1 for t in ttfts if t > 1),
+        "upstream_calls": int(metric_total(metrics, "proxy_upstream_base_picks_total")),
+        "hedges_won": int(metric_total(metrics, "proxy_upstream_hedges_total", winner="hedge")),
+        "hedges_lost": int(metric_total(metrics, "proxy_upstream_hedges_total", winner="primary")),
+        "hedge_budget_exhausted": int(metric_total(metrics, "proxy_upstream_hedge_budget_exhausted_total")),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--requests", type=int, default=300)
+    parser.add_argument("--concurrency", type=int, default=10)
+    parser.add_argument("--first-token-ms", type=float, default=50)
+    parser.add_argument("--stall-rate", type=float, default=0.05)
+    parser.add_argument("--stall-ms", type=float, default=2000)
+    parser.add_argument("--hedge-delay-ms", type=float, default=0, help="0 hedges at the observed p95")
+    parser.add_argument("--hedge-budget", type=float, default=0.1)
+    args = parser.parse_args()
+
+    ports = [free_port(), free_port()]
+    upstreams = [
+        spawn_fake_upstream(port, [
+            "--first-token-ms", str(args.first_token_ms),
+            "--stall-rate", str(args.stall_rate),
+            "--stall-ms", str(args.stall_ms),
+        ])
+        for port in ports
+    ]
+    api_bases = ",".join(f"http://127.0.0.1:{port}/v1" for port in ports)
+    results = {}
+    try:
+        for name, hedging in (("no_hedging", "false"), ("hedging", "true")):
+            port = free_port()
+            proxy = spawn_proxy(port, api_bases, {
+                "SINGLE_FLIGHT": "false",
+                "UPSTREAM_HEDGING": hedging,
+                "UPSTREAM_HEDGE_DELAY": str(args.hedge_delay_ms / 1000),
+                "UPSTREAM_HEDGE_BUDGET": str(args.hedge_budget),
+                # Stalls are by design here, they should not get a replica ejected
+                "UPSTREAM_EJECT_FAILURES": "1000000",
+            })
+            try:
+                results[name] = asyncio.run(run_load(f"http://127.0.0.1:{port}", args))
+            finally:
+                proxy.terminate()
+                proxy.wait(10)
+    finally:
+        for upstream in upstreams:
+            upstream.terminate()
+            upstream.wait(10)
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,120 @@
+"""Upstream request size and per-turn translation time of a session with screenshots.
+
+Replays a synthetic Claude Code session turn by turn, like the proxy does: each
+turn's body is parsed from JSON (not timed), then prepare_images and
+convert_anthropic_to_litellm run on it. Every --image-every tool result carries
+a screenshot (retina sized PNGs drawn with Pillow, cycling through --distinct of
+them, so some repeat). Reports the bytes of message content sent upstream over
+the session and on its last turn, and translation time (total, median and
+slowest turn), for images sent as they are, downscaled with the image cache, and
+downscaled without it.
+
+Needs Pillow (pip install pillow).
+
+Usage:
+    python benchmarks/bench_images.py --max-messages 200 --image-every 3
+"""
+import argparse
+import asyncio
+import base64
+import io
+import json
+import os
+import random
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+os.environ.setdefault("LITELLM_LOCAL_MODEL_COST_MAP", "True")
+
+import server
+from benchmarks.transcripts import make_messages
+
+
+def make_screenshot(width: int, height: int, seed: int) -> str:
+    """A base64 PNG resembling a screenshot: window panes, text lines and a photo-like area."""
+    from PIL import Image, ImageDraw, ImageFilter
+    rng = random.Random(seed)
+    image = Image.linear_gradient("L").resize((width, height)).convert("RGB")
+    draw = ImageDraw.Draw(image)
+    for _ in range(40):
+        x, y = rng.randrange(width), rng.randrange(height)
+        draw.rectangle((x, y, x + rng.randrange(50, 600), y + rng.randrange(30, 300)),
+                       fill=tuple(rng.randrange(256) for _ in range(3)))
+    for y in range(0, height, 30):
+        draw.text((rng.randint(0, 200), y), "def handle(request): return response " * rng.randint(1, 8), fill=(20, 20, 20))
+    image.paste(Image.effect_noise((width // 3, height // 3), 40).convert("RGB"), (width // 2, height // 2))
+    buffer = io.BytesIO()
+    image.filter(ImageFilter.SMOOTH).save(buffer, "PNG")
+    return base64.b64encode(buffer.getvalue()).decode("ascii")
+
+
+def make_session(args):
+    screenshots = [make_screenshot(args.width, args.height, seed) for seed in range(args.distinct)]
+    messages = make_messages(args.max_messages, args.tool_result_bytes)
+    results = 0
+    for message in messages:
+        if message["role"] != "user" or isinstance(message["content"], str):
+            continue
+        results += 1
+        if results % args.image_every == 0:
+            block = message["content"][0]
+            source = {"type": "base64", "media_type": "image/png", "data": screenshots[results // args.image_every % args.distinct]}
+            block["content"] = [{"type": "text", "text": block["content"]}, {"type": "image", "source": source}]
+    return messages
+
+
+async def replay(messages, model: str, image_limits) -> dict:
+    server.translation_cache = server.LRUCache(server.TRANSLATION_CACHE_SIZE or 4096)
+    turn_ms, sent = [], []
+    for n in range(1, len(messages) + 1, 2):
+        # Fresh strings every turn, as with a real request body
+        body = json.dumps({"model": model, "max_tokens": 1024, "messages": messages[:n]})
+        request = server.MessagesRequest.model_validate_json(body)
+        start = time.perf_counter()
+        await server.prepare_images(request.messages, image_limits)
+        litellm_request = server.convert_anthropic_to_litellm(
+            request, flatten_for_openai="openai" in model, image_limits=image_limits)
+        turn_ms.append((time.perf_counter() - start) * 1000)
+        sent.append(len(json.dumps(litellm_request["messages"])))
+    return {
+        "upstream_mb_total": round(sum(sent) / 1e6, 1),
+        "upstream_mb_last_turn": round(sent[-1] / 1e6, 2),
+        "translation_s_total": round(sum(turn_ms) / 1000, 2),
+        "turn_ms_p50": round(statistics.median(turn_ms), 2),
+        "turn_ms_max": round(max(turn_ms), 1),
+        "images_cache": server.image_cache.stats(),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--max-messages", type=int, default=200)
+    parser.add_argument("--image-every", type=int, default=3, help="a screenshot in every n-th tool result")
+    parser.add_argument("--distinct", type=int, default=8, help="distinct screenshots, cycled through")
+    parser.add_argument("--width", type=int, default=3456)
+    parser.add_argument("--height", type=int, default=2234)
+    parser.add_argument("--tool-result-bytes", type=int, default=2000)
+    parser.add_argument("--model", default="anthropic/claude-sonnet-4-20250514")
+    parser.add_argument("--max-dimension", type=int, default=server.IMAGE_MAX_DIMENSION)
+    parser.add_argument("--max-bytes", type=int, default=server.IMAGE_MAX_BYTES)
+    args = parser.parse_args()
+
+    try:
+        import PIL  # noqa: F401
+    except ImportError:
+        sys.exit("bench_images.py needs Pillow: pip install pillow")
+    server.logger.setLevel("ERROR")
+    messages = make_session(args)
+    limits = (args.max_dimension, args.max_bytes)
+    results = {}
+    for label, image_limits, cache_size in (("as_is", (0, 0), 64), ("downscaled", limits, 64),
+                                            ("downscaled_no_image_cache", limits, 0)):
+        server.image_cache = server.LRUCache(cache_size)
+        results[label] = asyncio.run(replay(messages, args.model, image_limits))
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
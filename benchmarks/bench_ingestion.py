@@ -0,0 +1,88 @@
+"""Request ingestion cost per payload size.
+
+Compares the old path (FastAPI parses and validates the body, then the handler
+json.loads the same bytes again to read the model name) with the single-pass
+MessagesRequest.model_validate_json used by parse_request_body. If orjson is
+installed, an orjson.loads + model_validate variant is reported as well.
+
+Usage:
+    python benchmarks/bench_ingestion.py --sizes 10,100,500,1000
+"""
+import argparse
+import json
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+os.environ.setdefault("LITELLM_LOCAL_MODEL_COST_MAP", "True")
+
+import server
+from benchmarks.transcripts import make_messages
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def legacy_ingest(body: bytes):
+    # FastAPI: json.loads + validate the dict; handler: json.loads again for the model name
+    request = server.MessagesRequest.model_validate(json.loads(body))
+    original_model = json.loads(body.decode("utf-8")).get("model", "unknown")
+    return request, original_model
+
+
+def single_pass_ingest(body: bytes):
+    request = server.MessagesRequest.model_validate_json(body)
+    return request, request.original_model
+
+
+def orjson_ingest(body: bytes):
+    request = server.MessagesRequest.model_validate(orjson.loads(body))
+    return request, request.original_model
+
+
+def measure(func, body: bytes, repeats: int):
+    best = float("inf")
+    for _ in range(repeats):
+        start = time.perf_counter()
+        func(body)
+        best = min(best, time.perf_counter() - start)
+    tracemalloc.start()
+    func(body)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {"ms": round(best * 1000, 3), "mb_per_s": round(len(body) / best / 1e6, 1), "peak_alloc_mb": round(peak / 1e6, 2)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sizes", default="10,100,500,1000", help="conversation lengths in messages")
+    parser.add_argument("--tool-result-bytes", type=int, default=4000)
+    parser.add_argument("--repeats", type=int, default=5)
+    args = parser.parse_args()
+
+    server.logger.setLevel("ERROR")
+    variants = {"legacy_double_parse": legacy_ingest, "single_pass": single_pass_ingest}
+    if orjson is not None:
+        variants["orjson_then_validate"] = orjson_ingest
+
+    results = {}
+    for size in (int(n) for n in args.sizes.split(",")):
+        body = json.dumps({
+            "model": "claude-sonnet-4-20250514",
+            "max_tokens": 8192,
+            "stream": True,
+            "messages": make_messages(size, args.tool_result_bytes),
+        }).encode("utf-8")
+        row = {"payload_mb": round(len(body) / 1e6, 2)}
+        for name, func in variants.items():
+            row[name] = measure(func, body, args.repeats)
+        results[size] = row
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
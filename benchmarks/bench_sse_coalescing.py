@@ -0,0 +1,88 @@
+"""Frames and bytes per streamed response, with and without SSE delta coalescing.
+
+Feeds handle_streaming a fake LiteLLM stream that delivers a long text answer
+and a large tool call in tiny fragments (the way some providers stream), then
+counts the SSE frames and bytes written to the client and checks that the
+reassembled text and tool input are unchanged.
+
+Usage:
+    python benchmarks/bench_sse_coalescing.py --chars-per-chunk 2 --chunk-interval-ms 2
+"""
+import argparse
+import asyncio
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+os.environ.setdefault("LITELLM_LOCAL_MODEL_COST_MAP", "True")
+
+from litellm.types.utils import ModelResponseStream
+
+import server
+
+ANSWER = "I'll update the handler so that it streams responses incrementally. " * 60
+TOOL_INPUT = {"file_path": "/repo/server.py", "content": "def handler(request):\n    return request\n" * 80}
+
+
+def chunk(delta, finish_reason=None):
+    return ModelResponseStream(choices=[{"index": 0, "delta": delta, "finish_reason": finish_reason}])
+
+
+async def fake_stream(chars_per_chunk: int, interval: float):
+    for i in range(0, len(ANSWER), chars_per_chunk):
+        yield chunk({"content": ANSWER[i:i + chars_per_chunk]})
+        if interval:
+            await asyncio.sleep(interval)
+    yield chunk({"tool_calls": [{"index": 0, "id": "call_bench", "type": "function", "function": {"name": "Write", "arguments": ""}}]})
+    arguments = json.dumps(TOOL_INPUT)
+    for i in range(0, len(arguments), chars_per_chunk):
+        yield chunk({"tool_calls": [{"index": 0, "function": {"arguments": arguments[i:i + chars_per_chunk]}}]})
+        if interval:
+            await asyncio.sleep(interval)
+    yield chunk({}, finish_reason="tool_calls")
+
+
+async def run(chars_per_chunk: int, interval: float):
+    request = server.MessagesRequest(model="claude-sonnet-4-20250514", max_tokens=4096, stream=True,
+                                     messages=[{"role": "user", "content": "go"}])
+    frames = 0
+    size = 0
+    text = ""
+    partial_json = ""
+    start = time.perf_counter()
+    async for frame in server.handle_streaming(fake_stream(chars_per_chunk, interval), request):
+        frames += 1
+        size += len(frame.encode("utf-8"))
+        for line in frame.splitlines():
+            if line.startswith("data: {"):
+                delta = json.loads(line[6:]).get("delta", {})
+                text += delta.get("text", "")
+                partial_json += delta.get("partial_json", "")
+    elapsed = time.perf_counter() - start
+    assert text == ANSWER, "text changed by coalescing"
+    assert json.loads(partial_json) == TOOL_INPUT, "tool input changed by coalescing"
+    return {"frames": frames, "bytes": size, "seconds": round(elapsed, 3)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--chars-per-chunk", type=int, default=2)
+    parser.add_argument("--chunk-interval-ms", type=float, default=2.0, help="delay between upstream chunks")
+    parser.add_argument("--window-ms", type=float, default=15.0)
+    parser.add_argument("--max-bytes", type=int, default=512)
+    args = parser.parse_args()
+
+    server.logger.setLevel("ERROR")
+    interval = args.chunk_interval_ms / 1000
+    results = {}
+    for label, window in (("coalescing_off", 0), ("coalescing_on", args.window_ms)):
+        server.SSE_COALESCE_WINDOW_MS = window
+        server.SSE_COALESCE_MAX_BYTES = args.max_bytes
+        results[label] = asyncio.run(run(args.chars_per_chunk, interval))
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
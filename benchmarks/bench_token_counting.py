@@ -0,0 +1,116 @@
+"""Token counting throughput and event-loop lag under concurrent /v1/messages/count_tokens load.
+
+Every request carries a fresh conversation, so the token count caches miss and
+each request is tokenized. A ticker task sleeps in short steps next to the load
+and records how late it wakes up: that lateness is the time the event loop was
+blocked tokenizing instead of serving other requests. Compares counting inline
+on the event loop with the tokenizer process pool.
+
+Usage:
+    python benchmarks/bench_token_counting.py --concurrency 8 --requests 32 --messages 60
+"""
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+os.environ.setdefault("LITELLM_LOCAL_MODEL_COST_MAP", "True")
+
+import httpx
+
+import server
+from benchmarks.transcripts import make_messages
+
+TICK = 0.005
+
+
+async def ticker(lags, stop: asyncio.Event):
+    loop = asyncio.get_running_loop()
+    while not stop.is_set():
+        start = loop.time()
+        await asyncio.sleep(TICK)
+        lags.append(loop.time() - start - TICK)
+
+
+async def run_load(workers: int, args) -> dict:
+    server.message_token_cache = server.LRUCache(server.TOKEN_COUNT_CACHE_SIZE)
+    server.token_count_request_cache = server.LRUCache(server.TOKEN_COUNT_REQUEST_CACHE_SIZE)
+    engine = server.TokenizerEngine(workers, args.inline_max_chars)
+    server.tokenizer_engine = engine
+    engine.start(server.model_router.default_models)
+    if engine.pool is not None:
+        # Wait for the workers to spawn and preload before timing
+        await asyncio.gather(*(
+            asyncio.get_running_loop().run_in_executor(engine.pool, server.preload_tokenizers, [])
+            for _ in range(workers)
+        ))
+
+    bodies = [
+        json.dumps({
+            "model": args.model,
+            "messages": make_messages(args.messages, args.tool_result_bytes, seed=1000 * workers + i + 1),
+        }).encode("utf-8")
+        for i in range(args.requests)
+    ]
+    queue = asyncio.Queue()
+    for body in bodies:
+        queue.put_nowait(body)
+
+    tokens = 0
+    lags = []
+    stop = asyncio.Event()
+    transport = httpx.ASGITransport(app=server.app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://proxy") as client:
+        async def worker():
+            nonlocal tokens
+            while not queue.empty():
+                body = queue.get_nowait()
+                response = await client.post("/v1/messages/count_tokens", content=body, headers={"content-type": "application/json"})
+                tokens += response.json()["input_tokens"]
+
+        tick_task = asyncio.create_task(ticker(lags, stop))
+        start = time.perf_counter()
+        await asyncio.gather(*(worker() for _ in range(args.concurrency)))
+        elapsed = time.perf_counter() - start
+        stop.set()
+        await tick_task
+    engine.shutdown()
+
+    lags_ms = sorted(lag * 1000 for lag in lags) or [0.0]
+    return {
+        "seconds": round(elapsed, 3),
+        "tokens": tokens,
+        "tokens_per_s": round(tokens / elapsed),
+        "loop_lag_ms_p50": round(statistics.median(lags_ms), 2),
+        "loop_lag_ms_p99": round(lags_ms[int(0.99 * (len(lags_ms) - 1))], 2),
+        "loop_lag_ms_max": round(lags_ms[-1], 2),
+        "offloaded_jobs": engine.offloaded_jobs,
+        "inline_jobs": engine.inline_jobs,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--model", default="claude-3-haiku-20240307")
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--requests", type=int, default=32)
+    parser.add_argument("--messages", type=int, default=60)
+    parser.add_argument("--tool-result-bytes", type=int, default=2000)
+    parser.add_argument("--workers", type=int, default=2, help="process pool size for the pool run")
+    parser.add_argument("--inline-max-chars", type=int, default=server.TOKENIZER_INLINE_MAX_CHARS)
+    args = parser.parse_args()
+
+    server.logger.setLevel("ERROR")
+    results = {
+        "inline": asyncio.run(run_load(0, args)),
+        f"process_pool_{args.workers}": asyncio.run(run_load(args.workers, args)),
+    }
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,147 @@
+"""Prompt tokens and time to first token of flattened vs native tool-call encoding.
+
+Translates Claude Code conversations for an OpenAI target with tool calls and
+results flattened into text (the default) and as native tool_calls / role
+"tool" messages (OPENAI_NATIVE_TOOL_CALLS=true), and counts the prompt tokens
+of both with LiteLLM's tokenizer. Conversations are synthetic
+(benchmarks/transcripts.py) or recorded /v1/messages request bodies, one JSON
+object per line (--requests).
+
+With --ttft, every conversation is also streamed through the proxy in both
+modes and the median time to first token is reported. The upstream is
+--upstream-base (a real OpenAI-compatible endpoint, key in OPENAI_API_KEY) or
+the local fake upstream, whose time to first token then grows with the prompt
+by --prefill-ms-per-1k-tokens, a stand-in for a real model's prefill time.
+
+Usage:
+    python benchmarks/bench_tool_encoding.py --sizes 20,100,300
+    python benchmarks/bench_tool_encoding.py --requests sessions.jsonl --ttft --upstream-base https://litellm:4000/v1
+"""
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import sys
+import time
+from typing import Any, Dict, List
+
+import httpx
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, ROOT)
+os.environ.setdefault("LITELLM_LOCAL_MODEL_COST_MAP", "True")
+
+from benchmarks.fake_upstream import free_port
+from benchmarks.loadtest import spawn_fake_upstream, spawn_proxy
+from benchmarks.transcripts import make_messages, make_tools
+
+SYSTEM = "You are Claude Code, a coding assistant working in /repo."
+MODES = {"flattened": "false", "native": "true"}
+
+
+def load_conversations(args) -> Dict[str, Dict[str, Any]]:
+    """Request bodies by name, recorded or synthetic."""
+    if args.requests:
+        with open(args.requests) as f:
+            return {f"recorded_{i}": json.loads(line) for i, line in enumerate(f) if line.strip()}
+    return {
+        f"{size}_messages": {
+            "model": "claude-sonnet-4-20250514",
+            "max_tokens": 4096,
+            "system": SYSTEM,
+            "tools": make_tools(),
+            "messages": make_messages(size, args.tool_result_bytes),
+        }
+        for size in args.sizes
+    }
+
+
+def count_tokens(conversations: Dict[str, Dict[str, Any]], model: str) -> Dict[str, Dict[str, Any]]:
+    import litellm
+    import server
+
+    results = {}
+    for name, body in conversations.items():
+        request = server.MessagesRequest(**dict(body, model=f"openai/{model}"))
+        counts = {}
+        for mode, native in MODES.items():
+            translated = server.convert_anthropic_to_litellm(request, flatten_for_openai=True,
+                                                             native_tool_calls=native == "true")
+            counts[mode] = litellm.token_counter(model=model, messages=translated["messages"],
+                                                 tools=translated.get("tools"))
+        counts["drop_pct"] = round((counts["flattened"] - counts["native"]) / counts["flattened"] * 100, 1)
+        results[name] = counts
+    return results
+
+
+async def measure_ttft(proxy_url: str, conversations: Dict[str, Dict[str, Any]], repeats: int) -> Dict[str, float]:
+    """Median milliseconds to the first content delta per conversation."""
+    results = {}
+    async with httpx.AsyncClient(base_url=proxy_url, timeout=300) as client:
+        for name, body in conversations.items():
+            body = dict(body, stream=True, max_tokens=min(body.get("max_tokens", 64), 64))
+            samples = []
+            for _ in range(repeats):
+                start = time.perf_counter()
+                async with client.stream("POST", "/v1/messages", json=body) as response:
+                    async for line in response.aiter_lines():
+                        if line.startswith("data: ") and "content_block_delta" in line:
+                            samples.append(time.perf_counter() - start)
+                            break
+            results[name] = round(statistics.median(samples) * 1000, 1) if samples else None
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sizes", type=lambda s: [int(n) for n in s.split(",")], default=[20, 100, 300])
+    parser.add_argument("--tool-result-bytes", type=int, default=2000)
+    parser.add_argument("--requests", help="recorded /v1/messages bodies, one JSON object per line")
+    parser.add_argument("--model", default="gpt-4.1", help="OpenAI model the conversations are sent to")
+    parser.add_argument("--ttft", action="store_true", help="also stream every conversation through the proxy")
+    parser.add_argument("--repeats", type=int, default=5)
+    parser.add_argument("--upstream-base", help="real OpenAI-compatible upstream instead of the fake one")
+    parser.add_argument("--first-token-ms", type=float, default=50)
+    parser.add_argument("--prefill-ms-per-1k-tokens", type=float, default=20)
+    args = parser.parse_args()
+
+    conversations = load_conversations(args)
+    report: Dict[str, Any] = {"prompt_tokens": count_tokens(conversations, args.model)}
+
+    if args.ttft:
+        processes: List[Any] = []
+        try:
+            upstream_base = args.upstream_base
+            if upstream_base is None:
+                upstream_port = free_port()
+                processes.append(spawn_fake_upstream(upstream_port, [
+                    "--first-token-ms", str(args.first_token_ms),
+                    "--prefill-ms-per-1k-tokens", str(args.prefill_ms_per_1k_tokens),
+                ]))
+                upstream_base = f"http://127.0.0.1:{upstream_port}/v1"
+            settings = {"BIG_MODEL": args.model, "SMALL_MODEL": args.model, "SINGLE_FLIGHT": "false"}
+            if args.upstream_base:
+                settings["OPENAI_API_KEY"] = os.environ.get("OPENAI_API_KEY", "")
+            ttft = {}
+            for mode, native in MODES.items():
+                port = free_port()
+                proxy = spawn_proxy(port, upstream_base, dict(settings, OPENAI_NATIVE_TOOL_CALLS=native))
+                try:
+                    ttft[mode] = asyncio.run(measure_ttft(f"http://127.0.0.1:{port}", conversations, args.repeats))
+                finally:
+                    proxy.terminate()
+                    proxy.wait(10)
+            report["ttft_ms"] = {
+                name: {mode: ttft[mode][name] for mode in MODES} for name in conversations
+            }
+        finally:
+            for process in processes:
+                process.terminate()
+                process.wait(10)
+
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,74 @@
+"""Per-turn translation cost as a conversation grows.
+
+Replays a synthetic Claude Code session turn by turn and times
+convert_anthropic_to_litellm for each turn, with the message translation cache
+enabled and disabled. With the cache, per-turn time should stay roughly flat;
+without it, it grows linearly with the conversation length.
+
+Usage:
+    python benchmarks/bench_translation_cache.py --max-messages 400
+"""
+import argparse
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+os.environ.setdefault("LITELLM_LOCAL_MODEL_COST_MAP", "True")
+
+import server
+from benchmarks.transcripts import make_messages
+
+
+def time_session(messages, checkpoints, model, repeats):
+    """Replay the session one message at a time.
+
+    Returns, for each checkpoint, the best-of-N translation time of that turn and
+    how many messages actually had to be converted on it.
+    """
+    timings = {}
+    converted = {}
+    for n in range(1, len(messages) + 1):
+        request = server.MessagesRequest(model=model, max_tokens=1024, messages=messages[:n])
+        best = float("inf")
+        misses_before = server.translation_cache.misses
+        for attempt in range(repeats):
+            start = time.perf_counter()
+            server.convert_anthropic_to_litellm(request, flatten_for_openai="openai" in request.model)
+            best = min(best, time.perf_counter() - start)
+            if attempt == 0:
+                misses = server.translation_cache.misses - misses_before
+        if n in checkpoints:
+            timings[n] = round(best * 1000, 3)
+            converted[n] = misses if server.translation_cache.max_entries > 0 else n
+    return timings, converted
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--max-messages", type=int, default=400)
+    parser.add_argument("--tool-result-bytes", type=int, default=2000)
+    parser.add_argument("--model", default="openai/gpt-4.1")
+    parser.add_argument("--repeats", type=int, default=3, help="timed runs per turn, best one is kept")
+    args = parser.parse_args()
+
+    server.logger.setLevel("ERROR")
+    messages = make_messages(args.max_messages, args.tool_result_bytes)
+    checkpoints = {n for n in (10, 25, 50, 100, 200, 400, 800, 1000) if n <= args.max_messages}
+    checkpoints.add(args.max_messages)
+
+    results = {}
+    for label, size in (("cache_off", 0), ("cache_on", server.TRANSLATION_CACHE_SIZE or 4096)):
+        server.translation_cache = server.LRUCache(size)
+        timings, converted = time_session(messages, checkpoints, args.model, args.repeats)
+        results[label] = {
+            "per_turn_ms": timings,
+            "messages_converted_per_turn": converted,
+            "cache": server.translation_cache.stats(),
+        }
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
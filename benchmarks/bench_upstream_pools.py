@@ -0,0 +1,116 @@
+"""Time to first byte through the proxy with and without the managed upstream pools.
+
+Starts the local fake upstream (benchmarks/fake_upstream.py) and the proxy as
+separate uvicorn processes, then streams requests through the proxy over real
+sockets. The fake upstream delays every new TCP connection by
+--connect-delay-ms, standing in for the handshakes to a remote api_base.
+Reports p50/p95 time to the first SSE byte and to the first text delta for
+UPSTREAM_POOLS=false (LiteLLM's own clients), UPSTREAM_POOLS=true, and, as a
+reference, pools with keep-alive disabled (a new connection per request).
+
+Usage:
+    python benchmarks/bench_upstream_pools.py --requests 200 --concurrency 10 --connect-delay-ms 30
+"""
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import sys
+import time
+
+import httpx
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, ROOT)
+
+from benchmarks.fake_upstream import free_port
+from benchmarks.loadtest import percentile, spawn_fake_upstream, spawn_proxy
+
+CONFIGS = {
+    # Reference: a fresh upstream connection for every request
+    "no_reuse": {"UPSTREAM_POOLS": "true", "UPSTREAM_KEEPALIVE_EXPIRY": "0"},
+    "litellm_default_clients": {"UPSTREAM_POOLS": "false"},
+    "managed_pools": {"UPSTREAM_POOLS": "true"},
+}
+
+
+async def run_load(proxy_url: str, args) -> dict:
+    first_byte, first_token = [], []
+    async with httpx.AsyncClient(base_url=proxy_url, timeout=60) as client:
+        async def one(i: int):
+            body = {
+                "model": "gpt-4o",
+                "max_tokens": 256,
+                "stream": True,
+                "messages": [{"role": "user", "content": f"request {i}"}],
+            }
+            start = time.perf_counter()
+            got_byte = got_token = None
+            async with client.stream("POST", "/v1/messages", json=body) as response:
+                async for chunk in response.aiter_text():
+                    now = time.perf_counter()
+                    if got_byte is None:
+                        got_byte = now
+                    if got_token is None and "text_delta" in chunk:
+                        got_token = now
+            first_byte.append(got_byte - start)
+            first_token.append((got_token or got_byte) - start)
+
+        # Warm up the proxy (imports, tokenizers) before measuring
+        await one(-1)
+        first_byte.clear()
+        first_token.clear()
+
+        semaphore = asyncio.Semaphore(args.concurrency)
+
+        async def limited(i: int):
+            async with semaphore:
+                await one(i)
+                await asyncio.sleep(args.think_ms / 1000)
+
+        await asyncio.gather(*(limited(i) for i in range(args.requests)))
+    return {
+        "ttfb_ms_p50": round(statistics.median(first_byte) * 1000, 1),
+        "ttfb_ms_p95": round(percentile(first_byte, 0.95) * 1000, 1),
+        "first_token_ms_p50": round(statistics.median(first_token) * 1000, 1),
+        "first_token_ms_p95": round(percentile(first_token, 0.95) * 1000, 1),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=10)
+    parser.add_argument("--connect-delay-ms", type=float, default=30)
+    parser.add_argument("--first-token-ms", type=float, default=20)
+    parser.add_argument("--think-ms", type=float, default=0, help="pause between requests of one client")
+    args = parser.parse_args()
+
+    upstream_port = free_port()
+    upstream = spawn_fake_upstream(upstream_port, [
+        "--first-token-ms", str(args.first_token_ms), "--connect-delay-ms", str(args.connect_delay_ms)
+    ])
+    upstream_base = f"http://127.0.0.1:{upstream_port}/v1"
+    results = {}
+    try:
+        for name, settings in CONFIGS.items():
+            port = free_port()
+            proxy = spawn_proxy(port, upstream_base, dict(
+                settings,
+                SINGLE_FLIGHT="false",
+                UPSTREAM_MAX_KEEPALIVE_CONNECTIONS=str(args.concurrency * 2)
+            ))
+            try:
+                results[name] = asyncio.run(run_load(f"http://127.0.0.1:{port}", args))
+            finally:
+                proxy.terminate()
+                proxy.wait(10)
+    finally:
+        upstream.terminate()
+        upstream.wait(10)
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,260 @@
+"""A local fake OpenAI-compatible upstream for benchmarks.
+
+Serves /v1/chat/completions (streaming and non-streaming) with a configurable
+time to first token, number of chunks and gap between chunks (or a token
+rate). Requests that carry tools are answered with a streamed tool call at
+--tool-call-rate, --error-rate of all requests fail with --error-status, and
+--stall-rate of them wait an extra --stall-ms before their first token.
+--prefill-ms-per-1k-tokens adds a delay growing with the prompt (estimated at
+four characters of message text and tool calls per token), standing in for the
+prefill time of a real model.
+An optional TCP front adds a fixed delay to every new connection, standing in
+for the TCP and TLS handshakes to a remote upstream, so connection reuse
+becomes measurable.
+
+Usage as a library:
+    upstream = FakeUpstream(first_token_latency=0.05, connect_delay=0.03)
+    base_url = upstream.start()   # e.g. http://127.0.0.1:54321/v1
+    ...
+    upstream.stop()
+
+Or standalone:
+    python benchmarks/fake_upstream.py --port 8099 --connect-delay-ms 30
+"""
+import argparse
+import asyncio
+import json
+import random
+import socket
+import threading
+import time
+import uuid
+
+import uvicorn
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def prompt_chars(messages) -> int:
+    """Characters of text in chat messages: contents, tool call names and arguments."""
+    total = 0
+    for message in messages:
+        content = message.get("content")
+        if isinstance(content, str):
+            total += len(content)
+        elif isinstance(content, list):
+            total += sum(len(part.get("text") or "") for part in content if isinstance(part, dict))
+        for call in message.get("tool_calls") or ():
+            function = call.get("function") or {}
+            total += len(function.get("name") or "") + len(function.get("arguments") or "")
+    return total
+
+
+def make_app(first_token_latency: float, chunks: int, chunk_gap: float, words_per_chunk: int,
+             tool_call_rate: float = 0.0, error_rate: float = 0.0, error_status: int = 500, seed: int = 0,
+             stall_rate: float = 0.0, stall: float = 0.0, prefill_per_token: float = 0.0) -> FastAPI:
+    app = FastAPI()
+    app.state.requests = 0
+    app.state.errors = 0
+    rng = random.Random(seed)
+
+    @app.post("/v1/chat/completions")
+    async def chat_completions(request: Request):
+        body = await request.json()
+        app.state.requests += 1
+        completion_id = f"chatcmpl-{uuid.uuid4().hex[:12]}"
+        created = int(time.time())
+        model = body.get("model", "fake")
+        text = " ".join(["token"] * words_per_chunk) + " "
+        usage = {"prompt_tokens": 10, "completion_tokens": chunks * words_per_chunk, "total_tokens": 10 + chunks * words_per_chunk}
+        delay = first_token_latency + (stall if stall_rate and rng.random() < stall_rate else 0.0)
+        if prefill_per_token:
+            delay += prefill_per_token * prompt_chars(body.get("messages", [])) / 4
+
+        if error_rate and rng.random() < error_rate:
+            app.state.errors += 1
+            await asyncio.sleep(first_token_latency)
+            headers = {"retry-after": "1"} if error_status == 429 else None
+            return JSONResponse({"error": {"message": "fake upstream error", "type": "server_error"}},
+                                status_code=error_status, headers=headers)
+
+        tool_name = None
+        if body.get("tools") and tool_call_rate and rng.random() < tool_call_rate:
+            tool_name = body["tools"][0]["function"]["name"]
+        arguments = json.dumps({"file_path": "/repo/src/module.py", "content": text * chunks})
+
+        if not body.get("stream"):
+            await asyncio.sleep(delay + chunk_gap * chunks)
+            message = {"role": "assistant", "content": text * chunks}
+            if tool_name:
+                message["tool_calls"] = [{"id": f"call_{uuid.uuid4().hex[:8]}", "type": "function",
+                                          "function": {"name": tool_name, "arguments": arguments}}]
+            return JSONResponse({
+                "id": completion_id,
+                "object": "chat.completion",
+                "created": created,
+                "model": model,
+                "choices": [{"index": 0, "message": message, "finish_reason": "tool_calls" if tool_name else "stop"}],
+                "usage": usage,
+            })
+
+        def chunk(delta, finish_reason=None, **extra):
+            return "data: " + json.dumps({
+                "id": completion_id,
+                "object": "chat.completion.chunk",
+                "created": created,
+                "model": model,
+                "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}],
+                **extra,
+            }) + "\n\n"
+
+        async def events():
+            await asyncio.sleep(delay)
+            if tool_name:
+                # A short text preamble, then the tool call with its arguments in fragments
+                yield chunk({"role": "assistant", "content": text})
+                yield chunk({"tool_calls": [{"index": 0, "id": f"call_{uuid.uuid4().hex[:8]}", "type": "function",
+                                             "function": {"name": tool_name, "arguments": ""}}]})
+                step = max(1, len(arguments) // max(1, chunks))
+                for i in range(0, len(arguments), step):
+                    await asyncio.sleep(chunk_gap)
+                    yield chunk({"tool_calls": [{"index": 0, "function": {"arguments": arguments[i:i + step]}}]})
+            else:
+                for i in range(chunks):
+                    if i:
+                        await asyncio.sleep(chunk_gap)
+                    yield chunk({"role": "assistant", "content": text} if i == 0 else {"content": text})
+            yield chunk({}, "tool_calls" if tool_name else "stop", usage=usage)
+            yield "data: [DONE]\n\n"
+
+        return StreamingResponse(events(), media_type="text/event-stream")
+
+    return app
+
+
+class SlowConnectFront:
+    """TCP front that delays every new connection before piping it to the backend."""
+
+    def __init__(self, backend_port: int, connect_delay: float):
+        self.backend_port = backend_port
+        self.connect_delay = connect_delay
+        self.connections = 0
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self.connections += 1
+        await asyncio.sleep(self.connect_delay)
+        backend_reader, backend_writer = await asyncio.open_connection("127.0.0.1", self.backend_port)
+
+        async def pipe(src: asyncio.StreamReader, dst: asyncio.StreamWriter):
+            try:
+                while True:
+                    data = await src.read(65536)
+                    if not data:
+                        break
+                    dst.write(data)
+                    await dst.drain()
+            except (ConnectionError, asyncio.CancelledError):
+                pass
+            finally:
+                try:
+                    dst.close()
+                except Exception:
+                    pass
+
+        await asyncio.gather(pipe(reader, backend_writer), pipe(backend_reader, writer))
+
+
+class FakeUpstream:
+    """Runs the fake upstream (and optional slow-connect front) on a background thread."""
+
+    def __init__(self, first_token_latency: float = 0.05, chunks: int = 20, chunk_gap: float = 0.005,
+                 words_per_chunk: int = 3, connect_delay: float = 0.0, port: int = 0,
+                 tool_call_rate: float = 0.0, error_rate: float = 0.0, error_status: int = 500,
+                 stall_rate: float = 0.0, stall: float = 0.0, prefill_per_token: float = 0.0):
+        self.app = make_app(first_token_latency, chunks, chunk_gap, words_per_chunk,
+                            tool_call_rate, error_rate, error_status, stall_rate=stall_rate, stall=stall,
+                            prefill_per_token=prefill_per_token)
+        self.connect_delay = connect_delay
+        self.port = port or free_port()
+        self.front = None
+        self._server = None
+        self._thread = None
+        self._ready = threading.Event()
+
+    @property
+    def requests(self) -> int:
+        return self.app.state.requests
+
+    @property
+    def connections(self) -> int:
+        return self.front.connections if self.front else 0
+
+    def start(self) -> str:
+        """Start serving; returns the OpenAI base URL."""
+        backend_port = free_port() if self.connect_delay > 0 else self.port
+        config = uvicorn.Config(self.app, host="127.0.0.1", port=backend_port, log_level="error", lifespan="off")
+        self._server = uvicorn.Server(config)
+
+        async def serve():
+            front_server = None
+            if self.connect_delay > 0:
+                self.front = SlowConnectFront(backend_port, self.connect_delay)
+                front_server = await asyncio.start_server(self.front.handle, "127.0.0.1", self.port)
+            serve_task = asyncio.create_task(self._server.serve())
+            while not self._server.started:
+                await asyncio.sleep(0.01)
+            self._ready.set()
+            await serve_task
+            if front_server is not None:
+                front_server.close()
+
+        self._thread = threading.Thread(target=asyncio.run, args=(serve(),), daemon=True)
+        self._thread.start()
+        self._ready.wait(10)
+        return f"http://127.0.0.1:{self.port}/v1"
+
+    def stop(self):
+        if self._server is not None:
+            self._server.should_exit = True
+        if self._thread is not None:
+            self._thread.join(5)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--port", type=int, default=8099)
+    parser.add_argument("--first-token-ms", type=float, default=50)
+    parser.add_argument("--chunks", type=int, default=20)
+    parser.add_argument("--chunk-gap-ms", type=float, default=5)
+    parser.add_argument("--tokens-per-second", type=float, default=0, help="overrides --chunk-gap-ms")
+    parser.add_argument("--words-per-chunk", type=int, default=3)
+    parser.add_argument("--tool-call-rate", type=float, default=0.0, help="share of tool-carrying requests answered with a tool call")
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--error-status", type=int, default=500)
+    parser.add_argument("--stall-rate", type=float, default=0.0, help="share of requests with a slow first token")
+    parser.add_argument("--stall-ms", type=float, default=2000)
+    parser.add_argument("--prefill-ms-per-1k-tokens", type=float, default=0, help="extra time to first token per prompt size")
+    parser.add_argument("--connect-delay-ms", type=float, default=0)
+    args = parser.parse_args()
+
+    chunk_gap = args.words_per_chunk / args.tokens_per_second if args.tokens_per_second else args.chunk_gap_ms / 1000
+    upstream = FakeUpstream(args.first_token_ms / 1000, args.chunks, chunk_gap, args.words_per_chunk,
+                            connect_delay=args.connect_delay_ms / 1000, port=args.port,
+                            tool_call_rate=args.tool_call_rate, error_rate=args.error_rate,
+                            error_status=args.error_status, stall_rate=args.stall_rate,
+                            stall=args.stall_ms / 1000, prefill_per_token=args.prefill_ms_per_1k_tokens / 1e6)
+    print(f"Fake upstream on {upstream.start()}")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        upstream.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,288 @@
+"""End-to-end load test of the proxy against a local fake upstream.
+
+Starts benchmarks/fake_upstream.py and the proxy as separate processes (or
+targets an already running proxy with --proxy-url) and replays Claude Code
+style conversations through /v1/messages: every request resends the
+conversation so far, with the Claude Code tool list, and each virtual
+conversation grows turn by turn.
+
+Two load models:
+    closed  --users N virtual users, each sending its next turn as soon as the
+            previous response is complete (plus --think-ms)
+    open    Poisson arrivals at --rate requests per second, independent of how
+            fast responses come back
+
+Results (throughput, error rate, p50/p95/p99 time to first token and total
+latency) are printed as JSON and optionally written to --output. --compare
+prints the relative change against an earlier result file.
+
+Usage:
+    python benchmarks/loadtest.py --mode closed --users 20 --duration 30 --output before.json
+    python benchmarks/loadtest.py --mode open --rate 40 --duration 30 --compare before.json
+    python benchmarks/loadtest.py --proxy-env SSE_COALESCE_WINDOW_MS=15 --tool-call-rate 0.5
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import statistics
+import subprocess
+import sys
+import time
+from typing import Any, Dict, List, Optional
+
+import httpx
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, ROOT)
+
+from benchmarks.fake_upstream import free_port
+from benchmarks.transcripts import make_messages, make_tools
+
+
+def percentile(values: List[float], q: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+def summarize_ms(values: List[float]) -> Dict[str, Optional[float]]:
+    if not values:
+        return {"p50": None, "p95": None, "p99": None, "mean": None}
+    return {
+        "p50": round(percentile(values, 0.50) * 1000, 1),
+        "p95": round(percentile(values, 0.95) * 1000, 1),
+        "p99": round(percentile(values, 0.99) * 1000, 1),
+        "mean": round(statistics.fmean(values) * 1000, 1),
+    }
+
+
+def wait_until_up(url: str, timeout: float = 60):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            httpx.get(url, timeout=1)
+            return
+        except httpx.HTTPError:
+            time.sleep(0.2)
+    raise RuntimeError(f"{url} did not come up")
+
+
+def spawn_fake_upstream(port: int, upstream_args: List[str]) -> subprocess.Popen:
+    """Start benchmarks/fake_upstream.py on port; returns once it accepts requests."""
+    process = subprocess.Popen(
+        [sys.executable, os.path.join(ROOT, "benchmarks", "fake_upstream.py"), "--port", str(port)] + upstream_args,
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+    )
+    wait_until_up(f"http://127.0.0.1:{port}/")
+    return process
+
+
+def spawn_proxy(port: int, upstream_base: str, settings: Dict[str, str]) -> subprocess.Popen:
+    """Start the proxy with uvicorn, pointed at upstream_base; returns once it is up."""
+    env = dict(
+        os.environ,
+        OPENAI_API_BASE=upstream_base,
+        OPENAI_API_KEY="sk-fake",
+        LITELLM_LOCAL_MODEL_COST_MAP="True",
+        LITELLM_LOG="ERROR",
+        **settings
+    )
+    process = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "server:app", "--port", str(port), "--log-level", "error"],
+        cwd=ROOT, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+    )
+    wait_until_up(f"http://127.0.0.1:{port}/")
+    return process
+
+
+class Conversations:
+    """Claude Code style conversations, handed out turn by turn."""
+
+    def __init__(self, args):
+        self.args = args
+        self.tools = make_tools()
+        self._cache: Dict[int, List[Dict[str, Any]]] = {}
+
+    def messages(self, conversation: int, turn: int) -> List[Dict[str, Any]]:
+        full = self._cache.get(conversation)
+        if full is None:
+            full = self._cache[conversation] = make_messages(2 * self.args.max_turns + 1, self.args.tool_result_bytes, seed=conversation)
+        # Turn t resends the first 2t+1 messages, which always end with a user turn
+        return full[:2 * (turn % self.args.max_turns) + 1]
+
+    def body(self, conversation: int, turn: int) -> Dict[str, Any]:
+        return {
+            "model": self.args.model,
+            "max_tokens": 4096,
+            "stream": not self.args.no_stream,
+            "system": "You are Claude Code, a coding assistant working in /repo.",
+            "tools": self.tools,
+            "messages": self.messages(conversation, turn),
+        }
+
+
+async def send(client: httpx.AsyncClient, body: Dict[str, Any]) -> Dict[str, Any]:
+    """Send one request; returns its status, time to first token and total time."""
+    start = time.perf_counter()
+    first_token = None
+    failed = False
+    try:
+        if body["stream"]:
+            async with client.stream("POST", "/v1/messages", json=body) as response:
+                async for line in response.aiter_lines():
+                    if first_token is None and line.startswith("data: ") and "content_block_delta" in line:
+                        first_token = time.perf_counter() - start
+                    if line.startswith("data: ") and '"stop_reason": "error"' in line:
+                        failed = True
+                status = response.status_code
+        else:
+            response = await client.post("/v1/messages", json=body)
+            status = response.status_code
+            first_token = time.perf_counter() - start
+    except httpx.HTTPError:
+        status = 0
+    return {
+        "ok": status == 200 and not failed,
+        "status": status,
+        "ttft": first_token,
+        "latency": time.perf_counter() - start,
+    }
+
+
+async def closed_loop(client: httpx.AsyncClient, conversations: Conversations, args) -> List[Dict[str, Any]]:
+    results = []
+    deadline = time.perf_counter() + args.duration
+
+    async def user(user_id: int):
+        turn = 0
+        while time.perf_counter() < deadline:
+            results.append(await send(client, conversations.body(user_id, turn)))
+            turn += 1
+            if args.think_ms:
+                await asyncio.sleep(args.think_ms / 1000)
+
+    await asyncio.gather(*(user(i) for i in range(args.users)))
+    return results
+
+
+async def open_loop(client: httpx.AsyncClient, conversations: Conversations, args) -> List[Dict[str, Any]]:
+    rng = random.Random(args.seed)
+    results = []
+    tasks = []
+    deadline = time.perf_counter() + args.duration
+
+    async def one(i: int):
+        # Arrivals rotate over --users conversations, each one advancing a turn per visit
+        results.append(await send(client, conversations.body(i % args.users, i // args.users)))
+
+    i = 0
+    while time.perf_counter() < deadline:
+        tasks.append(asyncio.create_task(one(i)))
+        i += 1
+        await asyncio.sleep(rng.expovariate(args.rate))
+    await asyncio.gather(*tasks)
+    return results
+
+
+async def run(proxy_url: str, args) -> Dict[str, Any]:
+    conversations = Conversations(args)
+    limits = httpx.Limits(max_connections=None, max_keepalive_connections=1000)
+    async with httpx.AsyncClient(base_url=proxy_url, timeout=args.timeout, limits=limits) as client:
+        # Warm up the proxy (imports, tokenizers, connections) before measuring
+        await send(client, conversations.body(-1, 0))
+        start = time.perf_counter()
+        if args.mode == "closed":
+            results = await closed_loop(client, conversations, args)
+        else:
+            results = await open_loop(client, conversations, args)
+        elapsed = time.perf_counter() - start
+
+    ok = [r for r in results if r["ok"]]
+    statuses: Dict[str, int] = {}
+    for r in results:
+        statuses[str(r["status"])] = statuses.get(str(r["status"]), 0) + 1
+    return {
+        "requests": len(results),
+        "errors": len(results) - len(ok),
+        "error_rate": round((len(results) - len(ok)) / len(results), 4) if results else 0.0,
+        "statuses": statuses,
+        "duration_s": round(elapsed, 2),
+        "throughput_rps": round(len(ok) / elapsed, 2),
+        "ttft_ms": summarize_ms([r["ttft"] for r in ok if r["ttft"] is not None]),
+        "latency_ms": summarize_ms([r["latency"] for r in ok]),
+    }
+
+
+def compare(current: Dict[str, Any], baseline: Dict[str, Any]) -> Dict[str, Optional[float]]:
+    """Relative change (percent) of the headline numbers against a baseline result."""
+    changes = {}
+    for section, key in (("throughput_rps", None), ("ttft_ms", "p50"), ("ttft_ms", "p95"), ("ttft_ms", "p99"),
+                         ("latency_ms", "p50"), ("latency_ms", "p95"), ("latency_ms", "p99")):
+        now = current["results"][section] if key is None else current["results"][section][key]
+        before = baseline["results"][section] if key is None else baseline["results"][section][key]
+        name = section if key is None else f"{section}_{key}"
+        changes[name] = round((now - before) / before * 100, 1) if now is not None and before else None
+    return changes
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--mode", choices=["closed", "open"], default="closed")
+    parser.add_argument("--users", type=int, default=10, help="closed loop: virtual users; open loop: conversations")
+    parser.add_argument("--rate", type=float, default=20, help="open loop: requests per second")
+    parser.add_argument("--duration", type=float, default=20, help="seconds of load")
+    parser.add_argument("--think-ms", type=float, default=0)
+    parser.add_argument("--model", default="claude-3-5-sonnet-20241022")
+    parser.add_argument("--no-stream", action="store_true")
+    parser.add_argument("--max-turns", type=int, default=20, help="turns per conversation before it starts over")
+    parser.add_argument("--tool-result-bytes", type=int, default=2000)
+    parser.add_argument("--timeout", type=float, default=120)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--proxy-url", help="load an already running proxy instead of spawning one")
+    parser.add_argument("--proxy-env", action="append", default=[], metavar="KEY=VALUE", help="settings for the spawned proxy")
+    # Fake upstream behavior (ignored with --proxy-url)
+    parser.add_argument("--first-token-ms", type=float, default=300)
+    parser.add_argument("--tokens-per-second", type=float, default=80)
+    parser.add_argument("--output-chunks", type=int, default=40)
+    parser.add_argument("--tool-call-rate", type=float, default=0.3)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--error-status", type=int, default=500)
+    parser.add_argument("--output", help="write the result JSON here")
+    parser.add_argument("--compare", help="earlier result JSON to compare against")
+    args = parser.parse_args()
+
+    processes = []
+    try:
+        proxy_url = args.proxy_url
+        if proxy_url is None:
+            upstream_port = free_port()
+            processes.append(spawn_fake_upstream(upstream_port, [
+                "--first-token-ms", str(args.first_token_ms),
+                "--tokens-per-second", str(args.tokens_per_second),
+                "--chunks", str(args.output_chunks),
+                "--tool-call-rate", str(args.tool_call_rate),
+                "--error-rate", str(args.error_rate),
+                "--error-status", str(args.error_status),
+            ]))
+            proxy_port = free_port()
+            settings = dict(setting.split("=", 1) for setting in args.proxy_env)
+            processes.append(spawn_proxy(proxy_port, f"http://127.0.0.1:{upstream_port}/v1", settings))
+            proxy_url = f"http://127.0.0.1:{proxy_port}"
+        report = {"config": vars(args), "results": asyncio.run(run(proxy_url, args))}
+    finally:
+        for process in reversed(processes):
+            process.terminate()
+            process.wait(10)
+
+    if args.compare:
+        with open(args.compare) as f:
+            report["change_pct"] = compare(report, json.load(f))
+    print(json.dumps(report, indent=2))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
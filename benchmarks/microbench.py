@@ -0,0 +1,274 @@
+"""Microbenchmarks of the translation layer at realistic conversation sizes.
+
+Times the CPU hot paths of a request on synthetic Claude Code transcripts
+(large tool results, 20 tools, screenshots every few turns) and records the
+peak memory each one allocates:
+
+    convert_anthropic_to_litellm           whole request, translation caches empty
+    convert_anthropic_to_litellm_warm      the OpenAI request again, every message cached
+    convert_anthropic_to_litellm_openai    whole request flattened for an OpenAI model
+    convert_anthropic_to_litellm_openai_tools   same with native tool_calls / tool messages
+    flatten_openai_message                 the OpenAI flattening step alone
+    parse_tool_result_content              every tool_result payload of the transcript
+    compact_tool_results                   tool result compaction of the whole conversation
+    convert_litellm_to_anthropic           a text response and a response with tool calls
+    stream_anthropic_events                streamed tool calls (40 KB of arguments in 8 byte
+                                           fragments), one after the other and interleaved
+
+Times are the best of --repeats runs per call; peak memory is measured once
+with tracemalloc, separately from the timed runs. --save-baseline stores the
+results; --baseline compares against stored results and exits non-zero when a
+case got slower or allocates more than --threshold (relative) beyond it.
+benchmarks/microbench_baseline.json is the baseline of the current tree with the
+default arguments; refresh it with --save-baseline when a change is expected to
+move the numbers.
+
+Usage:
+    python benchmarks/microbench.py --save-baseline benchmarks/microbench_baseline.json
+    python benchmarks/microbench.py --baseline benchmarks/microbench_baseline.json --threshold 0.2
+"""
+import argparse
+import asyncio
+import gc
+import json
+import os
+import sys
+import time
+import tracemalloc
+from typing import Any, Callable, Dict, List
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+os.environ.setdefault("LITELLM_LOCAL_MODEL_COST_MAP", "True")
+
+import litellm
+
+import server
+from benchmarks.transcripts import make_messages, make_tools
+
+SYSTEM = "You are Claude Code, a coding assistant working in /repo."
+
+# Differences below these are noise, whatever the relative change
+MIN_MS_DELTA = 0.02
+MIN_KB_DELTA = 16
+
+
+def reset_caches():
+    server.translation_cache = server.LRUCache(0)
+    server.tool_cache = server.LRUCache(0)
+    server.image_cache = server.LRUCache(0)
+
+
+def measure(func: Callable[[], Any], repeats: int, min_run_seconds: float = 0.05) -> Dict[str, float]:
+    """Best-of-repeats time per call and the tracemalloc peak of a single call."""
+    func()
+    # Calibrate the number of calls per run so short cases are timed over a useful interval
+    number = 1
+    while True:
+        start = time.perf_counter()
+        for _ in range(number):
+            func()
+        if time.perf_counter() - start >= min_run_seconds or number >= 100000:
+            break
+        number *= 2
+
+    gc_was_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        best = float("inf")
+        for _ in range(repeats):
+            start = time.perf_counter()
+            for _ in range(number):
+                func()
+            best = min(best, (time.perf_counter() - start) / number)
+    finally:
+        if gc_was_enabled:
+            gc.enable()
+
+    tracemalloc.start()
+    try:
+        baseline = tracemalloc.get_traced_memory()[0]
+        func()
+        peak = tracemalloc.get_traced_memory()[1] - baseline
+    finally:
+        tracemalloc.stop()
+    return {"ms": round(best * 1000, 4), "peak_kb": round(peak / 1024, 1)}
+
+
+def make_request(model: str, messages: List[Dict[str, Any]], tools: List[Dict[str, Any]]) -> server.MessagesRequest:
+    return server.MessagesRequest(model=model, max_tokens=4096, system=SYSTEM, tools=tools, messages=messages)
+
+
+def make_response(text_bytes: int, tool_calls: int) -> litellm.ModelResponse:
+    message = {"role": "assistant", "content": ("All tests pass after the refactor. " * (text_bytes // 35 + 1))[:text_bytes]}
+    if tool_calls:
+        message["tool_calls"] = [
+            {"id": f"call_{i:04d}", "type": "function",
+             "function": {"name": "Edit", "arguments": json.dumps({"file_path": f"/repo/src/module_{i}.py", "content": "x = 1\n" * 200})}}
+            for i in range(tool_calls)
+        ]
+    return litellm.ModelResponse(
+        id="chatcmpl-microbench",
+        model="gpt-4.1",
+        choices=[{"index": 0, "message": message, "finish_reason": "tool_calls" if tool_calls else "stop"}],
+        usage={"prompt_tokens": 50000, "completion_tokens": 800, "total_tokens": 50800},
+    )
+
+
+def make_stream(tool_calls: int, arguments_bytes: int, fragment_bytes: int, interleaved: bool) -> List[Any]:
+    """Stream chunks of parallel tool calls, their arguments in fragments, as LiteLLM yields them."""
+    def chunk(delta, finish_reason=None):
+        return litellm.ModelResponseStream(choices=[{"index": 0, "delta": delta, "finish_reason": finish_reason}])
+
+    fragments = []
+    for i in range(tool_calls):
+        arguments = json.dumps({"file_path": f"/repo/src/module_{i}.py", "content": ('print("x")\n' * arguments_bytes)[:arguments_bytes]})
+        fragments.append([chunk({"tool_calls": [{"index": i, "function": {"arguments": arguments[n:n + fragment_bytes]}}]})
+                          for n in range(0, len(arguments), fragment_bytes)])
+    chunks = [chunk({"role": "assistant", "content": "Writing the modules."})]
+    chunks += [chunk({"tool_calls": [{"index": i, "id": f"call_{i:04d}", "type": "function",
+                                      "function": {"name": "Write", "arguments": ""}}]}) for i in range(tool_calls)]
+    if interleaved:
+        chunks += [call[n] for n in range(max(map(len, fragments))) for call in fragments if n < len(call)]
+    else:
+        chunks += [c for call in fragments for c in call]
+    return chunks + [chunk({}, "tool_calls")]
+
+
+def stream_cases() -> Dict[str, Callable[[], Any]]:
+    request = server.MessagesRequest(model="openai/gpt-4.1", max_tokens=4096,
+                                     messages=[{"role": "user", "content": "Refactor server.py"}])
+    loop = asyncio.new_event_loop()
+
+    async def replay(chunks):
+        async def upstream():
+            for c in chunks:
+                yield c
+        return [event async for event in server.stream_anthropic_events(upstream(), request)]
+
+    sequential = make_stream(2, 20000, 8, interleaved=False)
+    interleaved = make_stream(2, 20000, 8, interleaved=True)
+    return {
+        "tool_calls_2_sequential": lambda: loop.run_until_complete(replay(sequential)),
+        "tool_calls_2_interleaved": lambda: loop.run_until_complete(replay(interleaved)),
+    }
+
+
+def conversation_cases(size: int, args) -> Dict[str, Callable[[], Any]]:
+    messages = make_messages(size, args.tool_result_bytes, image_every=args.image_every,
+                             image_bytes=args.image_bytes, block_results_every=3)
+    tools = make_tools(args.tools)
+    request = make_request("anthropic/claude-sonnet-4-20250514", messages, tools)
+    openai_request = make_request("openai/gpt-4.1", messages, tools)
+    converted = [m for msg in request.messages for m in server.convert_message_to_litellm(msg)]
+    tool_results = [
+        block.content
+        for msg in request.messages if isinstance(msg.content, list)
+        for block in msg.content if block.type == "tool_result"
+    ]
+
+    def cold():
+        reset_caches()
+        server.convert_anthropic_to_litellm(request)
+
+    warm_cache = server.LRUCache(2 * size + 16)
+    warm_images = server.LRUCache(size + 16)
+
+    def warm():
+        server.translation_cache = warm_cache
+        server.tool_cache = server.LRUCache(16)
+        server.image_cache = warm_images
+        server.convert_anthropic_to_litellm(openai_request, flatten_for_openai=True)
+
+    def cold_openai():
+        reset_caches()
+        server.convert_anthropic_to_litellm(openai_request, flatten_for_openai=True)
+
+    def cold_openai_tools():
+        reset_caches()
+        server.convert_anthropic_to_litellm(openai_request, flatten_for_openai=True, native_tool_calls=True)
+
+    return {
+        "convert_anthropic_to_litellm": cold,
+        "convert_anthropic_to_litellm_warm": warm,
+        "convert_anthropic_to_litellm_openai": cold_openai,
+        "convert_anthropic_to_litellm_openai_tools": cold_openai_tools,
+        "flatten_openai_message": lambda: [server.flatten_openai_message(m) for m in converted],
+        "parse_tool_result_content": lambda: [server.parse_tool_result_content(c) for c in tool_results],
+        "compact_tool_results": lambda: server.compact_tool_results(request.messages, 500, 4),
+    }
+
+
+def response_cases() -> Dict[str, Callable[[], Any]]:
+    request = server.MessagesRequest(model="openai/gpt-4.1", max_tokens=4096,
+                                     messages=[{"role": "user", "content": "Refactor server.py"}])
+    request.original_model = "claude-sonnet-4-20250514"
+    text = make_response(4000, 0)
+    tool_calls = make_response(500, 8)
+    return {
+        "text_4kb": lambda: server.convert_litellm_to_anthropic(text, request),
+        "tool_calls_8": lambda: server.convert_litellm_to_anthropic(tool_calls, request),
+    }
+
+
+def run(args) -> Dict[str, Dict[str, Dict[str, float]]]:
+    results: Dict[str, Dict[str, Dict[str, float]]] = {}
+    for size in args.sizes:
+        for name, func in conversation_cases(size, args).items():
+            results.setdefault(name, {})[f"{size}_messages"] = measure(func, args.repeats)
+    for case, func in response_cases().items():
+        results.setdefault("convert_litellm_to_anthropic", {})[case] = measure(func, args.repeats)
+    for case, func in stream_cases().items():
+        results.setdefault("stream_anthropic_events", {})[case] = measure(func, args.repeats)
+    reset_caches()
+    return results
+
+
+def find_regressions(results, baseline, threshold: float) -> List[str]:
+    """Cases whose time or peak memory grew by more than threshold over the baseline."""
+    regressions = []
+    for name, cases in results.items():
+        for case, now in cases.items():
+            before = baseline.get(name, {}).get(case)
+            if before is None:
+                continue
+            for metric, min_delta in (("ms", MIN_MS_DELTA), ("peak_kb", MIN_KB_DELTA)):
+                delta = now[metric] - before[metric]
+                if before[metric] and delta > min_delta and delta / before[metric] > threshold:
+                    regressions.append(f"{name}[{case}] {metric}: {before[metric]} -> {now[metric]} "
+                                       f"(+{delta / before[metric]:.0%})")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sizes", type=lambda s: [int(n) for n in s.split(",")], default=[10, 100, 500, 1000])
+    parser.add_argument("--tool-result-bytes", type=int, default=8000)
+    parser.add_argument("--tools", type=int, default=20)
+    parser.add_argument("--image-every", type=int, default=10, help="a screenshot every n tool results, 0 for none")
+    parser.add_argument("--image-bytes", type=int, default=50000)
+    parser.add_argument("--repeats", type=int, default=5, help="timed runs per case, best one is kept")
+    parser.add_argument("--save-baseline", help="write the results here")
+    parser.add_argument("--baseline", help="earlier results to compare against")
+    parser.add_argument("--threshold", type=float, default=0.2, help="relative growth that counts as a regression")
+    args = parser.parse_args()
+
+    server.logger.setLevel("ERROR")
+    results = run(args)
+    print(json.dumps(results, indent=2))
+
+    if args.save_baseline:
+        with open(args.save_baseline, "w") as f:
+            json.dump(results, f, indent=2)
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = find_regressions(results, json.load(f), args.threshold)
+        if regressions:
+            print(f"{len(regressions)} regression(s) beyond {args.threshold:.0%}:", file=sys.stderr)
+            for line in regressions:
+                print(f"  {line}", file=sys.stderr)
+            sys.exit(1)
+        print(f"No regressions beyond {args.threshold:.0%}", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
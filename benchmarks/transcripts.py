@@ -0,0 +1,88 @@
+"""Synthetic Claude Code style transcripts for benchmarks.
+
+Conversations alternate assistant tool_use turns with user tool_result turns,
+the way a Claude Code session looks after a few rounds of file reads and edits.
+"""
+import base64
+import random
+from typing import Any, Dict, List
+
+TOOL_NAMES = ["Read", "Write", "Edit", "Bash", "Grep", "Glob", "LS", "TodoWrite"]
+
+
+def make_tools(count: int = len(TOOL_NAMES)) -> List[Dict[str, Any]]:
+    """Anthropic tool definitions named like Claude Code's built-in tools.
+
+    Beyond the built-in names, extra tools are named like MCP server tools.
+    """
+    names = TOOL_NAMES[:count] + [f"mcp__repo__tool_{i}" for i in range(count - len(TOOL_NAMES))]
+    return [
+        {
+            "name": name,
+            "description": f"{name} tool: operate on files and the shell in the working directory.",
+            "input_schema": {
+                "type": "object",
+                "properties": {
+                    "file_path": {"type": "string", "description": "Absolute path"},
+                    "content": {"type": "string"},
+                    "limit": {"type": "integer"},
+                },
+                "required": ["file_path"],
+            },
+        }
+        for name in names
+    ]
+
+
+def make_tool_result_text(rng: random.Random, size: int) -> str:
+    lines = []
+    total = 0
+    n = 1
+    while total < size:
+        line = f"{n:>6}\t" + " ".join(rng.choice(["def", "return", "self", "value", "import", "for", "in", "if"]) for _ in range(8))
+        lines.append(line)
+        total += len(line) + 1
+        n += 1
+    return "\n".join(lines)
+
+
+def make_image_block(rng: random.Random, size: int) -> Dict[str, Any]:
+    """A base64 image block with size bytes of (random, not actually decodable) image data."""
+    data = base64.b64encode(rng.randbytes(size)).decode("ascii")
+    return {"type": "image", "source": {"type": "base64", "media_type": "image/png", "data": data}}
+
+
+def make_messages(num_messages: int, tool_result_bytes: int = 2000, seed: int = 0,
+                  image_every: int = 0, image_bytes: int = 50000, block_results_every: int = 0) -> List[Dict[str, Any]]:
+    """Build a conversation of num_messages Anthropic messages (first one is the user prompt).
+
+    With image_every, every n-th tool result turn also carries a screenshot. With
+    block_results_every, every n-th tool result holds a list of text blocks instead of a string.
+    """
+    rng = random.Random(seed)
+    messages: List[Dict[str, Any]] = [
+        {"role": "user", "content": "Refactor the request handling in server.py and add tests."}
+    ]
+    turn = 0
+    while len(messages) < num_messages:
+        tool_id = f"toolu_{seed:04d}{turn:06d}"
+        name = TOOL_NAMES[turn % len(TOOL_NAMES)]
+        messages.append({
+            "role": "assistant",
+            "content": [
+                {"type": "text", "text": f"Let me look at step {turn} of the change."},
+                {"type": "tool_use", "id": tool_id, "name": name, "input": {"file_path": f"/repo/src/module_{turn}.py", "limit": 200}},
+            ],
+        })
+        if len(messages) >= num_messages:
+            break
+        result: Any = make_tool_result_text(rng, tool_result_bytes)
+        if block_results_every and turn % block_results_every == 0:
+            lines = result.split("\n")
+            result = [{"type": "text", "text": "\n".join(lines[i:i + 20])} for i in range(0, len(lines), 20)]
+        content = [{"type": "tool_result", "tool_use_id": tool_id, "content": result}]
+        if image_every and turn % image_every == image_every - 1:
+            content.append(make_image_block(rng, image_bytes))
+        messages.append({"role": "user", "content": content})
+        turn += 1
+    return messages[:num_messages]
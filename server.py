@@ -1,12 +1,13 @@
 from fastapi import FastAPI, Request, HTTPException
+from fastapi.exceptions import RequestValidationError
 import uvicorn
 import logging
 import json
-from pydantic import BaseModel, Field, field_validator, model_validator
-from typing import List, Dict, Any, Optional, Union, Literal
+from pydantic import BaseModel, Field, PrivateAttr, ValidationError, model_validator
+from typing import List, Dict, Any, Optional, Union, Literal, Annotated
 import httpx
 import os
-from fastapi.responses import JSONResponse, StreamingResponse
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
 import litellm
 import uuid
 import time
@@ -14,6 +15,22 @@ from dotenv import load_dotenv
 import re
 from datetime import datetime
 import sys
+import asyncio
+import functools
+import pickle
+import random
+import bisect
+import hashlib
+import base64
+import io
+import tempfile
+import threading
+import weakref
+from collections import OrderedDict, deque
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import asynccontextmanager
 
 # Load environment variables from .env file
 load_dotenv()
@@ -72,7 +89,17 @@ for handler in logger.handlers:
     if isinstance(handler, logging.StreamHandler):
         handler.setFormatter(ColorizedFormatter('%(asctime)s - %(levelname)s - %(message)s'))
 
-app = FastAPI()
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Start background resources before serving and release them on shutdown."""
+    tokenizer_engine.start(model_router.default_models)
+    try:
+        yield
+    finally:
+        tokenizer_engine.shutdown()
+        await upstream_pools.aclose()
+
+app = FastAPI(lifespan=lifespan)
 
 # Get API keys from environment
 ANTHROPIC_API_KEY = os.environ.get("ANTHROPIC_API_KEY")
@@ -85,6 +112,137 @@ PREFERRED_PROVIDER = os.environ.get("PREFERRED_PROVIDER", "openai").lower()
 # Get custom OpenAI API base URL for LiteLLM proxy support
 OPENAI_API_BASE = os.environ.get("OPENAI_API_BASE", None)
 
+# Upstream call configuration
+# How non-streaming completions are awaited: "async" uses litellm.acompletion on the
+# event loop, "thread" offloads the blocking litellm.completion to a worker thread pool
+UPSTREAM_CALL_MODE = os.environ.get("UPSTREAM_CALL_MODE", "async").lower()
+UPSTREAM_THREAD_WORKERS = int(os.environ.get("UPSTREAM_THREAD_WORKERS", "64"))
+# Timeout (seconds) for upstream LiteLLM calls
+REQUEST_TIMEOUT = float(os.environ.get("REQUEST_TIMEOUT", "600"))
+
+# OpenAI-compatible targets get tool calls and results as native assistant tool_calls
+# and role "tool" messages instead of flattened text (routes opt in or out with
+# "native_tool_calls")
+OPENAI_NATIVE_TOOL_CALLS = os.environ.get("OPENAI_NATIVE_TOOL_CALLS", "false").lower() in ("1", "true", "yes")
+
+# Opt-in compaction of old tool results before they are sent upstream (routes opt in or
+# out with "tool_result_compaction"): results in the last TOOL_RESULT_KEEP_TURNS user
+# turns are sent as they are; older ones are cut to TOOL_RESULT_MAX_TOKENS (head and
+# tail kept; routes set "tool_result_max_tokens"), repeats of an earlier result are
+# replaced by a reference to it, and results older than TOOL_RESULT_STALE_TURNS turns
+# by a marker (0 keeps them)
+TOOL_RESULT_COMPACTION = os.environ.get("TOOL_RESULT_COMPACTION", "false").lower() in ("1", "true", "yes")
+TOOL_RESULT_MAX_TOKENS = int(os.environ.get("TOOL_RESULT_MAX_TOKENS", "2000"))
+TOOL_RESULT_KEEP_TURNS = int(os.environ.get("TOOL_RESULT_KEEP_TURNS", "4"))
+TOOL_RESULT_STALE_TURNS = int(os.environ.get("TOOL_RESULT_STALE_TURNS", "0"))
+
+# Images are sent upstream as image_url parts, which LiteLLM turns into each provider's
+# own image format (routes opt out with "image_input"; their images become a text
+# placeholder). Images larger than IMAGE_MAX_DIMENSION pixels on their long side or
+# IMAGE_MAX_BYTES are downscaled first with Pillow (routes set "image_max_dimension" and
+# "image_max_bytes", 0 disables a limit). The last IMAGE_CACHE_SIZE distinct images are
+# kept prepared for later turns (0 disables)
+IMAGE_INPUT = os.environ.get("IMAGE_INPUT", "true").lower() in ("1", "true", "yes")
+IMAGE_MAX_DIMENSION = int(os.environ.get("IMAGE_MAX_DIMENSION", "1568"))
+IMAGE_MAX_BYTES = int(os.environ.get("IMAGE_MAX_BYTES", str(1024 * 1024)))
+IMAGE_CACHE_SIZE = int(os.environ.get("IMAGE_CACHE_SIZE", "64"))
+# Image limits of routes without their own, None when images are not sent
+IMAGE_LIMITS = (IMAGE_MAX_DIMENSION, IMAGE_MAX_BYTES) if IMAGE_INPUT else None
+
+# Number of translated messages kept for reuse across turns (0 disables the cache)
+TRANSLATION_CACHE_SIZE = int(os.environ.get("TRANSLATION_CACHE_SIZE", "4096"))
+# Number of distinct translated tool lists kept (0 disables the cache)
+TOOL_CACHE_SIZE = int(os.environ.get("TOOL_CACHE_SIZE", "64"))
+
+# Opt-in coalescing of streamed text/tool-input deltas: fragments for the same content
+# block are merged for up to SSE_COALESCE_WINDOW_MS or SSE_COALESCE_MAX_BYTES (0 disables)
+SSE_COALESCE_WINDOW_MS = float(os.environ.get("SSE_COALESCE_WINDOW_MS", "0"))
+SSE_COALESCE_MAX_BYTES = int(os.environ.get("SSE_COALESCE_MAX_BYTES", "512"))
+
+# Token counting caches: per-message counts and whole count_tokens requests (0 disables)
+TOKEN_COUNT_CACHE_SIZE = int(os.environ.get("TOKEN_COUNT_CACHE_SIZE", "16384"))
+TOKEN_COUNT_REQUEST_CACHE_SIZE = int(os.environ.get("TOKEN_COUNT_REQUEST_CACHE_SIZE", "1024"))
+
+# Tokenizer engine: worker processes for large token counting jobs (0 keeps all counting
+# on the event loop) and the job size, in characters, below which counting stays inline
+TOKENIZER_PROCESS_WORKERS = int(os.environ.get("TOKENIZER_PROCESS_WORKERS", "2"))
+TOKENIZER_INLINE_MAX_CHARS = int(os.environ.get("TOKENIZER_INLINE_MAX_CHARS", "20000"))
+
+# Streaming pump: per-stream caps on translated events buffered ahead of the client,
+# and the idle time after which a keep-alive ping is sent
+STREAM_QUEUE_MAX_EVENTS = int(os.environ.get("STREAM_QUEUE_MAX_EVENTS", "1024"))
+STREAM_QUEUE_MAX_BYTES = int(os.environ.get("STREAM_QUEUE_MAX_BYTES", str(4 * 1024 * 1024)))
+SSE_PING_INTERVAL = float(os.environ.get("SSE_PING_INTERVAL", "30"))
+
+# Upstream connection pools, one long-lived HTTP client per OpenAI-compatible api_base:
+# connection limits, idle keep-alive time in seconds (0 opens a connection per request)
+# and HTTP/2 (needs the h2 package)
+UPSTREAM_POOLS = os.environ.get("UPSTREAM_POOLS", "true").lower() in ("1", "true", "yes")
+UPSTREAM_MAX_CONNECTIONS = int(os.environ.get("UPSTREAM_MAX_CONNECTIONS", "100"))
+UPSTREAM_MAX_KEEPALIVE_CONNECTIONS = int(os.environ.get("UPSTREAM_MAX_KEEPALIVE_CONNECTIONS", "20"))
+UPSTREAM_KEEPALIVE_EXPIRY = float(os.environ.get("UPSTREAM_KEEPALIVE_EXPIRY", "120"))
+UPSTREAM_HTTP2 = os.environ.get("UPSTREAM_HTTP2", "false").lower() in ("1", "true", "yes")
+
+# Response cache for deterministic (temperature 0) requests: memory entries (0 disables),
+# optional directory for the disk tier, entry lifetime in seconds and disk size cap in MB
+RESPONSE_CACHE_SIZE = int(os.environ.get("RESPONSE_CACHE_SIZE", "0"))
+RESPONSE_CACHE_DIR = os.environ.get("RESPONSE_CACHE_DIR")
+RESPONSE_CACHE_TTL = float(os.environ.get("RESPONSE_CACHE_TTL", "3600"))
+RESPONSE_CACHE_MAX_DISK_MB = float(os.environ.get("RESPONSE_CACHE_MAX_DISK_MB", "256"))
+
+# Load balancing over the api_bases of a route (OPENAI_API_BASE may list several, comma
+# separated): EWMA smoothing of time to first token and error rate, consecutive failures
+# after which a base is ejected, and the seconds it then stays out of rotation
+UPSTREAM_EWMA_ALPHA = float(os.environ.get("UPSTREAM_EWMA_ALPHA", "0.3"))
+UPSTREAM_EJECT_FAILURES = int(os.environ.get("UPSTREAM_EJECT_FAILURES", "3"))
+UPSTREAM_EJECT_SECONDS = float(os.environ.get("UPSTREAM_EJECT_SECONDS", "30"))
+
+# Hedging of streaming calls that are slow to produce a first chunk: on for every route
+# (routes opt in or out with "hedge"), the delay in seconds before the duplicate call
+# (0 uses the route's observed p95 time to first token) and the share of requests hedged
+UPSTREAM_HEDGING = os.environ.get("UPSTREAM_HEDGING", "false").lower() in ("1", "true", "yes")
+UPSTREAM_HEDGE_DELAY = float(os.environ.get("UPSTREAM_HEDGE_DELAY", "0"))
+UPSTREAM_HEDGE_BUDGET = float(os.environ.get("UPSTREAM_HEDGE_BUDGET", "0.05"))
+
+# Fallback chains ("fallbacks" in the routing file) and per-target circuit breakers:
+# consecutive failures that open a target's circuit (0 disables the breakers), seconds
+# before a trial call is let through again, and how long a target that has a fallback
+# after it gets to produce its first chunk (or whole response) before the next one is
+# tried (0 waits for REQUEST_TIMEOUT)
+CIRCUIT_FAILURE_THRESHOLD = int(os.environ.get("CIRCUIT_FAILURE_THRESHOLD", "5"))
+CIRCUIT_OPEN_SECONDS = float(os.environ.get("CIRCUIT_OPEN_SECONDS", "30"))
+FALLBACK_TIMEOUT = float(os.environ.get("FALLBACK_TIMEOUT", "0"))
+
+# Retries of upstream calls failing with 429, 5xx or a connection error: attempts after
+# the first, the base and cap in seconds of the jittered exponential backoff (a longer
+# Retry-After is not waited for; the error goes on to the fallbacks or the client) and
+# the share of requests that may be retried
+UPSTREAM_RETRIES = int(os.environ.get("UPSTREAM_RETRIES", "2"))
+UPSTREAM_RETRY_BASE_DELAY = float(os.environ.get("UPSTREAM_RETRY_BASE_DELAY", "0.5"))
+UPSTREAM_RETRY_MAX_DELAY = float(os.environ.get("UPSTREAM_RETRY_MAX_DELAY", "10"))
+UPSTREAM_RETRY_BUDGET = float(os.environ.get("UPSTREAM_RETRY_BUDGET", "0.1"))
+
+# Upstream concurrency limits per mapped model and api_base: requests in flight (0 disables
+# limiting), requests allowed to wait for a slot, the longest wait in seconds (0 waits
+# without deadline) and the status (529 or 429) of the overloaded_error for shed requests
+UPSTREAM_MAX_INFLIGHT = int(os.environ.get("UPSTREAM_MAX_INFLIGHT", "0"))
+UPSTREAM_QUEUE_SIZE = int(os.environ.get("UPSTREAM_QUEUE_SIZE", "64"))
+UPSTREAM_QUEUE_TIMEOUT = float(os.environ.get("UPSTREAM_QUEUE_TIMEOUT", "30"))
+UPSTREAM_OVERLOAD_STATUS = int(os.environ.get("UPSTREAM_OVERLOAD_STATUS", "529"))
+
+# Identical deterministic requests arriving while one is already in flight share its
+# upstream call (streams are fanned out to every client)
+SINGLE_FLIGHT = os.environ.get("SINGLE_FLIGHT", "false").lower() in ("1", "true", "yes")
+
+# Optional JSON routing file extending the built-in model mapping (see README)
+ROUTES_FILE = os.environ.get("ROUTES_FILE")
+# Seconds between checks of ROUTES_FILE for changes (0 disables hot reload)
+ROUTES_RELOAD_INTERVAL = float(os.environ.get("ROUTES_RELOAD_INTERVAL", "5"))
+
+if UPSTREAM_CALL_MODE not in ("async", "thread"):
+    logger.warning(f"⚠️ Unknown UPSTREAM_CALL_MODE '{UPSTREAM_CALL_MODE}', falling back to 'async'")
+    UPSTREAM_CALL_MODE = "async"
+
 # Get model mapping configuration from environment
 # Default to latest OpenAI models if not set
 BIG_MODEL = os.environ.get("BIG_MODEL", "gpt-4.1")
@@ -130,60 +288,319 @@ ANTHROPIC_MODELS = [
     "claude-instant-1.2"
 ]
 
+PROVIDER_PREFIXES = ("anthropic/", "openai/", "gemini/")
+
+def strip_provider_prefix(model: str) -> str:
+    """Remove a leading anthropic/, openai/ or gemini/ prefix from a model name."""
+    for prefix in PROVIDER_PREFIXES:
+        if model.startswith(prefix):
+            return model[len(prefix):]
+    return model
+
+class UpstreamBase(BaseModel):
+    """One of several api_bases serving a route, with its relative share of traffic."""
+    url: str
+    weight: float = Field(default=1.0, gt=0)
+
+def parse_api_bases(value: Any) -> List[UpstreamBase]:
+    """api_bases from a comma separated string or a list of URLs and {"url", "weight"} objects."""
+    if isinstance(value, str):
+        value = [part.strip() for part in value.split(",") if part.strip()]
+    return [UpstreamBase(url=item) if isinstance(item, str) else UpstreamBase(**item) for item in value or []]
+
+def api_base_fields(bases: List[UpstreamBase]) -> Dict[str, Any]:
+    """Route fields for a list of bases: api_bases is only set when there is a choice."""
+    return {"api_base": bases[0].url if bases else None, "api_bases": bases if len(bases) > 1 else None}
+
+class Route(BaseModel):
+    """Where a mapped model is sent upstream, and with which credentials."""
+    model: str
+    provider: str  # "openai", "gemini", "anthropic" or "default" for unprefixed models
+    api_key: Optional[str] = Field(default=None, repr=False)
+    api_base: Optional[str] = None
+    # Several deployments serving the route; one is picked per request into api_base
+    api_bases: Optional[List[UpstreamBase]] = None
+    custom_llm_provider: Optional[str] = None
+    # Per-route concurrency limits, UPSTREAM_MAX_INFLIGHT/QUEUE_SIZE/QUEUE_TIMEOUT when unset
+    max_inflight: Optional[int] = None
+    queue_size: Optional[int] = None
+    queue_timeout: Optional[float] = None
+    # Per-route hedging, UPSTREAM_HEDGING/UPSTREAM_HEDGE_DELAY when unset
+    hedge: Optional[bool] = None
+    hedge_delay: Optional[float] = None
+    # Mapped models tried in order when this one fails before answering
+    fallbacks: Optional[List[str]] = None
+    # Native tool_calls / role "tool" messages for OpenAI targets, OPENAI_NATIVE_TOOL_CALLS when unset
+    native_tool_calls: Optional[bool] = None
+    # Compaction of old tool results, TOOL_RESULT_COMPACTION/TOOL_RESULT_MAX_TOKENS when unset
+    tool_result_compaction: Optional[bool] = None
+    tool_result_max_tokens: Optional[int] = None
+    # Images sent upstream and their size limits, IMAGE_INPUT/IMAGE_MAX_DIMENSION/IMAGE_MAX_BYTES when unset
+    image_input: Optional[bool] = None
+    image_max_dimension: Optional[int] = None
+    image_max_bytes: Optional[int] = None
+
+    def litellm_params(self) -> Dict[str, Any]:
+        """Provider and credential arguments for a litellm completion call."""
+        params = {"api_key": self.api_key}
+        if self.api_base:
+            params["api_base"] = self.api_base
+        if self.custom_llm_provider:
+            params["custom_llm_provider"] = self.custom_llm_provider
+        return params
+
+class RouteTable:
+    """Model routing indexes built once from the model lists and the routing file.
+    
+    Every distinct incoming model string is resolved once and memoized; a table is
+    never modified after construction apart from its memo.
+    """
+    MEMO_LIMIT = 4096  # Incoming model names are client controlled, keep the memo bounded
+    
+    def __init__(self, openai_models: List[str], gemini_models: List[str], anthropic_models: List[str],
+                 big_model: str, small_model: str, preferred_provider: str,
+                 aliases: Optional[Dict[str, str]] = None,
+                 route_overrides: Optional[Dict[str, Dict[str, Any]]] = None):
+        self.openai_models = frozenset(openai_models)
+        self.gemini_models = frozenset(gemini_models)
+        self.anthropic_models = frozenset(anthropic_models)
+        self.preferred_provider = preferred_provider
+        self.aliases = dict(aliases or {})
+        self.route_overrides = dict(route_overrides or {})
+        # Parsed up front so an invalid api_bases entry fails the (re)load, not a request
+        self.openai_bases = api_base_fields(parse_api_bases(OPENAI_API_BASE))
+        self.route_bases = {
+            model: api_base_fields(parse_api_bases(overrides["api_bases"]))
+            for model, overrides in self.route_overrides.items() if "api_bases" in overrides
+        }
+        # Haiku requests go to SMALL_MODEL and Sonnet requests to BIG_MODEL
+        self.small_target = self._prefixed_target(small_model)
+        self.big_target = self._prefixed_target(big_model)
+        self._memo: Dict[str, Route] = {}
+    
+    def _prefixed_target(self, model: str) -> str:
+        """Add the provider prefix to BIG_MODEL/SMALL_MODEL based on provider preference."""
+        model_clean = strip_provider_prefix(model)
+        if self.preferred_provider == "google" and model_clean in self.gemini_models:
+            # Use the model as-is if it already has prefix, otherwise add gemini/
+            return model if model.startswith('gemini/') else f"gemini/{model}"
+        elif model_clean in self.anthropic_models:
+            return model if model.startswith('anthropic/') else f"anthropic/{model}"
+        # Default to openai/ (the LiteLLM proxy)
+        return model if model.startswith('openai/') else f"openai/{model}"
+    
+    def map_model(self, model: str) -> str:
+        """Map an incoming model name to the model name passed to LiteLLM."""
+        if model in self.aliases:
+            return self.aliases[model]
+        
+        clean_model = strip_provider_prefix(model)
+        lowered = clean_model.lower()
+        if 'haiku' in lowered:
+            return self.small_target
+        if 'sonnet' in lowered:
+            return self.big_target
+        
+        # Add prefixes to non-mapped models if they match known lists
+        if clean_model in self.anthropic_models and not model.startswith('anthropic/'):
+            return f"anthropic/{clean_model}"
+        if clean_model in self.gemini_models and not model.startswith('gemini/'):
+            return f"gemini/{clean_model}"
+        if clean_model in self.openai_models and not model.startswith('openai/'):
+            return f"openai/{clean_model}"
+        
+        if not model.startswith(PROVIDER_PREFIXES):
+            logger.warning(f"⚠️ No prefix or mapping rule for model: '{model}'. Using as is.")
+        return model
+    
+    def build_route(self, model: str) -> Route:
+        """Determine provider and credentials for a mapped model."""
+        if model.startswith("openai/"):
+            route = Route(model=model, provider="openai", api_key=OPENAI_API_KEY, **self.openai_bases)
+        elif model.startswith("gemini/"):
+            route = Route(model=model, provider="gemini", api_key=GEMINI_API_KEY)
+        elif model.startswith("anthropic/"):
+            # Anthropic models are routed through the LiteLLM proxy with OpenAI credentials,
+            # forcing the openai provider so litellm uses OpenAI-compatible endpoints
+            route = Route(model=model, provider="anthropic", api_key=OPENAI_API_KEY,
+                          custom_llm_provider="openai", **self.openai_bases)
+        else:
+            route = Route(model=model, provider="default", api_key=ANTHROPIC_API_KEY)
+        
+        overrides = self.route_overrides.get(model)
+        if overrides:
+            update = {
+                key: overrides[key]
+                for key in ("api_base", "api_key", "custom_llm_provider", "max_inflight", "queue_size", "queue_timeout",
+                            "hedge", "hedge_delay", "fallbacks", "native_tool_calls",
+                            "tool_result_compaction", "tool_result_max_tokens",
+                            "image_input", "image_max_dimension", "image_max_bytes")
+                if key in overrides
+            }
+            if "api_bases" in overrides:
+                update.update(self.route_bases[model])
+            elif "api_base" in overrides:
+                update["api_bases"] = None
+            if "api_key_env" in overrides:
+                update["api_key"] = os.environ.get(overrides["api_key_env"])
+            route = route.model_copy(update=update)
+        return route
+    
+    def resolve(self, model: str) -> Route:
+        """Resolve an incoming model name to its route, memoized per distinct name."""
+        route = self._memo.get(model)
+        if route is None:
+            if len(self._memo) >= self.MEMO_LIMIT:
+                self._memo.clear()
+            route = self.build_route(self.map_model(model))
+            self._memo[model] = route
+        return route
+
+class ModelRouter:
+    """Resolves incoming model names to routes, hot reloading ROUTES_FILE when it changes.
+    
+    Reloading builds a complete new RouteTable and swaps it in with a single
+    assignment, so in-flight lookups always see either the old or the new table.
+    """
+    def __init__(self, routes_file: Optional[str] = None, reload_interval: float = 0.0):
+        self.routes_file = routes_file
+        self.reload_interval = reload_interval
+        self._routes_mtime: Optional[float] = None
+        self._next_check = time.monotonic() + reload_interval
+        self._table = self._build_table(self._load_routes_file())
+    
+    def _load_routes_file(self) -> Dict[str, Any]:
+        if not self.routes_file:
+            return {}
+        self._routes_mtime = os.path.getmtime(self.routes_file)
+        with open(self.routes_file) as f:
+            config = json.load(f)
+        if not isinstance(config, dict):
+            raise ValueError(f"Routing file {self.routes_file} must contain a JSON object")
+        return config
+    
+    def _build_table(self, config: Dict[str, Any]) -> RouteTable:
+        extra_models = config.get("models", {})
+        return RouteTable(
+            openai_models=OPENAI_MODELS + extra_models.get("openai", []),
+            gemini_models=GEMINI_MODELS + extra_models.get("gemini", []),
+            anthropic_models=ANTHROPIC_MODELS + extra_models.get("anthropic", []),
+            big_model=config.get("big_model", BIG_MODEL),
+            small_model=config.get("small_model", SMALL_MODEL),
+            preferred_provider=PREFERRED_PROVIDER,
+            aliases=config.get("aliases"),
+            route_overrides=config.get("routes"),
+        )
+    
+    @property
+    def default_models(self) -> List[str]:
+        """Mapped BIG_MODEL and SMALL_MODEL, the models most requests end up on."""
+        table = self._table
+        return list(dict.fromkeys([table.big_target, table.small_target]))
+    
+    def reload(self) -> bool:
+        """Rebuild the route table from the routing file. Keeps the current table on errors."""
+        try:
+            table = self._build_table(self._load_routes_file())
+        except Exception as e:
+            logger.error(f"Failed to reload routes from {self.routes_file}: {e}")
+            return False
+        self._table = table
+        logger.info(f"🔀 Reloaded model routes from {self.routes_file}")
+        return True
+    
+    def _check_for_changes(self):
+        self._next_check = time.monotonic() + self.reload_interval
+        try:
+            mtime = os.path.getmtime(self.routes_file)
+        except OSError as e:
+            logger.error(f"Cannot stat routing file {self.routes_file}: {e}")
+            return
+        if mtime != self._routes_mtime:
+            self.reload()
+    
+    def route_for(self, model: str) -> Route:
+        """Route of an already mapped model (a fallback target), skipping aliases and name mapping."""
+        return self._table.build_route(model)
+    
+    def resolve(self, model: str) -> Route:
+        """Resolve an incoming model name to its mapped model, provider and credentials."""
+        if self.routes_file and self.reload_interval > 0 and time.monotonic() >= self._next_check:
+            self._check_for_changes()
+        return self._table.resolve(model)
+
+model_router = ModelRouter(ROUTES_FILE, ROUTES_RELOAD_INTERVAL)
+
 # Helper function to clean schema for Gemini
 def clean_gemini_schema(schema: Any) -> Any:
-    """Recursively removes unsupported fields from a JSON schema for Gemini."""
+    """Recursively removes unsupported fields from a JSON schema for Gemini.
+
+    Returns a cleaned copy, the input schema is left untouched.
+    """
     if isinstance(schema, dict):
-        # Remove specific keys unsupported by Gemini tool parameters
-        schema.pop("additionalProperties", None)
-        schema.pop("default", None)
+        cleaned = {}
+        for key, value in schema.items():
+            # Remove specific keys unsupported by Gemini tool parameters
+            if key in ("additionalProperties", "default"):
+                continue
+            # Recursively clean nested schemas (properties, items, etc.)
+            cleaned[key] = clean_gemini_schema(value)
 
         # Check for unsupported 'format' in string types
-        if schema.get("type") == "string" and "format" in schema:
+        if cleaned.get("type") == "string" and "format" in cleaned:
             allowed_formats = {"enum", "date-time"}
-            if schema["format"] not in allowed_formats:
-                schema.pop("format")
-
-        # Recursively clean nested schemas (properties, items, etc.)
-        for key, value in list(schema.items()): # Use list() to allow modification during iteration
-            schema[key] = clean_gemini_schema(value)
+            if cleaned["format"] not in allowed_formats:
+                cleaned.pop("format")
+        return cleaned
     elif isinstance(schema, list):
         # Recursively clean items in a list
         return [clean_gemini_schema(item) for item in schema]
     return schema
 
 # Models for Anthropic API requests
+# cache_control marks a prompt cache breakpoint; it is only read from requests and
+# never written back in responses
 class ContentBlockText(BaseModel):
     type: Literal["text"]
     text: str
+    cache_control: Optional[Dict[str, Any]] = Field(default=None, exclude=True)
 
 class ContentBlockImage(BaseModel):
     type: Literal["image"]
     source: Dict[str, Any]
+    cache_control: Optional[Dict[str, Any]] = Field(default=None, exclude=True)
 
 class ContentBlockToolUse(BaseModel):
     type: Literal["tool_use"]
     id: str
     name: str
     input: Dict[str, Any]
+    cache_control: Optional[Dict[str, Any]] = Field(default=None, exclude=True)
 
 class ContentBlockToolResult(BaseModel):
     type: Literal["tool_result"]
     tool_use_id: str
     content: Union[str, List[Dict[str, Any]], Dict[str, Any], List[Any], Any]
+    cache_control: Optional[Dict[str, Any]] = Field(default=None, exclude=True)
 
 class SystemContent(BaseModel):
     type: Literal["text"]
     text: str
+    cache_control: Optional[Dict[str, Any]] = None
+
+# Tagged on "type", so a block is validated against its own model only instead of each in turn
+ContentBlock = Annotated[Union[ContentBlockText, ContentBlockImage, ContentBlockToolUse, ContentBlockToolResult],
+                         Field(discriminator="type")]
 
 class Message(BaseModel):
     role: Literal["user", "assistant"] 
-    content: Union[str, List[Union[ContentBlockText, ContentBlockImage, ContentBlockToolUse, ContentBlockToolResult]]]
+    content: Union[str, List[ContentBlock]]
 
 class Tool(BaseModel):
     name: str
     description: Optional[str] = None
     input_schema: Dict[str, Any]
+    cache_control: Optional[Dict[str, Any]] = None
 
 class ThinkingConfig(BaseModel):
     enabled: bool
@@ -203,85 +620,21 @@ class MessagesRequest(BaseModel):
     tool_choice: Optional[Dict[str, Any]] = None
     thinking: Optional[ThinkingConfig] = None
     original_model: Optional[str] = None  # Will store the original model name
+    _route: Optional[Route] = PrivateAttr(default=None)
+    _client_messages: Optional[List[Message]] = PrivateAttr(default=None)  # As sent by the client, once compacted
     
-    @model_validator(mode='before')
-    def preserve_original_model(cls, values):
-        """Preserve the original model name before any mapping occurs"""
-        if isinstance(values, dict) and 'model' in values:
-            values['original_model'] = values['model']
-        return values
-    
-    @field_validator('model')
-    def validate_model_field(cls, v, info): # Renamed to avoid conflict
-        original_model = v
-        new_model = v # Default to original value
-
-
-        # Remove provider prefixes for easier matching
-        clean_v = v
-        if clean_v.startswith('anthropic/'):
-            clean_v = clean_v[10:]
-        elif clean_v.startswith('openai/'):
-            clean_v = clean_v[7:]
-        elif clean_v.startswith('gemini/'):
-            clean_v = clean_v[7:]
-
-        # --- Mapping Logic --- START ---
-        mapped = False
-        # Map Haiku to SMALL_MODEL based on provider preference
-        if 'haiku' in clean_v.lower():
-            # Check what type of model SMALL_MODEL is (with or without prefix)
-            small_model_clean = SMALL_MODEL.replace('gemini/', '').replace('openai/', '').replace('anthropic/', '')
-            if PREFERRED_PROVIDER == "google" and small_model_clean in GEMINI_MODELS:
-                # Use SMALL_MODEL as-is if it already has prefix, otherwise add gemini/
-                new_model = SMALL_MODEL if SMALL_MODEL.startswith('gemini/') else f"gemini/{SMALL_MODEL}"
-                mapped = True
-            elif small_model_clean in ANTHROPIC_MODELS:
-                # Use SMALL_MODEL as-is if it already has prefix, otherwise add anthropic/
-                new_model = SMALL_MODEL if SMALL_MODEL.startswith('anthropic/') else f"anthropic/{SMALL_MODEL}"
-                mapped = True
-            else:
-                # Use SMALL_MODEL as-is if it already has prefix, otherwise add openai/
-                new_model = SMALL_MODEL if SMALL_MODEL.startswith('openai/') else f"openai/{SMALL_MODEL}"
-                mapped = True
-
-        # Map Sonnet to BIG_MODEL based on provider preference
-        elif 'sonnet' in clean_v.lower():
-            # Check what type of model BIG_MODEL is (with or without prefix)
-            big_model_clean = BIG_MODEL.replace('gemini/', '').replace('openai/', '').replace('anthropic/', '')
-            if PREFERRED_PROVIDER == "google" and big_model_clean in GEMINI_MODELS:
-                # Use BIG_MODEL as-is if it already has prefix, otherwise add gemini/
-                new_model = BIG_MODEL if BIG_MODEL.startswith('gemini/') else f"gemini/{BIG_MODEL}"
-                mapped = True
-            elif big_model_clean in ANTHROPIC_MODELS:
-                # Use BIG_MODEL as-is if it already has prefix, otherwise add anthropic/
-                new_model = BIG_MODEL if BIG_MODEL.startswith('anthropic/') else f"anthropic/{BIG_MODEL}"
-                mapped = True
-            else:
-                # Use BIG_MODEL as-is if it already has prefix, otherwise add openai/
-                new_model = BIG_MODEL if BIG_MODEL.startswith('openai/') else f"openai/{BIG_MODEL}"
-                mapped = True
-
-        # Add prefixes to non-mapped models if they match known lists
-        elif not mapped:
-            if clean_v in ANTHROPIC_MODELS and not v.startswith('anthropic/'):
-                new_model = f"anthropic/{clean_v}"
-                mapped = True # Technically mapped to add prefix
-            elif clean_v in GEMINI_MODELS and not v.startswith('gemini/'):
-                new_model = f"gemini/{clean_v}"
-                mapped = True # Technically mapped to add prefix
-            elif clean_v in OPENAI_MODELS and not v.startswith('openai/'):
-                new_model = f"openai/{clean_v}"
-                mapped = True # Technically mapped to add prefix
-        # --- Mapping Logic --- END ---
-
-        if not mapped:
-             # If no mapping occurred and no prefix exists, log warning or decide default
-             if not v.startswith(('openai/', 'gemini/', 'anthropic/')):
-                 logger.warning(f"⚠️ No prefix or mapping rule for model: '{original_model}'. Using as is.")
-             new_model = v # Ensure we return the original if no rule applied
-
-        return new_model
+    @model_validator(mode='after')
+    def validate_model_field(self):
+        """Map the requested model to its upstream route, keeping the name the client sent"""
+        self.original_model = self.model
+        self._route = model_router.resolve(self.model)
+        self.model = self._route.model
+        return self
+    
+    @property
+    def route(self) -> Route:
+        """Upstream route (provider, api_base, credentials) resolved for this request"""
+        return self._route
 
 class TokenCountRequest(BaseModel):
     model: str
@@ -291,92 +644,20 @@ class TokenCountRequest(BaseModel):
     thinking: Optional[ThinkingConfig] = None
     tool_choice: Optional[Dict[str, Any]] = None
     original_model: Optional[str] = None  # Will store the original model name
+    _route: Optional[Route] = PrivateAttr(default=None)
     
-    @model_validator(mode='before')
-    def preserve_original_model(cls, values):
-        """Preserve the original model name before any mapping occurs"""
-        if isinstance(values, dict) and 'model' in values:
-            values['original_model'] = values['model']
-        return values
-    
-    @field_validator('model')
-    def validate_model_token_count(cls, v, info): # Renamed to avoid conflict
-        # Use the same logic as MessagesRequest validator
-        # NOTE: Pydantic validators might not share state easily if not class methods
-        # Re-implementing the logic here for clarity, could be refactored
-        original_model = v
-        new_model = v # Default to original value
-
-
-        # Remove provider prefixes for easier matching
-        clean_v = v
-        if clean_v.startswith('anthropic/'):
-            clean_v = clean_v[10:]
-        elif clean_v.startswith('openai/'):
-            clean_v = clean_v[7:]
-        elif clean_v.startswith('gemini/'):
-            clean_v = clean_v[7:]
-
-        # --- Mapping Logic --- START ---
-        mapped = False
-        # Map Haiku to SMALL_MODEL based on provider preference
-        if 'haiku' in clean_v.lower():
-            # Check what type of model SMALL_MODEL is (with or without prefix)
-            small_model_clean = SMALL_MODEL.replace('gemini/', '').replace('openai/', '').replace('anthropic/', '')
-            if PREFERRED_PROVIDER == "google" and small_model_clean in GEMINI_MODELS:
-                # Use SMALL_MODEL as-is if it already has prefix, otherwise add gemini/
-                new_model = SMALL_MODEL if SMALL_MODEL.startswith('gemini/') else f"gemini/{SMALL_MODEL}"
-                mapped = True
-            elif small_model_clean in ANTHROPIC_MODELS:
-                # Use SMALL_MODEL as-is if it already has prefix, otherwise add anthropic/
-                new_model = SMALL_MODEL if SMALL_MODEL.startswith('anthropic/') else f"anthropic/{SMALL_MODEL}"
-                mapped = True
-            else:
-                # Use SMALL_MODEL as-is if it already has prefix, otherwise add openai/
-                new_model = SMALL_MODEL if SMALL_MODEL.startswith('openai/') else f"openai/{SMALL_MODEL}"
-                mapped = True
-
-        # Map Sonnet to BIG_MODEL based on provider preference
-        elif 'sonnet' in clean_v.lower():
-            # Check what type of model BIG_MODEL is (with or without prefix)
-            big_model_clean = BIG_MODEL.replace('gemini/', '').replace('openai/', '').replace('anthropic/', '')
-            if PREFERRED_PROVIDER == "google" and big_model_clean in GEMINI_MODELS:
-                # Use BIG_MODEL as-is if it already has prefix, otherwise add gemini/
-                new_model = BIG_MODEL if BIG_MODEL.startswith('gemini/') else f"gemini/{BIG_MODEL}"
-                mapped = True
-            elif big_model_clean in ANTHROPIC_MODELS:
-                # Use BIG_MODEL as-is if it already has prefix, otherwise add anthropic/
-                new_model = BIG_MODEL if BIG_MODEL.startswith('anthropic/') else f"anthropic/{BIG_MODEL}"
-                mapped = True
-            else:
-                # Use BIG_MODEL as-is if it already has prefix, otherwise add openai/
-                new_model = BIG_MODEL if BIG_MODEL.startswith('openai/') else f"openai/{BIG_MODEL}"
-                mapped = True
-
-        # Add prefixes to non-mapped models if they match known lists
-        elif not mapped:
-            if clean_v in ANTHROPIC_MODELS and not v.startswith('anthropic/'):
-                new_model = f"anthropic/{clean_v}"
-                mapped = True # Technically mapped to add prefix
-            elif clean_v in GEMINI_MODELS and not v.startswith('gemini/'):
-                new_model = f"gemini/{clean_v}"
-                mapped = True # Technically mapped to add prefix
-            elif clean_v in OPENAI_MODELS and not v.startswith('openai/'):
-                new_model = f"openai/{clean_v}"
-                mapped = True # Technically mapped to add prefix
-        # --- Mapping Logic --- END ---
-
-        if not mapped:
-             if not v.startswith(('openai/', 'gemini/', 'anthropic/')):
-                 logger.warning(f"⚠️ No prefix or mapping rule for token count model: '{original_model}'. Using as is.")
-             new_model = v # Ensure we return the original if no rule applied
-
-        # Store the original model in the values dictionary
-        values = info.data
-        if isinstance(values, dict):
-            values['original_model'] = original_model
-
-        return new_model
+    @model_validator(mode='after')
+    def validate_model_token_count(self):
+        """Map the requested model to its upstream route, keeping the name the client sent"""
+        self.original_model = self.model
+        self._route = model_router.resolve(self.model)
+        self.model = self._route.model
+        return self
+    
+    @property
+    def route(self) -> Route:
+        """Upstream route (provider, api_base, credentials) resolved for this request"""
+        return self._route
 
 class TokenCountResponse(BaseModel):
     input_tokens: int
@@ -397,19 +678,307 @@ class MessagesResponse(BaseModel):
     stop_sequence: Optional[str] = None
     usage: Usage
 
+def escape_label_value(value: Any) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def format_labels(names: tuple, values: tuple, extra: str = "") -> str:
+    pairs = [f'{name}="{escape_label_value(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+class Metric:
+    """A Prometheus metric family; series are keyed by a tuple of label values.
+    
+    Label values come partly from clients (model names), so the number of series is
+    capped; anything beyond MAX_SERIES is folded into one "_other" series.
+    """
+    TYPE = "untyped"
+    MAX_SERIES = 1000
+    
+    def __init__(self, name: str, help_text: str, labelnames: tuple = ()):
+        self.name = name
+        self.help = help_text
+        self.labelnames = labelnames
+        self.series: Dict[tuple, Any] = {}
+        self._overflow = ("_other",) * len(labelnames)
+    
+    def _key(self, labels: tuple) -> tuple:
+        if labels in self.series or len(self.series) < self.MAX_SERIES:
+            return labels
+        return self._overflow
+    
+    def samples(self) -> List[str]:
+        return [f"{self.name}{format_labels(self.labelnames, labels)} {value}" for labels, value in self.series.items()]
+    
+    def render(self) -> List[str]:
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.TYPE}"] + self.samples()
+
+class Counter(Metric):
+    TYPE = "counter"
+    
+    def inc(self, labels: tuple = (), amount: float = 1):
+        key = self._key(labels)
+        self.series[key] = self.series.get(key, 0) + amount
+
+class Gauge(Metric):
+    TYPE = "gauge"
+    
+    def inc(self, labels: tuple = (), amount: float = 1):
+        key = self._key(labels)
+        self.series[key] = self.series.get(key, 0) + amount
+    
+    def dec(self, labels: tuple = (), amount: float = 1):
+        self.inc(labels, -amount)
+    
+    def set(self, labels: tuple, value: float):
+        self.series[self._key(labels)] = value
+
+class Histogram(Metric):
+    """Histogram with fixed upper bounds; observe() is a bisect and three increments."""
+    TYPE = "histogram"
+    
+    def __init__(self, name: str, help_text: str, labelnames: tuple, buckets: tuple):
+        super().__init__(name, help_text, labelnames)
+        self.buckets = tuple(sorted(buckets))
+    
+    def observe(self, labels: tuple, value: float):
+        key = self._key(labels)
+        data = self.series.get(key)
+        if data is None:
+            # Per-bucket (non-cumulative) counts, the last one is +Inf; then sum and count
+            data = self.series[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+        data[0][bisect.bisect_left(self.buckets, value)] += 1
+        data[1] += value
+        data[2] += 1
+    
+    def samples(self) -> List[str]:
+        lines = []
+        for labels, (counts, total, count) in self.series.items():
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += bucket_count
+                le = "+Inf" if bound == float("inf") else repr(float(bound))
+                bucket_labels = format_labels(self.labelnames, labels, f'le="{le}"')
+                lines.append(f"{self.name}_bucket{bucket_labels} {cumulative}")
+            lines.append(f"{self.name}_sum{format_labels(self.labelnames, labels)} {total}")
+            lines.append(f"{self.name}_count{format_labels(self.labelnames, labels)} {count}")
+        return lines
+
+class MetricsRegistry:
+    """Metrics recorded on the request path, plus collectors read only at scrape time."""
+    def __init__(self):
+        self.metrics: List[Metric] = []
+        self.collectors: List[Any] = []  # Callables returning freshly built metrics
+    
+    def register(self, metric: Metric) -> Metric:
+        self.metrics.append(metric)
+        return metric
+    
+    def render(self) -> str:
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        for collector in self.collectors:
+            for metric in collector():
+                lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+metrics = MetricsRegistry()
+REQUESTS = metrics.register(Counter(
+    "proxy_requests_total", "HTTP requests by route, requested model, mapped model and status.",
+    ("route", "original_model", "mapped_model", "status")))
+REQUEST_LATENCY = metrics.register(Histogram(
+    "proxy_request_duration_seconds", "Time from request to the end of the response body, streams included.",
+    ("route", "mapped_model", "status"),
+    (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)))
+UPSTREAM_TTFT = metrics.register(Histogram(
+    "proxy_upstream_time_to_first_token_seconds", "Time from the upstream call to its first streamed chunk.",
+    ("mapped_model", "provider"),
+    (0.05, 0.1, 0.25, 0.5, 0.75, 1, 1.5, 2, 3, 5, 10, 30)))
+STREAM_CHUNK_GAP = metrics.register(Histogram(
+    "proxy_upstream_chunk_gap_seconds", "Time between consecutive upstream stream chunks.",
+    ("mapped_model", "provider"),
+    (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5)))
+TRANSLATION_TIME = metrics.register(Histogram(
+    "proxy_translation_seconds", "Time spent translating requests to and responses from LiteLLM.",
+    ("direction", "mapped_model"),
+    (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25)))
+TOOL_RESULT_TOKENS_SAVED = metrics.register(Counter(
+    "proxy_tool_result_tokens_saved_total", "Estimated prompt tokens removed by tool result compaction, by how.",
+    ("mapped_model", "action")))
+IMAGES_DOWNSCALED = metrics.register(Counter(
+    "proxy_images_downscaled_total", "Distinct images downscaled before being sent upstream."))
+IMAGE_BYTES_SAVED = metrics.register(Counter(
+    "proxy_image_bytes_saved_total", "Bytes removed from distinct images by downscaling."))
+STREAM_TOOL_ARGUMENTS_INVALID = metrics.register(Counter(
+    "proxy_stream_tool_arguments_invalid_total", "Streamed tool calls whose arguments were not a JSON object when their block closed.",
+    ("mapped_model",)))
+OUTPUT_TOKENS_PER_SECOND = metrics.register(Histogram(
+    "proxy_output_tokens_per_second", "Upstream output tokens per second (streams: from the first chunk, otherwise the whole call).",
+    ("mapped_model", "provider"),
+    (5, 10, 20, 30, 50, 75, 100, 150, 200, 300, 500, 1000)))
+INFLIGHT_STREAMS = metrics.register(Gauge(
+    "proxy_inflight_upstream_streams", "Upstream streams currently open.",
+    ("mapped_model", "provider")))
+UPSTREAM_QUEUE_WAIT = metrics.register(Histogram(
+    "proxy_upstream_queue_wait_seconds", "Time requests waited for an upstream concurrency slot.",
+    ("mapped_model", "api_base"),
+    (0.001, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)))
+UPSTREAM_HEDGES = metrics.register(Counter(
+    "proxy_upstream_hedges_total", "Hedged streaming calls by which call delivered the first chunk (primary, hedge or none).",
+    ("mapped_model", "winner")))
+UPSTREAM_HEDGE_BUDGET_EXHAUSTED = metrics.register(Counter(
+    "proxy_upstream_hedge_budget_exhausted_total", "Slow streaming calls not hedged because the hedge budget was spent.",
+    ("mapped_model",)))
+UPSTREAM_FALLBACKS = metrics.register(Counter(
+    "proxy_upstream_fallbacks_total", "Requests passed on from a target to the next one in its fallback chain.",
+    ("from_model", "to_model", "reason")))
+UPSTREAM_RETRY_ATTEMPTS = metrics.register(Counter(
+    "proxy_upstream_retries_total", "Upstream calls retried, by the status that failed them.",
+    ("mapped_model", "status")))
+UPSTREAM_RETRY_BUDGET_EXHAUSTED = metrics.register(Counter(
+    "proxy_upstream_retry_budget_exhausted_total", "Failed upstream calls not retried because the retry budget was spent.",
+    ("mapped_model",)))
+UPSTREAM_SHED = metrics.register(Counter(
+    "proxy_upstream_shed_total", "Requests answered with overloaded_error instead of calling upstream.",
+    ("mapped_model", "api_base", "reason")))
+
+async def observe_response_body(body_iterator, route: str, raw_request: Request, status: int, start: float):
+    """Pass a response body through, recording request metrics when it ends."""
+    try:
+        async for chunk in body_iterator:
+            yield chunk
+    finally:
+        original_model, mapped_model = getattr(raw_request.state, "models", ("", ""))
+        REQUESTS.inc((route, original_model, mapped_model, status))
+        REQUEST_LATENCY.observe((route, mapped_model, status), time.perf_counter() - start)
+
+def call_once(func):
+    """Wrap func so that only the first call goes through."""
+    called = False
+    def wrapper(*args, **kwargs):
+        nonlocal called
+        if not called:
+            called = True
+            func(*args, **kwargs)
+    return wrapper
+
+async def open_upstream_stream(litellm_request: Dict[str, Any], route: Route):
+    """Start a streaming LiteLLM completion, wrapped for the upstream stream metrics.
+    
+    The route's concurrency slot is held until the stream is closed; the load balancer
+    learns the time to first token, or the failure, of the chosen api_base.
+    """
+    slot = await upstream_limiters.acquire(route)
+    start = time.perf_counter()
+    upstream_balancer.start(route)
+    settle = call_once(functools.partial(upstream_balancer.finish, route))
+    try:
+        response_generator = await litellm.acompletion(**litellm_request)
+    except BaseException as e:
+        if isinstance(e, asyncio.CancelledError):
+            # Abandoned (e.g. a lost hedge): the first token would have taken at least this long
+            settle(ttft=time.perf_counter() - start)
+        else:
+            settle(failed=is_upstream_failure(e))
+        if slot is not None:
+            slot.release()
+        raise
+    stream = observe_upstream_stream(response_generator, route, start, slot, settle)
+    # A stream that is dropped without ever being iterated never runs its finally block
+    weakref.finalize(stream, settle)
+    if slot is not None:
+        weakref.finalize(stream, slot.release)
+    return stream
+
+async def observe_upstream_stream(response_generator, route: Route, start: float, slot=None, settle=None):
+    """Pass upstream stream chunks through, recording TTFT, chunk gaps and token throughput."""
+    labels = (route.model, route.provider)
+    INFLIGHT_STREAMS.inc(labels)
+    first = last = None
+    output_tokens = 0
+    try:
+        async for chunk in response_generator:
+            now = time.perf_counter()
+            if first is None:
+                first = now
+                UPSTREAM_TTFT.observe(labels, now - start)
+                stream_hedger.observe(route.model, now - start)
+                if settle is not None:
+                    settle(ttft=now - start)
+            else:
+                STREAM_CHUNK_GAP.observe(labels, now - last)
+            last = now
+            usage = getattr(chunk, "usage", None)
+            if usage is not None and getattr(usage, "completion_tokens", None):
+                output_tokens = usage.completion_tokens
+            yield chunk
+        if output_tokens and last > first:
+            OUTPUT_TOKENS_PER_SECOND.observe(labels, output_tokens / (last - first))
+    except asyncio.CancelledError:
+        if settle is not None and first is None:
+            settle(ttft=time.perf_counter() - start)
+        raise
+    except Exception as e:
+        if settle is not None:
+            settle(failed=is_upstream_failure(e))
+        raise
+    finally:
+        INFLIGHT_STREAMS.dec(labels)
+        if settle is not None:
+            settle()
+        if slot is not None:
+            slot.release()
+        aclose = getattr(response_generator, "aclose", None)
+        if aclose is not None:
+            await aclose()
+
 @app.middleware("http")
 async def log_requests(request: Request, call_next):
     # Get request details
     method = request.method
     path = request.url.path
+    start = time.perf_counter()
     
     # Log only basic request details at debug level
     
     # Process the request and get the response
     response = await call_next(request)
     
+    # Request metrics are recorded once the body (possibly a long stream) has been sent
+    response.body_iterator = observe_response_body(response.body_iterator, path, request, response.status_code, start)
     return response
 
+def request_body_openapi(model_cls: type) -> Dict[str, Any]:
+    """OpenAPI request body description for endpoints that parse their body themselves."""
+    return {
+        "requestBody": {
+            "content": {"application/json": {"schema": model_cls.model_json_schema()}},
+            "required": True,
+        }
+    }
+
+async def parse_request_body(raw_request: Request, model_cls: type):
+    """Decode and validate a JSON request body in one pass.
+
+    pydantic-core parses the raw bytes straight into the model, so there is no
+    intermediate dict tree and no second json.loads of multi-megabyte conversations.
+    This holds as long as the models have no mode='before' validators, which need that tree.
+    """
+    body = await raw_request.body()
+    try:
+        request = model_cls.model_validate_json(body)
+    except ValidationError as e:
+        # Same 422 response FastAPI produces for invalid bodies
+        errors = e.errors(include_url=False)
+        for error in errors:
+            error["loc"] = ("body",) + tuple(error["loc"])
+        raise RequestValidationError(errors, body=body)
+    # Model labels for the request metrics
+    raw_request.state.models = (request.original_model or request.model, request.model)
+    return request
+
 # Not using validation function as we're using the environment API key
 
 def parse_tool_result_content(content):
@@ -425,6 +994,9 @@ def parse_tool_result_content(content):
         for item in content:
             if isinstance(item, dict) and item.get("type") == "text":
                 result += item.get("text", "") + "\n"
+            elif isinstance(item, dict) and item.get("type") == "image":
+                # The image itself is sent separately, see convert_message_to_openai_tools
+                result += "[Image]\n"
             elif isinstance(item, str):
                 result += item + "\n"
             elif isinstance(item, dict):
@@ -456,137 +1028,1679 @@ def parse_tool_result_content(content):
     except:
         return "Unparseable content"
 
-def convert_anthropic_to_litellm(anthropic_request: MessagesRequest) -> Dict[str, Any]:
-    """Convert Anthropic API request format to LiteLLM format (which follows OpenAI)."""
+CHARS_PER_TOKEN = 4  # Token estimate of tool result compaction; deterministic, unlike a tokenizer call
+
+def truncate_middle(text: str, max_chars: int) -> str:
+    """Keep the head and tail of text within about max_chars, cutting at line breaks where possible."""
+    if len(text) <= max_chars:
+        return text
+    half = max_chars // 2
+    head = text[:half]
+    tail = text[len(text) - half:]
+    # Prefer whole lines unless that throws away most of the kept part
+    cut = head.rfind("\n")
+    if cut > half // 2:
+        head = head[:cut]
+    cut = tail.find("\n")
+    if 0 <= cut < half // 2:
+        tail = tail[cut + 1:]
+    omitted = len(text) - len(head) - len(tail)
+    return f"{head}\n[... {omitted} characters omitted by the proxy ...]\n{tail}"
+
+def compact_tool_results(messages: List[Message], max_tokens: int, keep_turns: int,
+                         stale_turns: int = 0) -> tuple:
+    """Shrink old tool results; returns (messages, {action: estimated tokens saved}).
+
+    Only results that are plain text and outside the last keep_turns user turns are
+    touched. Each one is replaced by a marker once older than stale_turns (if set), by
+    a reference to an earlier identical result, or cut to max_tokens. The outcome for a
+    result depends only on its content and its age, so a compacted conversation prefix
+    stays the same from turn to turn and upstream prompt caches keep matching.
+    """
+    saved: Dict[str, int] = {}
+    user_turns = sum(1 for msg in messages if msg.role == "user")
+    first_seen: Dict[str, str] = {}  # Text of a result -> tool_use_id of its first occurrence
+    compacted = []
+    turn = 0
+    for msg in messages:
+        if msg.role == "user":
+            turn += 1
+        age = user_turns - turn  # Later user turns
+        if msg.role != "user" or isinstance(msg.content, str) or age < keep_turns:
+            compacted.append(msg)
+            continue
+        blocks = []
+        changed = False
+        for block in msg.content:
+            content = block.content if block.type == "tool_result" else None
+            if not (isinstance(content, str) or (
+                    isinstance(content, list) and all(isinstance(item, dict) and item.get("type") == "text" for item in content))):
+                blocks.append(block)
+                continue
+            text = parse_tool_result_content(content)
+            first_id = first_seen.setdefault(text, block.tool_use_id)
+            if stale_turns and age >= stale_turns:
+                action, new_text = "stale", f"[Old tool result of {len(text)} characters omitted by the proxy]"
+            elif first_id != block.tool_use_id:
+                action, new_text = "dedupe", f"[Same output as the tool result for {first_id}]"
+            else:
+                action, new_text = "truncate", truncate_middle(text, max_tokens * CHARS_PER_TOKEN)
+            if len(new_text) >= len(text):
+                blocks.append(block)
+                continue
+            saved[action] = saved.get(action, 0) + (len(text) - len(new_text)) // CHARS_PER_TOKEN
+            # Validated once already; constructing directly is several times cheaper than copying
+            blocks.append(ContentBlockToolResult.model_construct(
+                type="tool_result", tool_use_id=block.tool_use_id, content=new_text, cache_control=block.cache_control))
+            changed = True
+        compacted.append(Message.model_construct(role=msg.role, content=blocks) if changed else msg)
+    return compacted, saved
+
+_upstream_executor: Optional[ThreadPoolExecutor] = None
+
+def get_upstream_executor() -> ThreadPoolExecutor:
+    """Lazily create the thread pool used when UPSTREAM_CALL_MODE is "thread"."""
+    global _upstream_executor
+    if _upstream_executor is None:
+        _upstream_executor = ThreadPoolExecutor(
+            max_workers=UPSTREAM_THREAD_WORKERS,
+            thread_name_prefix="litellm-upstream"
+        )
+    return _upstream_executor
+
+async def call_litellm_completion(litellm_request: Dict[str, Any]):
+    """Run a non-streaming LiteLLM completion without blocking the event loop."""
+    if UPSTREAM_CALL_MODE == "thread":
+        # Offload the synchronous client to a bounded pool of worker threads
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            get_upstream_executor(),
+            functools.partial(litellm.completion, **litellm_request)
+        )
+    # Default: native async client, the event loop stays free while we wait
+    return await litellm.acompletion(**litellm_request)
+
+class DrainingResponseStream(httpx.AsyncByteStream):
+    """Response body that reads the small remainder of a body before closing it.
+    
+    SDK stream readers stop at the SSE [DONE] marker and close the response before
+    the end of the body arrives, which makes HTTP/1.1 drop the connection. Reading
+    the last few bytes first lets the connection go back to the pool.
+    """
+    DRAIN_TIMEOUT = 0.05
+    DRAIN_MAX_BYTES = 64 * 1024
+    
+    def __init__(self, stream: httpx.AsyncByteStream, on_close=None):
+        self._stream = stream
+        self._on_close = on_close
+        self._iterator = None
+        self._finished = False
+    
+    async def __aiter__(self):
+        self._iterator = self._stream.__aiter__()
+        async for chunk in self._iterator:
+            yield chunk
+        self._finished = True
+    
+    async def _drain(self):
+        drained = 0
+        async for chunk in self._iterator:
+            drained += len(chunk)
+            if drained > self.DRAIN_MAX_BYTES:
+                return
+        self._finished = True
+    
+    async def aclose(self):
+        if self._iterator is not None and not self._finished:
+            try:
+                await asyncio.wait_for(self._drain(), self.DRAIN_TIMEOUT)
+            except (asyncio.TimeoutError, httpx.HTTPError, OSError):
+                pass
+            except Exception as e:
+                logger.debug(f"Could not drain upstream response: {e}")
+        on_close, self._on_close = self._on_close, None
+        if on_close is not None:
+            on_close()
+        await self._stream.aclose()
+
+class DrainingTransport(httpx.AsyncBaseTransport):
+    """Transport wrapper that gives every response a DrainingResponseStream body.
+    
+    It also counts the responses still open, i.e. the connections in use.
+    """
+    def __init__(self, transport: httpx.AsyncBaseTransport):
+        self.transport = transport
+        self.open_responses = 0
+    
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        response = await self.transport.handle_async_request(request)
+        self.open_responses += 1
+        return httpx.Response(
+            status_code=response.status_code,
+            headers=response.headers,
+            stream=DrainingResponseStream(response.stream, self._response_closed),
+            extensions=response.extensions
+        )
+    
+    def _response_closed(self):
+        self.open_responses -= 1
+    
+    async def aclose(self):
+        await self.transport.aclose()
+
+class UpstreamPool:
+    """A long-lived async HTTP client for one upstream base URL, with connection counters.
+    
+    Both HTTP versions go through httpx's transport (HTTP/2 needs the h2 package), so
+    every connection limit applies and new connections are seen through its trace
+    extension.
+    """
+    def __init__(self, api_base: str, limits: httpx.Limits, http2: bool, timeout: float):
+        self.api_base = api_base
+        self.limits = limits
+        self.requests = 0
+        self.new_connections = 0
+        try:
+            self.httpx_transport = httpx.AsyncHTTPTransport(limits=limits, http2=http2)
+        except ImportError:
+            logger.warning("⚠️ UPSTREAM_HTTP2 needs the h2 package (pip install httpx[http2]), using HTTP/1.1")
+            self.httpx_transport = httpx.AsyncHTTPTransport(limits=limits)
+        self.transport = DrainingTransport(self.httpx_transport)
+        self.http_client = httpx.AsyncClient(
+            transport=self.transport,
+            timeout=timeout,
+            event_hooks={"request": [self._on_request]}
+        )
+        self._openai_clients: Dict[str, Any] = {}
+    
+    async def _on_request(self, request: httpx.Request):
+        self.requests += 1
+        request.extensions["trace"] = self._trace
+    
+    async def _trace(self, event_name: str, info: Dict[str, Any]):
+        if event_name == "connection.connect_tcp.complete":
+            self.new_connections += 1
+    
+    def openai_client(self, api_key: str):
+        """AsyncOpenAI client for this base URL and key, sharing the pool's connections."""
+        client = self._openai_clients.get(api_key)
+        if client is None:
+            from openai import AsyncOpenAI
+            # Retries are made by call_with_retries, under its budget
+            client = AsyncOpenAI(api_key=api_key, base_url=self.api_base, http_client=self.http_client, max_retries=0)
+            self._openai_clients[api_key] = client
+        return client
+    
+    def occupancy(self) -> tuple:
+        """(active, idle) connections.
+        
+        Read from httpcore's connection list, which httpx does not expose publicly;
+        without it, active is the number of responses still open and idle reads as 0.
+        """
+        connections = getattr(getattr(self.httpx_transport, "_pool", None), "connections", None)
+        if connections is None:
+            return self.transport.open_responses, 0
+        idle = sum(1 for connection in connections if connection.is_idle())
+        return len(connections) - idle, idle
+    
+    def stats(self) -> Dict[str, Any]:
+        active, idle = self.occupancy()
+        return {
+            "connections": active + idle,
+            "active_connections": active,
+            "idle_connections": idle,
+            "requests": self.requests,
+            "new_connections": self.new_connections,
+            "reuse_ratio": round(1 - self.new_connections / self.requests, 4) if self.requests else 0.0,
+        }
+
+class UpstreamPools:
+    """Shared connection pools per upstream base URL, handed to LiteLLM as clients.
+    
+    Only OpenAI-compatible routes (the openai provider, including Anthropic models sent
+    through a LiteLLM proxy) use these pools; other providers keep LiteLLM's own clients.
+    """
+    DEFAULT_OPENAI_BASE = "https://api.openai.com/v1"
+    
+    def __init__(self, enabled: bool, limits: httpx.Limits, http2: bool, timeout: float):
+        self.enabled = enabled
+        self.limits = limits
+        self.http2 = http2
+        self.timeout = timeout
+        self.pools: Dict[str, UpstreamPool] = {}
+    
+    def client_for(self, route: Route):
+        """Pooled AsyncOpenAI client for a route, or None to let LiteLLM pick its own."""
+        if not self.enabled or not route.api_key:
+            return None
+        if route.provider != "openai" and route.custom_llm_provider != "openai":
+            return None
+        api_base = (route.api_base or self.DEFAULT_OPENAI_BASE).rstrip("/")
+        pool = self.pools.get(api_base)
+        if pool is None:
+            pool = UpstreamPool(api_base, self.limits, self.http2, self.timeout)
+            self.pools[api_base] = pool
+        return pool.openai_client(route.api_key)
+    
+    async def aclose(self):
+        pools, self.pools = self.pools, {}
+        for pool in pools.values():
+            await pool.http_client.aclose()
+    
+    def stats(self) -> Dict[str, Any]:
+        return {api_base: pool.stats() for api_base, pool in self.pools.items()}
+
+upstream_pools = UpstreamPools(
+    UPSTREAM_POOLS,
+    httpx.Limits(
+        max_connections=UPSTREAM_MAX_CONNECTIONS,
+        max_keepalive_connections=UPSTREAM_MAX_KEEPALIVE_CONNECTIONS,
+        keepalive_expiry=UPSTREAM_KEEPALIVE_EXPIRY
+    ),
+    UPSTREAM_HTTP2,
+    REQUEST_TIMEOUT
+)
+
+class UpstreamOverloaded(Exception):
+    """A request was shed because its upstream is at its concurrency limit."""
+    def __init__(self, message: str, reason: str):
+        super().__init__(message)
+        self.reason = reason  # "queue_full" or "queue_timeout"
+
+def overloaded_response(error: UpstreamOverloaded) -> JSONResponse:
+    """Anthropic-style overloaded_error returned instead of queueing a request further."""
+    return JSONResponse(
+        status_code=UPSTREAM_OVERLOAD_STATUS,
+        content={"type": "error", "error": {"type": "overloaded_error", "message": str(error)}}
+    )
+
+class ConcurrencySlot:
+    """An in-flight slot held by one upstream call; release() may be called more than once."""
+    def __init__(self, limiter: "ConcurrencyLimiter"):
+        self._limiter = limiter
+    
+    def release(self):
+        limiter, self._limiter = self._limiter, None
+        if limiter is not None:
+            limiter._release()
+
+class ConcurrencyLimiter:
+    """Caps upstream calls in flight, with a bounded FIFO queue and a deadline for waiters.
+    
+    A released slot is handed straight to the oldest waiter, so queued requests are
+    never overtaken by new arrivals.
+    """
+    def __init__(self, labels: tuple, max_inflight: int, queue_size: int, queue_timeout: float):
+        self.labels = labels  # (mapped_model, api_base)
+        self.max_inflight = max_inflight
+        self.queue_size = queue_size
+        self.queue_timeout = queue_timeout
+        self.in_flight = 0
+        self.waiters: "deque[asyncio.Future]" = deque()
+    
+    async def acquire(self) -> ConcurrencySlot:
+        if self.in_flight < self.max_inflight and not self.waiters:
+            self.in_flight += 1
+            UPSTREAM_QUEUE_WAIT.observe(self.labels, 0.0)
+            return ConcurrencySlot(self)
+        if len(self.waiters) >= self.queue_size:
+            UPSTREAM_SHED.inc(self.labels + ("queue_full",))
+            raise UpstreamOverloaded(
+                f"{self.labels[0]} is overloaded: {self.in_flight} requests in flight and {len(self.waiters)} queued",
+                "queue_full"
+            )
+        
+        waiter = asyncio.get_running_loop().create_future()
+        self.waiters.append(waiter)
+        start = time.perf_counter()
+        try:
+            await asyncio.wait_for(waiter, self.queue_timeout if self.queue_timeout > 0 else None)
+        except (asyncio.TimeoutError, asyncio.CancelledError) as e:
+            if waiter.done() and not waiter.cancelled():
+                # The slot was handed over just as the wait ended, pass it on
+                self._release()
+            if isinstance(e, asyncio.CancelledError):
+                raise
+            UPSTREAM_SHED.inc(self.labels + ("queue_timeout",))
+            raise UpstreamOverloaded(
+                f"{self.labels[0]} is overloaded: no upstream slot within {self.queue_timeout:g}s",
+                "queue_timeout"
+            ) from None
+        finally:
+            try:
+                self.waiters.remove(waiter)
+            except ValueError:
+                pass
+            UPSTREAM_QUEUE_WAIT.observe(self.labels, time.perf_counter() - start)
+        return ConcurrencySlot(self)
+    
+    def _release(self):
+        while self.waiters:
+            waiter = self.waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)  # The slot moves to the waiter, in_flight is unchanged
+                return
+        self.in_flight -= 1
+    
+    def stats(self) -> Dict[str, Any]:
+        return {"in_flight": self.in_flight, "queued": len(self.waiters), "max_inflight": self.max_inflight}
+
+class UpstreamLimiters:
+    """One ConcurrencyLimiter per mapped model and api_base, created on first use.
+    
+    Limits come from the route (routing file) or the UPSTREAM_* defaults and are
+    re-read on every acquire, so a reloaded routing file applies to new requests.
+    """
+    def __init__(self, max_inflight: int, queue_size: int, queue_timeout: float):
+        self.max_inflight = max_inflight
+        self.queue_size = queue_size
+        self.queue_timeout = queue_timeout
+        self.limiters: Dict[tuple, ConcurrencyLimiter] = {}
+    
+    def limiter_for(self, route: Route) -> Optional[ConcurrencyLimiter]:
+        max_inflight = route.max_inflight if route.max_inflight is not None else self.max_inflight
+        queue_size = route.queue_size if route.queue_size is not None else self.queue_size
+        queue_timeout = route.queue_timeout if route.queue_timeout is not None else self.queue_timeout
+        if max_inflight <= 0:
+            return None
+        labels = (route.model, route.api_base or route.provider)
+        limiter = self.limiters.get(labels)
+        if limiter is None:
+            limiter = self.limiters[labels] = ConcurrencyLimiter(labels, max_inflight, queue_size, queue_timeout)
+        limiter.max_inflight, limiter.queue_size, limiter.queue_timeout = max_inflight, queue_size, queue_timeout
+        return limiter
+    
+    async def acquire(self, route: Route) -> Optional[ConcurrencySlot]:
+        """Wait for an upstream slot for route; None when the route is not limited."""
+        limiter = self.limiter_for(route)
+        if limiter is None:
+            return None
+        return await limiter.acquire()
+    
+    def stats(self) -> Dict[tuple, Dict[str, Any]]:
+        return {labels: limiter.stats() for labels, limiter in self.limiters.items()}
+
+upstream_limiters = UpstreamLimiters(UPSTREAM_MAX_INFLIGHT, UPSTREAM_QUEUE_SIZE, UPSTREAM_QUEUE_TIMEOUT)
+
+def is_upstream_failure(error: BaseException) -> bool:
+    """Whether an upstream error reflects on the deployment rather than on the request itself."""
+    if isinstance(error, asyncio.CancelledError):
+        return False
+    status = getattr(error, "status_code", None)
+    return not (isinstance(status, int) and 400 <= status < 500 and status not in (408, 429))
+
+class UpstreamBaseHealth:
+    """Observed behavior of one api_base."""
+    def __init__(self):
+        self.ewma_ttft: Optional[float] = None  # Seconds to the first token (whole call when not streaming)
+        self.ewma_errors = 0.0
+        self.in_flight = 0  # Calls still waiting for their first token
+        self.consecutive_failures = 0
+        self.ejected_until = 0.0
+        self.picks = 0
+        self.ejections = 0
+
+class UpstreamBalancer:
+    """Picks one of a route's weighted api_bases per request, by power of two choices.
+    
+    Two candidates are drawn by weight from the bases that are not ejected and the
+    cheaper one wins. Cost is the EWMA time to first token, times the calls already
+    waiting on that base plus one, inflated by the recent error rate and divided by
+    the weight. A base that fails eject_failures times in a row is skipped for
+    eject_seconds.
+    """
+    ERROR_PENALTY = 10  # Cost multiplier at a 100% error rate
+    MIN_TTFT = 0.001  # Keeps in-flight counts meaningful before any latency is known
+    
+    def __init__(self, alpha: float, eject_failures: int, eject_seconds: float):
+        self.alpha = alpha
+        self.eject_failures = eject_failures
+        self.eject_seconds = eject_seconds
+        self.bases: Dict[str, UpstreamBaseHealth] = {}
+        self.rng = random.Random()
+    
+    def health(self, url: str) -> UpstreamBaseHealth:
+        health = self.bases.get(url)
+        if health is None:
+            health = self.bases[url] = UpstreamBaseHealth()
+        return health
+    
+    def cost(self, base: UpstreamBase) -> float:
+        health = self.health(base.url)
+        ttft = health.ewma_ttft
+        if ttft is None:
+            # A base without observations is assumed to be as fast as the others
+            observed = [h.ewma_ttft for h in self.bases.values() if h.ewma_ttft is not None]
+            ttft = sum(observed) / len(observed) if observed else 0.0
+        return (max(ttft, self.MIN_TTFT) * (health.in_flight + 1)
+                * (1 + self.ERROR_PENALTY * health.ewma_errors) / base.weight)
+    
+    def pick(self, route: Route, exclude: tuple = ()) -> Optional[str]:
+        """URL of the api_base for the next call on route, None if every base is excluded."""
+        candidates = [base for base in route.api_bases if base.url not in exclude]
+        if not candidates:
+            return None
+        now = time.monotonic()
+        healthy = [base for base in candidates if self.health(base.url).ejected_until <= now]
+        if not healthy:
+            # Everything is ejected: try the base that comes back first rather than failing outright
+            healthy = [min(candidates, key=lambda base: self.health(base.url).ejected_until)]
+        choice = self.rng.choices(healthy, weights=[base.weight for base in healthy])[0]
+        if len(healthy) > 1:
+            rest = [base for base in healthy if base is not choice]
+            other = self.rng.choices(rest, weights=[base.weight for base in rest])[0]
+            choice = min(choice, other, key=self.cost)
+        self.health(choice.url).picks += 1
+        return choice.url
+    
+    def start(self, route: Route):
+        """Count a call on the route's chosen base as waiting for its first token."""
+        if route.api_bases:
+            self.health(route.api_base).in_flight += 1
+    
+    def finish(self, route: Route, ttft: Optional[float] = None, failed: bool = False):
+        """Record the outcome of a call started with start(); ttft None means no token arrived."""
+        if not route.api_bases:
+            return
+        health = self.health(route.api_base)
+        health.in_flight -= 1
+        if ttft is None and not failed:
+            return  # Closed early by the client, nothing learned about the base
+        health.ewma_errors += self.alpha * ((1.0 if failed else 0.0) - health.ewma_errors)
+        if not failed:
+            health.consecutive_failures = 0
+            health.ewma_ttft = ttft if health.ewma_ttft is None else health.ewma_ttft + self.alpha * (ttft - health.ewma_ttft)
+            return
+        health.consecutive_failures += 1
+        now = time.monotonic()
+        if health.consecutive_failures >= self.eject_failures and health.ejected_until <= now:
+            health.ejected_until = now + self.eject_seconds
+            health.ejections += 1
+            logger.warning(f"⏏️ Ejected {route.api_base} for {self.eject_seconds:g}s after {health.consecutive_failures} consecutive failures")
+    
+    def stats(self) -> Dict[str, Dict[str, Any]]:
+        now = time.monotonic()
+        return {
+            url: {
+                "ewma_ttft": health.ewma_ttft,
+                "error_rate": round(health.ewma_errors, 4),
+                "in_flight": health.in_flight,
+                "ejected": health.ejected_until > now,
+                "picks": health.picks,
+                "ejections": health.ejections,
+            }
+            for url, health in self.bases.items()
+        }
+
+upstream_balancer = UpstreamBalancer(UPSTREAM_EWMA_ALPHA, UPSTREAM_EJECT_FAILURES, UPSTREAM_EJECT_SECONDS)
+
+class RequestBudget:
+    """Token bucket allowing extra upstream calls for a fixed share of requests.
+    
+    Every request deposits ratio tokens, up to burst; an extra call spends a whole one.
+    The bucket starts full, so the first few slow calls after startup can be helped.
+    """
+    def __init__(self, ratio: float, burst: float = 10.0):
+        self.ratio = ratio
+        self.burst = burst
+        self.tokens = burst
+    
+    def deposit(self):
+        self.tokens = min(self.burst, self.tokens + self.ratio)
+    
+    def withdraw(self) -> bool:
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+async def open_first_chunk(litellm_request: Dict[str, Any], route: Route) -> tuple:
+    """Open an upstream stream and wait for its first chunk; returns (stream, [first chunk] or [])."""
+    return await read_first_chunk(await open_upstream_stream(litellm_request, route))
+
+async def read_first_chunk(stream) -> tuple:
+    """Wait for the first chunk of stream; returns (stream, [first chunk] or []), closing it on errors."""
+    try:
+        return stream, [await stream.__anext__()]
+    except StopAsyncIteration:
+        return stream, []
+    except BaseException:
+        await stream.aclose()
+        raise
+
+async def resume_stream(stream, head: List[Any]):
+    """Yield the chunks already read from stream, then the rest of it."""
+    try:
+        for chunk in head:
+            yield chunk
+        async for chunk in stream:
+            yield chunk
+    finally:
+        await stream.aclose()
+
+def discard_first_chunk_task(task: asyncio.Task):
+    """Cancel a losing open_first_chunk task, closing its stream if it opened anyway."""
+    def close(task: asyncio.Task):
+        if not task.cancelled() and task.exception() is None:
+            asyncio.ensure_future(task.result()[0].aclose())
+    task.cancel()
+    task.add_done_callback(close)
+
+class StreamHedger:
+    """Sends a duplicate streaming call when the first one is slow to produce a chunk.
+    
+    After the hedge delay (fixed, or the p95 of recent times to first token of the
+    mapped model) a second call goes to another of the route's api_bases, or the same
+    base when there is only one. Whichever delivers a first chunk first is streamed to
+    the client and the other is cancelled. Hedges are capped by a RequestBudget.
+    """
+    WINDOW = 200  # Recent times to first token kept per mapped model
+    MIN_SAMPLES = 20  # Below this, an observed p95 is not trusted
+    
+    def __init__(self, enabled: bool, delay: float, budget_ratio: float):
+        self.enabled = enabled
+        self.delay = delay
+        self.budget = RequestBudget(budget_ratio)
+        self.ttfts: Dict[str, deque] = {}
+    
+    def observe(self, model: str, ttft: float):
+        window = self.ttfts.get(model)
+        if window is None:
+            window = self.ttfts[model] = deque(maxlen=self.WINDOW)
+        window.append(ttft)
+    
+    def hedge_delay(self, route: Route) -> Optional[float]:
+        """Seconds to wait before hedging a call on route, None when it is not hedged."""
+        if not (route.hedge if route.hedge is not None else self.enabled):
+            return None
+        delay = route.hedge_delay if route.hedge_delay is not None else self.delay
+        if delay > 0:
+            return delay
+        window = self.ttfts.get(route.model)
+        if window is None or len(window) < self.MIN_SAMPLES:
+            return None
+        ordered = sorted(window)
+        return ordered[int(0.95 * (len(ordered) - 1))]
+    
+    def hedge_target(self, litellm_request: Dict[str, Any], route: Route) -> tuple:
+        """The (request, route) for the duplicate call, on another api_base when there is one."""
+        if route.api_bases:
+            api_base = upstream_balancer.pick(route, exclude=(route.api_base,))
+            if api_base is not None:
+                route = route.model_copy(update={"api_base": api_base})
+                litellm_request = dict(litellm_request, **route.litellm_params())
+                if "client" in litellm_request:
+                    client = upstream_pools.client_for(route)
+                    if client is not None:
+                        litellm_request["client"] = client
+                    else:
+                        del litellm_request["client"]
+        return litellm_request, route
+    
+    async def open(self, litellm_request: Dict[str, Any], route: Route):
+        """Open a streaming completion, hedged when the route asks for it."""
+        delay = self.hedge_delay(route)
+        if delay is None:
+            return await open_upstream_stream(litellm_request, route)
+        
+        self.budget.deposit()
+        primary = asyncio.create_task(open_first_chunk(litellm_request, route))
+        tasks = [primary]
+        try:
+            done, _ = await asyncio.wait(tasks, timeout=delay)
+            if not done and not self.budget.withdraw():
+                UPSTREAM_HEDGE_BUDGET_EXHAUSTED.inc((route.model,))
+                await asyncio.wait(tasks)
+            if primary.done():
+                tasks.remove(primary)
+                return resume_stream(*primary.result())
+            
+            hedge_request, hedge_route = self.hedge_target(litellm_request, route)
+            logger.debug(f"🪁 Hedging {route.model} after {delay:.2f}s without a first chunk ({hedge_route.api_base})")
+            tasks.append(asyncio.create_task(open_first_chunk(hedge_request, hedge_route)))
+            pending = set(tasks)
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                winner = next((task for task in tasks if task in done and task.exception() is None), None)
+                if winner is not None:
+                    UPSTREAM_HEDGES.inc((route.model, "primary" if winner is primary else "hedge"))
+                    tasks.remove(winner)
+                    return resume_stream(*winner.result())
+            UPSTREAM_HEDGES.inc((route.model, "none"))
+            tasks.remove(primary)
+            return resume_stream(*primary.result())  # Both failed: raise the primary's error
+        finally:
+            # Losers, or everything if the caller went away
+            for task in tasks:
+                discard_first_chunk_task(task)
+
+stream_hedger = StreamHedger(UPSTREAM_HEDGING, UPSTREAM_HEDGE_DELAY, UPSTREAM_HEDGE_BUDGET)
+
+class CircuitBreaker:
+    """Consecutive-failure circuit breaker for one upstream target.
+    
+    Opens after failure_threshold failures in a row. While open, calls are refused
+    except for one trial call every open_seconds; the trial's outcome closes the
+    circuit again or keeps it open.
+    """
+    def __init__(self, failure_threshold: int, open_seconds: float):
+        self.failure_threshold = failure_threshold
+        self.open_seconds = open_seconds
+        self.failures = 0
+        self.is_open = False
+        self.retry_at = 0.0
+        self.openings = 0
+    
+    def allow(self) -> bool:
+        if not self.is_open:
+            return True
+        now = time.monotonic()
+        if now < self.retry_at:
+            return False
+        self.retry_at = now + self.open_seconds  # One trial call per period
+        return True
+    
+    def record(self, ok: bool, target: str = ""):
+        if ok:
+            if self.is_open:
+                logger.info(f"🔌 Circuit for {target} closed again")
+            self.failures = 0
+            self.is_open = False
+            return
+        self.failures += 1
+        if self.failure_threshold > 0 and self.failures >= self.failure_threshold:
+            if not self.is_open:
+                self.openings += 1
+                logger.warning(f"🔌 Circuit for {target} opened after {self.failures} consecutive failures")
+            self.is_open = True
+            self.retry_at = time.monotonic() + self.open_seconds
+
+class CircuitBreakers:
+    """One CircuitBreaker per mapped model, created on first use."""
+    def __init__(self, failure_threshold: int, open_seconds: float):
+        self.failure_threshold = failure_threshold
+        self.open_seconds = open_seconds
+        self.breakers: Dict[str, CircuitBreaker] = {}
+    
+    def get(self, model: str) -> CircuitBreaker:
+        breaker = self.breakers.get(model)
+        if breaker is None:
+            breaker = self.breakers[model] = CircuitBreaker(self.failure_threshold, self.open_seconds)
+        return breaker
+    
+    def stats(self) -> Dict[str, Dict[str, Any]]:
+        return {
+            model: {"open": breaker.is_open, "failures": breaker.failures, "openings": breaker.openings}
+            for model, breaker in self.breakers.items()
+        }
+
+circuit_breakers = CircuitBreakers(CIRCUIT_FAILURE_THRESHOLD, CIRCUIT_OPEN_SECONDS)
+
+def upstream_targets(request: MessagesRequest) -> List[tuple]:
+    """(request, route) for the mapped model and then for each of its fallbacks, in order.
+    
+    A fallback gets a copy of the request carrying its own model name, so translation
+    and response conversion see the target they are actually talking to.
+    """
+    targets = [(request, request.route)]
+    for model in request.route.fallbacks or ():
+        route = model_router.route_for(model)
+        target_request = request.model_copy(update={"model": route.model, "messages": request._client_messages or request.messages})
+        target_request._route = route
+        target_request._client_messages = None
+        targets.append((target_request, route))
+    return targets
+
+def fallback_reason(error: BaseException) -> Optional[str]:
+    """Why a target's error lets the next target be tried, or None if it should reach the client."""
+    if isinstance(error, UpstreamOverloaded):
+        return "overloaded"
+    if isinstance(error, asyncio.TimeoutError) or getattr(error, "status_code", None) == 408:
+        return "timeout"
+    if is_upstream_failure(error):
+        return "error"
+    return None
+
+RETRYABLE_STATUSES = (429, 500, 502, 503, 504, 529)  # LiteLLM reports connection errors as 500
+
+def retry_after_seconds(error: BaseException) -> Optional[float]:
+    """The delay an upstream asked for in its Retry-After (or retry-after-ms) header, if any."""
+    headers = getattr(error, "litellm_response_headers", None)
+    if headers is None:
+        headers = getattr(getattr(error, "response", None), "headers", None)
+    if not headers:
+        return None
+    try:
+        if headers.get("retry-after-ms"):
+            return max(0.0, float(headers["retry-after-ms"]) / 1000)
+        value = headers.get("retry-after")
+        if not value:
+            return None
+        try:
+            return max(0.0, float(value))
+        except ValueError:
+            # An HTTP date
+            from email.utils import parsedate_to_datetime
+            return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+def retry_delay(error: BaseException, retries: int) -> Optional[float]:
+    """Seconds to wait before retrying a failed call, or None if it should not be retried.
+    
+    Full jitter over an exponential backoff, raised to the upstream's Retry-After;
+    a Retry-After beyond UPSTREAM_RETRY_MAX_DELAY is not waited for.
+    """
+    if retries >= UPSTREAM_RETRIES or getattr(error, "status_code", None) not in RETRYABLE_STATUSES:
+        return None
+    delay = random.uniform(0, min(UPSTREAM_RETRY_MAX_DELAY, UPSTREAM_RETRY_BASE_DELAY * 2 ** retries))
+    retry_after = retry_after_seconds(error)
+    if retry_after is not None:
+        if retry_after > UPSTREAM_RETRY_MAX_DELAY:
+            return None
+        delay = max(delay, retry_after)
+    return delay
+
+retry_budget = RequestBudget(UPSTREAM_RETRY_BUDGET)
+
+async def call_with_retries(target_request: MessagesRequest, attempt, route: Route, has_next: bool,
+                            first_call: Optional[tuple] = None):
+    """Run attempt on one target, retrying 429/5xx failures while the retry budget allows.
+    
+    Each retry is translated and load balanced anew, so it can go to another api_base.
+    """
+    retries = 0
+    while True:
+        if first_call is not None and retries == 0:
+            litellm_request, call_route = first_call
+        else:
+            await prepare_images(target_request.messages, route_image_limits(route))
+            litellm_request, call_route = build_upstream_request(target_request, route)
+        try:
+            return await attempt(target_request, litellm_request, call_route, has_next)
+        except Exception as e:
+            delay = retry_delay(e, retries)
+            if delay is None:
+                raise
+            if not retry_budget.withdraw():
+                UPSTREAM_RETRY_BUDGET_EXHAUSTED.inc((route.model,))
+                raise
+            UPSTREAM_RETRY_ATTEMPTS.inc((route.model, str(e.status_code)))
+            retries += 1
+            logger.warning(f"🔁 {route.model} failed with {e.status_code}, retry {retries} in {delay:.2f}s")
+            await asyncio.sleep(delay)
+
+async def call_with_fallbacks(request: MessagesRequest, attempt, first_call: Optional[tuple] = None):
+    """Run attempt on the request's targets in order until one answers.
+    
+    attempt(target_request, litellm_request, route, has_next) makes one upstream call.
+    Each target gets its retries first; targets whose circuit is open are skipped while
+    another target remains, so the last one (the only one, without fallbacks) is always
+    tried. Client errors (4xx other than 408/429) are returned at once. first_call is the
+    already built (litellm_request, route) of the first target. When every target
+    fails, the first error is raised.
+    """
+    retry_budget.deposit()
+    targets = upstream_targets(request)
+    first_error = None
+    skipped = None  # (model, reason) of the target just passed over
+    for i, (target_request, route) in enumerate(targets):
+        if skipped is not None:
+            UPSTREAM_FALLBACKS.inc((skipped[0], route.model, skipped[1]))
+        breaker = circuit_breakers.get(route.model)
+        has_next = i < len(targets) - 1
+        if has_next and not breaker.allow():
+            skipped = (route.model, "circuit_open")
+            continue
+        if i > 0:
+            target_request = compact_request(target_request, route)
+        try:
+            result = await call_with_retries(
+                target_request, attempt, route, has_next, first_call if i == 0 else None
+            )
+        except Exception as e:
+            reason = fallback_reason(e)
+            if reason in ("error", "timeout"):
+                # Client errors, bugs and shedding by our own limits say nothing about the target's health
+                breaker.record(False, route.model)
+            if reason is None:
+                raise
+            first_error = first_error or e
+            skipped = (route.model, reason)
+            if has_next:
+                logger.warning(f"↪️ {route.model} failed ({reason}: {e}), falling back to {targets[i + 1][1].model}")
+            continue
+        breaker.record(True, route.model)
+        return result
+    raise first_error
+
+def with_fallback_timeout(awaitable, has_next: bool):
+    """Bound a call by FALLBACK_TIMEOUT when another target could take over."""
+    if has_next and FALLBACK_TIMEOUT > 0:
+        return asyncio.wait_for(awaitable, FALLBACK_TIMEOUT)
+    return awaitable
+
+def convert_message_to_litellm(msg: Message, image_limits: Optional[tuple] = IMAGE_LIMITS) -> List[Dict[str, Any]]:
+    """Convert a single Anthropic message into one or more LiteLLM messages.
+
+    Images become image_url parts within image_limits (see image_url), or placeholder
+    text when image_limits is None.
+    """
+    messages = []
+    content = msg.content
+    if isinstance(content, str):
+        messages.append({"role": msg.role, "content": content})
+    else:
+        # Special handling for tool_result in user messages
+        # OpenAI/LiteLLM format expects the assistant to call the tool, 
+        # and the user's next message to include the result as plain text
+        if msg.role == "user" and any(block.type == "tool_result" for block in content if hasattr(block, "type")):
+            # For user messages with tool_result, split into separate messages
+            text_content = ""
+            images = []  # Image parts of the message and its tool results, sent after the text
+            
+            # Extract all text parts and concatenate them
+            for block in content:
+                if hasattr(block, "type"):
+                    if block.type == "text":
+                        text_content += block.text + "\n"
+                    elif block.type == "image":
+                        images.append(image_part(block.source, image_limits))
+                    elif block.type == "tool_result":
+                        # Add tool result as a message by itself - simulate the normal flow
+                        tool_id = block.tool_use_id if hasattr(block, "tool_use_id") else ""
+                        
+                        # Handle different formats of tool result content
+                        result_content = ""
+                        if hasattr(block, "content"):
+                            if isinstance(block.content, str):
+                                result_content = block.content
+                            elif isinstance(block.content, list):
+                                # If content is a list of blocks, extract text from each
+                                for content_block in block.content:
+                                    if hasattr(content_block, "type") and content_block.type == "text":
+                                        result_content += content_block.text + "\n"
+                                    elif isinstance(content_block, dict) and content_block.get("type") == "text":
+                                        result_content += content_block.get("text", "") + "\n"
+                                    elif isinstance(content_block, dict) and content_block.get("type") == "image":
+                                        result_content += "[Image]\n"
+                                        images.append(image_part(content_block.get("source"), image_limits))
+                                    elif isinstance(content_block, dict):
+                                        # Handle any dict by trying to extract text or convert to JSON
+                                        if "text" in content_block:
+                                            result_content += content_block.get("text", "") + "\n"
+                                        else:
+                                            try:
+                                                result_content += json.dumps(content_block) + "\n"
+                                            except:
+                                                result_content += str(content_block) + "\n"
+                            elif isinstance(block.content, dict):
+                                # Handle dictionary content
+                                if block.content.get("type") == "text":
+                                    result_content = block.content.get("text", "")
+                                else:
+                                    try:
+                                        result_content = json.dumps(block.content)
+                                    except:
+                                        result_content = str(block.content)
+                            else:
+                                # Handle any other type by converting to string
+                                try:
+                                    result_content = str(block.content)
+                                except:
+                                    result_content = "Unparseable content"
+                        
+                        # In OpenAI format, tool results come from the user (rather than being content blocks)
+                        text_content += f"Tool result for {tool_id}:\n{result_content}\n"
+            
+            # Add as a single user message with all the content
+            text_content = text_content.strip()
+            if images:
+                messages.append({"role": "user", "content": ([{"type": "text", "text": text_content}] if text_content else []) + images})
+            else:
+                messages.append({"role": "user", "content": text_content})
+        else:
+            # Regular handling for other message types
+            processed_content = []
+            for block in content:
+                if hasattr(block, "type"):
+                    if block.type == "text":
+                        processed_content.append({"type": "text", "text": block.text})
+                    elif block.type == "image":
+                        processed_content.append(image_part(block.source, image_limits))
+                    elif block.type == "tool_use":
+                        # Handle tool use blocks if needed
+                        processed_content.append({
+                            "type": "tool_use",
+                            "id": block.id,
+                            "name": block.name,
+                            "input": block.input
+                        })
+                    elif block.type == "tool_result":
+                        # Handle different formats of tool result content
+                        processed_content_block = {
+                            "type": "tool_result",
+                            "tool_use_id": block.tool_use_id if hasattr(block, "tool_use_id") else ""
+                        }
+                        
+                        # Process the content field properly
+                        if hasattr(block, "content"):
+                            if isinstance(block.content, str):
+                                # If it's a simple string, create a text block for it
+                                processed_content_block["content"] = [{"type": "text", "text": block.content}]
+                            elif isinstance(block.content, list):
+                                # If it's already a list of blocks, keep it
+                                processed_content_block["content"] = block.content
+                            else:
+                                # Default fallback
+                                processed_content_block["content"] = [{"type": "text", "text": str(block.content)}]
+                        else:
+                            # Default empty content
+                            processed_content_block["content"] = [{"type": "text", "text": ""}]
+                            
+                        processed_content.append(processed_content_block)
+            
+            messages.append({"role": msg.role, "content": processed_content})
+    
+    return messages
+
+def flatten_openai_message(msg: Dict[str, Any]) -> Dict[str, Any]:
+    """Flatten a translated message into the plain-text form OpenAI models accept.
+
+    image_url parts are kept, in their place between the text. Returns a new dict, the
+    input message is left untouched.
+    """
+    msg = dict(msg)
+    image_parts = []  # (offset in the text, part)
+    
+    # Special case - handle message content directly when it's a list of tool_result
+    # This is a specific case we're seeing in the error
+    if "content" in msg and isinstance(msg["content"], list):
+        is_only_tool_result = True
+        for block in msg["content"]:
+            if not isinstance(block, dict) or block.get("type") != "tool_result":
+                is_only_tool_result = False
+                break
+        
+        if is_only_tool_result and len(msg["content"]) > 0:
+            logger.warning(f"Found message with only tool_result content - special handling required")
+            # Extract the content from all tool_result blocks
+            all_text = ""
+            for block in msg["content"]:
+                all_text += "Tool Result:\n"
+                result_content = block.get("content", [])
+                
+                # Handle different formats of content
+                if isinstance(result_content, list):
+                    for item in result_content:
+                        if isinstance(item, dict) and item.get("type") == "text":
+                            all_text += item.get("text", "") + "\n"
+                        elif isinstance(item, dict):
+                            # Fall back to string representation of any dict
+                            try:
+                                item_text = item.get("text", json.dumps(item))
+                                all_text += item_text + "\n"
+                            except:
+                                all_text += str(item) + "\n"
+                elif isinstance(result_content, str):
+                    all_text += result_content + "\n"
+                else:
+                    try:
+                        all_text += json.dumps(result_content) + "\n"
+                    except:
+                        all_text += str(result_content) + "\n"
+            
+            # Replace the list with extracted text
+            msg["content"] = all_text.strip() or "..."
+            logger.warning(f"Converted tool_result to plain text: {all_text.strip()[:200]}...")
+            return msg  # Skip normal processing for this message
+    
+    # 1. Handle content field - normal case
+    if "content" in msg:
+        # Check if content is a list (content blocks)
+        if isinstance(msg["content"], list):
+            # Convert complex content blocks to simple string
+            text_content = ""
+            for block in msg["content"]:
+                if isinstance(block, dict):
+                    # Handle different content block types
+                    if block.get("type") == "text":
+                        text_content += block.get("text", "") + "\n"
+                    
+                    # Handle tool_result content blocks - extract nested text
+                    elif block.get("type") == "tool_result":
+                        tool_id = block.get("tool_use_id", "unknown")
+                        text_content += f"[Tool Result ID: {tool_id}]\n"
+                        
+                        # Extract text from the tool_result content
+                        result_content = block.get("content", [])
+                        if isinstance(result_content, list):
+                            for item in result_content:
+                                if isinstance(item, dict) and item.get("type") == "text":
+                                    text_content += item.get("text", "") + "\n"
+                                elif isinstance(item, dict):
+                                    # Handle any dict by trying to extract text or convert to JSON
+                                    if "text" in item:
+                                        text_content += item.get("text", "") + "\n"
+                                    else:
+                                        try:
+                                            text_content += json.dumps(item) + "\n"
+                                        except:
+                                            text_content += str(item) + "\n"
+                        elif isinstance(result_content, dict):
+                            # Handle dictionary content
+                            if result_content.get("type") == "text":
+                                text_content += result_content.get("text", "") + "\n"
+                            else:
+                                try:
+                                    text_content += json.dumps(result_content) + "\n"
+                                except:
+                                    text_content += str(result_content) + "\n"
+                        elif isinstance(result_content, str):
+                            text_content += result_content + "\n"
+                        else:
+                            try:
+                                text_content += json.dumps(result_content) + "\n"
+                            except:
+                                text_content += str(result_content) + "\n"
+                    
+                    # Handle tool_use content blocks
+                    elif block.get("type") == "tool_use":
+                        tool_name = block.get("name", "unknown")
+                        tool_id = block.get("id", "unknown")
+                        tool_input = json.dumps(block.get("input", {}))
+                        text_content += f"[Tool: {tool_name} (ID: {tool_id})]\nInput: {tool_input}\n\n"
+                    
+                    # Handle image content blocks
+                    elif block.get("type") == "image":
+                        text_content += IMAGE_PLACEHOLDER + "\n"
+                    elif block.get("type") == "image_url":
+                        image_parts.append((len(text_content), block))
+            
+            if image_parts:
+                # Text and images as parts, in their original order
+                parts, start = [], 0
+                for offset, part in image_parts + [(len(text_content), None)]:
+                    text = text_content[start:offset].strip()
+                    if text:
+                        parts.append({"type": "text", "text": text})
+                    if part is not None:
+                        parts.append(part)
+                    start = offset
+                msg["content"] = parts
+            else:
+                # Make sure content is never empty for OpenAI models
+                if not text_content.strip():
+                    text_content = "..."
+                
+                msg["content"] = text_content.strip()
+        # Also check for None or empty string content
+        elif msg["content"] is None:
+            msg["content"] = "..." # Empty content not allowed
+    
+    # 2. Remove any fields OpenAI doesn't support in messages
+    for key in list(msg.keys()):
+        if key not in ["role", "content", "name", "tool_call_id", "tool_calls"]:
+            logger.warning(f"Removing unsupported field from message: {key}")
+            del msg[key]
+    
+    # 3. Final validation - check for any remaining invalid values
+    if isinstance(msg.get("content"), list) and not image_parts:
+        logger.warning(f"CRITICAL: Message still has list content after processing: {json.dumps(msg.get('content'))}")
+        # Last resort - stringify the entire content as JSON
+        msg["content"] = f"Content as JSON: {json.dumps(msg.get('content'))}"
+    elif msg.get("content") is None:
+        logger.warning(f"Message has None content - replacing with placeholder")
+        msg["content"] = "..." # Fallback placeholder
+    
+    return msg
+
+def convert_message_to_openai_tools(msg: Message, image_limits: Optional[tuple] = IMAGE_LIMITS) -> List[Dict[str, Any]]:
+    """Translate a message for an OpenAI model using native tool calling.
+
+    tool_use blocks become the assistant's tool_calls and each tool_result becomes a
+    role "tool" message answering its call; everything else is flattened to text as
+    flatten_openai_message does. Tool messages cannot hold images, so images of tool
+    results follow in the user message after them.
+    """
+    content = msg.content
+    if isinstance(content, str):
+        return [{"role": msg.role, "content": content}]
+    if msg.role == "assistant":
+        tool_calls = [
+            {"id": block.id, "type": "function", "function": {"name": block.name, "arguments": json.dumps(block.input)}}
+            for block in content if block.type == "tool_use"
+        ]
+        if tool_calls:
+            text = "\n".join(block.text for block in content if block.type == "text" and block.text)
+            return [{"role": "assistant", "content": text or None, "tool_calls": tool_calls}]
+    elif any(block.type == "tool_result" for block in content):
+        # Tool messages have to follow the assistant message directly, other blocks go after them
+        messages = [
+            {"role": "tool", "tool_call_id": block.tool_use_id, "content": parse_tool_result_content(block.content) or "..."}
+            for block in content if block.type == "tool_result"
+        ]
+        rest = [block for block in content if block.type != "tool_result"]
+        # Images without a well-formed source are skipped, as image_part does
+        rest.extend(
+            ContentBlockImage.model_construct(type="image", source=item["source"])
+            for block in content if block.type == "tool_result" and isinstance(block.content, list)
+            for item in block.content
+            if isinstance(item, dict) and item.get("type") == "image" and isinstance(item.get("source"), dict)
+        )
+        if rest:
+            messages.extend(flatten_openai_message(m)
+                            for m in convert_message_to_litellm(Message(role="user", content=rest), image_limits))
+        return messages
+    return [flatten_openai_message(m) for m in convert_message_to_litellm(msg, image_limits)]
+
+def pair_tool_messages(messages: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """Make every assistant tool call be answered by the tool messages right after it.
+
+    OpenAI rejects a conversation with an unanswered call or a tool message without
+    its call (e.g. after an interrupted turn). Missing results get a placeholder and
+    stray results are passed on as user text.
+    """
+    paired = []
+    pending: Dict[str, bool] = {}  # Calls of the last assistant message still unanswered
+    for msg in messages:
+        role = msg.get("role")
+        if role == "tool":
+            if pending.pop(msg.get("tool_call_id"), None):
+                paired.append(msg)
+            else:
+                paired.append({"role": "user", "content": f"Tool result for {msg.get('tool_call_id')}:\n{msg.get('content')}"})
+            continue
+        for call_id in pending:
+            paired.append({"role": "tool", "tool_call_id": call_id, "content": "No result was recorded for this call."})
+        pending = {call["id"]: True for call in msg.get("tool_calls") or ()} if role == "assistant" else {}
+        paired.append(msg)
+    for call_id in pending:
+        paired.append({"role": "tool", "tool_call_id": call_id, "content": "No result was recorded for this call."})
+    return paired
+
+class LRUCache:
+    """Bounded LRU cache with hit and miss counters."""
+    def __init__(self, max_entries: int):
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[Any, Any]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+    
+    def get(self, key):
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry
+    
+    def pop(self, key):
+        return self._entries.pop(key, None)
+    
+    def __contains__(self, key) -> bool:
+        """Membership test that neither counts as a lookup nor refreshes the entry."""
+        return key in self._entries
+    
+    def put(self, key, value):
+        if self.max_entries <= 0:
+            return
+        self._entries[key] = value
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+    
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+        }
+
+def content_digest(data: bytes) -> bytes:
+    """128-bit BLAKE2b digest of data, for cache keys that must not collide.
+
+    hash() has 64 bits and a per-process salt; a long-running cache shared by every client
+    could then hand a request the entry of another one.
+    """
+    return hashlib.blake2b(data, digest_size=16).digest()
+
+class DigestMemo:
+    """content_digest of recently seen strings, found by identity.
+
+    A request's images are looked up in several caches in turn; with this each is read
+    once per request rather than once per lookup. The strings are kept alive, so their
+    ids cannot be reused, up to max_chars in total.
+    """
+    def __init__(self, max_chars: int):
+        self.max_chars = max_chars
+        self.chars = 0
+        self._entries: "OrderedDict[int, tuple]" = OrderedDict()
+    
+    def digest(self, data: str) -> bytes:
+        entry = self._entries.get(id(data))
+        if entry is not None and entry[0] is data:
+            self._entries.move_to_end(id(data))
+            return entry[1]
+        digest = content_digest(data.encode())
+        if len(data) <= self.max_chars:
+            if entry is not None:
+                del self._entries[id(data)]
+                self.chars -= len(entry[0])
+            self._entries[id(data)] = (data, digest)
+            self.chars += len(data)
+            while self.chars > self.max_chars:
+                evicted, _ = self._entries.popitem(last=False)[1]
+                self.chars -= len(evicted)
+        return digest
+
+# Base64 image data of the requests in flight
+image_digests = DigestMemo(64 * 1024 * 1024)
+
+# Translated LiteLLM messages keyed by the content of each Anthropic message (see
+# message_key). Claude Code resends the whole conversation on every turn, so only the new
+# tail has to be translated.
+translation_cache = LRUCache(TRANSLATION_CACHE_SIZE)
+
+# Translated tool definitions (pickled, so never shared) keyed by tool list digest and target
+tool_cache = LRUCache(TOOL_CACHE_SIZE)
+
+# Prepared image_url URLs keyed by a digest of the image data and size limits, shared by
+# every target and turn that sends the same image
+image_cache = LRUCache(IMAGE_CACHE_SIZE)
+
+IMAGE_PLACEHOLDER = "[Image content - not displayed in text format]"
+_pillow_missing_logged = False
+
+def encode_image(image, image_format: str) -> bytes:
+    """Encode a Pillow image; JPEG gets transparent areas filled with white."""
+    from PIL import Image
+    if image_format == "JPEG" and image.mode != "RGB":
+        rgba = image.convert("RGBA")
+        image = Image.new("RGB", rgba.size, (255, 255, 255))
+        image.paste(rgba, mask=rgba.getchannel("A"))
+    buffer = io.BytesIO()
+    image.save(buffer, image_format, **({"quality": 85} if image_format == "JPEG" else {}))
+    return buffer.getvalue()
+
+def downscale_image(media_type: str, data: str, max_dimension: int, max_bytes: int) -> tuple:
+    """Shrink a base64 image to max_dimension pixels on its long side and max_bytes.
+
+    Returns (media_type, data). Images within the limits, images that would not get
+    smaller, and every image when Pillow is missing or cannot read it come back
+    unchanged. An image still too large after resizing is re-encoded as JPEG, then made
+    smaller until it fits.
+    """
+    global _pillow_missing_logged
+    try:
+        from PIL import Image
+    except ImportError:
+        if not _pillow_missing_logged:
+            _pillow_missing_logged = True
+            logger.warning("⚠️ Downscaling images needs Pillow (pip install pillow), sending them as they are")
+        return media_type, data
+    try:
+        raw = base64.b64decode(data)
+        with Image.open(io.BytesIO(raw)) as image:
+            width, height = image.size
+            scale = min(1.0, max_dimension / max(width, height)) if max_dimension else 1.0
+            if scale == 1.0 and (not max_bytes or len(raw) <= max_bytes):
+                return media_type, data
+            image_format = image.format if image.format in ("JPEG", "PNG", "WEBP") else "PNG"
+            if scale == 1.0:
+                # Only too many bytes: a lossy encoding at the same size is the least loss
+                image_format = "JPEG"
+            if image.mode not in ("RGB", "RGBA", "L"):
+                image = image.convert("RGBA")
+            for _ in range(6):
+                size = (max(1, round(width * scale)), max(1, round(height * scale)))
+                resized = image.resize(size, Image.BICUBIC, reducing_gap=2.0) if scale < 1.0 else image
+                encoded = encode_image(resized, image_format)
+                if len(encoded) < len(raw) and (not max_bytes or len(encoded) <= max_bytes):
+                    break
+                if image_format != "JPEG":
+                    # Resampled screenshots often compress worse as PNG than the original
+                    image_format = "JPEG"
+                elif max_bytes and len(encoded) > max_bytes:
+                    scale *= max(0.5, 0.9 * (max_bytes / len(encoded)) ** 0.5)
+                else:
+                    break
+    except Exception as e:
+        logger.warning(f"⚠️ Could not downscale a {media_type} image ({e}), sending it as it is")
+        return media_type, data
+    if len(encoded) >= len(raw):
+        return media_type, data
+    IMAGES_DOWNSCALED.inc()
+    IMAGE_BYTES_SAVED.inc((), len(raw) - len(encoded))
+    logger.info(f"🖼️ Downscaled a {width}x{height} image of {len(raw) // 1024} kB "
+                f"to {size[0]}x{size[1]} {image_format} of {len(encoded) // 1024} kB")
+    return f"image/{image_format.lower()}", base64.b64encode(encoded).decode("ascii")
+
+def image_cache_key(source: Dict[str, Any], image_limits: tuple) -> Optional[tuple]:
+    """image_cache key of a base64 image source, None for other sources.
+
+    Keyed on content_digest of the data: two screenshots of the same size must never
+    share a downscaled image.
+    """
+    data = source.get("data")
+    if source.get("type") != "base64" or not isinstance(data, str):
+        return None
+    return (image_digests.digest(data), source.get("media_type"), image_limits)
+
+def prepare_image_url(source: Dict[str, Any], image_limits: tuple) -> Optional[str]:
+    """The image_url URL of an Anthropic image source within (max_dimension, max_bytes).
+
+    base64 images become data URLs, decoded and downscaled if needed. None for sources
+    that cannot be sent. Touches no shared state, so it can run in a worker thread.
+    """
+    if source.get("type") == "url":
+        return source.get("url")
+    data = source.get("data")
+    if source.get("type") != "base64" or not isinstance(data, str):
+        return None
+    media_type = source.get("media_type") or "image/png"
+    max_dimension, max_bytes = image_limits
+    if max_dimension or max_bytes:
+        media_type, data = downscale_image(media_type, data, max_dimension, max_bytes)
+    return f"data:{media_type};base64,{data}"
+
+def image_url(source: Dict[str, Any], image_limits: tuple) -> Optional[str]:
+    """prepare_image_url, done once per distinct image and limits and then taken from image_cache."""
+    key = image_cache_key(source, image_limits) if image_cache.max_entries > 0 else None
+    url = image_cache.get(key) if key is not None else None
+    if url is None:
+        url = prepare_image_url(source, image_limits)
+        if key is not None and url is not None:
+            image_cache.put(key, url)
+    return url
+
+async def prepare_images(messages: List[Message], image_limits: Optional[tuple]):
+    """Prepare the images of messages that are not in image_cache yet, in worker threads.
+
+    Decoding and resizing a large screenshot takes a CPU-bound tenth of a second or more;
+    done here, off the event loop, translation then finds every image ready.
+    """
+    if image_limits is None or image_cache.max_entries <= 0:
+        return
+    pending = {}
+    for msg in messages:
+        if isinstance(msg.content, str):
+            continue
+        for block in msg.content:
+            if block.type == "image":
+                sources = [block.source]
+            elif block.type == "tool_result" and isinstance(block.content, list):
+                sources = [item.get("source") for item in block.content if isinstance(item, dict) and item.get("type") == "image"]
+            else:
+                continue
+            for source in sources:
+                key = image_cache_key(source, image_limits) if isinstance(source, dict) else None
+                if key is not None and key not in image_cache and key not in pending:
+                    pending[key] = source
+    if not pending:
+        return
+    loop = asyncio.get_running_loop()
+    urls = await asyncio.gather(*(
+        loop.run_in_executor(None, prepare_image_url, source, image_limits) for source in pending.values()
+    ))
+    for key, url in zip(pending, urls):
+        image_cache.put(key, url)
+
+def image_part(source: Any, image_limits: Optional[tuple]) -> Dict[str, Any]:
+    """An image as an OpenAI image_url part, or placeholder text when it is not sent."""
+    url = image_url(source, image_limits) if image_limits is not None and isinstance(source, dict) else None
+    if url is None:
+        return {"type": "text", "text": IMAGE_PLACEHOLDER}
+    return {"type": "image_url", "image_url": {"url": url}}
+
+def message_key(msg: Message) -> tuple:
+    """Cache key holding the content of a message.
+
+    A dict lookup compares keys on a hit, so unlike a hash of the content, no collision
+    can return the entry of another conversation. Strings are kept as they are, which
+    costs no more than hashing them, and small nested values are pickled (see key_value).
+    """
+    content = msg.content
+    if isinstance(content, str):
+        return (msg.role, content)
+    parts = [msg.role]
+    for block in content:
+        for value in block.__dict__.values():
+            parts.append(value if value is None or value.__class__ is str else key_value(value))
+    return tuple(parts)
+
+def key_value(value: Any) -> Any:
+    """Hashable stand-in for a block field in message_key.
+
+    Image data, which can be megabytes, is replaced by its content_digest so that cache
+    keys do not keep full size images alive.
+    """
+    if value is None or isinstance(value, str):
+        return value
+    if isinstance(value, dict) and value.get("type") == "base64" and isinstance(value.get("data"), str):
+        return ("base64", value.get("media_type"), image_digests.digest(value["data"]))
+    if isinstance(value, list):
+        # Content items of a tool result
+        return tuple(key_item(item) for item in value)
+    return pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+
+def key_item(item: Any) -> Any:
+    if isinstance(item, dict):
+        item_type = item.get("type")
+        if item_type == "text" and len(item) == 2 and isinstance(item.get("text"), str):
+            return ("text", item["text"])
+        if item_type == "image":
+            return ("image", key_value(item.get("source")))
+    return pickle.dumps(item, pickle.HIGHEST_PROTOCOL)
+
+def copy_translated_message(msg: Dict[str, Any]) -> Dict[str, Any]:
+    """Copy a cached message so callers, LiteLLM's provider transforms included, can modify it
+    at any depth without touching the cache (strings are shared)."""
+    msg = msg.copy()
+    for key, value in msg.items():
+        if value.__class__ in (dict, list):
+            # Content parts and tool calls, with their image_url, cache_control and function dicts
+            msg[key] = copy_part(value)
+    return msg
+
+def copy_part(part: Any) -> Any:
+    if part.__class__ is list:
+        return [item if item.__class__ is str else copy_part(item) for item in part]
+    if part.__class__ is not dict:
+        return part
+    part = part.copy()
+    for key, value in part.items():
+        if value.__class__ in (dict, list):
+            part[key] = copy_part(value)
+    return part
+
+def message_cache_control(msg: Message) -> Optional[Dict[str, Any]]:
+    """The cache_control of the last block of a message that carries one."""
+    if isinstance(msg.content, str):
+        return None
+    for block in reversed(msg.content):
+        if block.cache_control:
+            return block.cache_control
+    return None
+
+def add_cache_control(msg: Dict[str, Any], cache_control: Dict[str, Any]) -> Dict[str, Any]:
+    """Put a cache breakpoint on the last content part of a translated message."""
+    content = msg.get("content")
+    if isinstance(content, str):
+        msg["content"] = [{"type": "text", "text": content, "cache_control": cache_control}]
+    elif isinstance(content, list) and content:
+        content[-1] = dict(content[-1], cache_control=cache_control)
+    return msg
+
+def translate_conversation(messages: List[Message], flatten_for_openai: bool = False,
+                           cache_control: bool = False, native_tool_calls: bool = False,
+                           image_limits: Optional[tuple] = IMAGE_LIMITS) -> List[Dict[str, Any]]:
+    """Translate conversation messages to LiteLLM format.
+
+    Flattened for OpenAI, only messages not seen before are converted, the rest come from
+    translation_cache. The plain LiteLLM format mostly reuses block fields as they are, which
+    is cheaper than the hash and copy a cache lookup costs, so it is not cached.
+    With cache_control, a message with a cache breakpoint on any of its blocks keeps it
+    at its end, where Claude Code puts it (the message may have been merged into text).
+    native_tool_calls applies to flatten_for_openai, see convert_message_to_openai_tools.
+    image_limits is passed on to convert_message_to_litellm.
+    """
+    native_tool_calls = native_tool_calls and flatten_for_openai
+    flavor = "openai_tools" if native_tool_calls else "openai"
+    use_cache = flatten_for_openai and translation_cache.max_entries > 0
+    translated = []
+    hits_before = translation_cache.hits
+    for msg in messages:
+        key = (flavor, cache_control, image_limits, message_key(msg)) if use_cache else None
+        cached = translation_cache.get(key) if key is not None else None
+        if cached is None:
+            if native_tool_calls:
+                converted = convert_message_to_openai_tools(msg, image_limits)
+            else:
+                converted = convert_message_to_litellm(msg, image_limits)
+                if flatten_for_openai:
+                    converted = [flatten_openai_message(m) for m in converted]
+            mark = message_cache_control(msg) if cache_control else None
+            if mark is not None and converted:
+                converted[-1] = add_cache_control(converted[-1], mark)
+            if key is None:
+                # Not cached, so not shared with anyone
+                translated.extend(converted)
+                continue
+            cached = tuple(converted)
+            translation_cache.put(key, cached)
+        translated.extend(copy_translated_message(m) for m in cached)
+    
+    if use_cache:
+        reused = translation_cache.hits - hits_before
+        logger.debug(f"Translation cache: reused {reused}/{len(messages)} messages ({translation_cache.stats()})")
+    return translated
+
+def convert_tools_to_openai(tools: List[Tool], is_gemini_model: bool = False) -> List[Dict[str, Any]]:
+    """Convert Anthropic tool definitions to OpenAI function tools.
+
+    cache_control is kept on the tool (LiteLLM passes it on to providers that cache
+    prompts) except for Gemini, where LiteLLM would create a context cache instead.
+    """
+    openai_tools = []
+    for tool in tools:
+        # Convert to dict if it's a pydantic model
+        if hasattr(tool, 'dict'):
+            tool_dict = tool.dict()
+        else:
+            # Ensure tool_dict is a dictionary, handle potential errors if 'tool' isn't dict-like
+            try:
+                tool_dict = dict(tool) if not isinstance(tool, dict) else tool
+            except (TypeError, ValueError):
+                 logger.error(f"Could not convert tool to dict: {tool}")
+                 continue # Skip this tool if conversion fails
+
+        # Clean the schema if targeting a Gemini model
+        input_schema = tool_dict.get("input_schema", {})
+        if is_gemini_model:
+             input_schema = clean_gemini_schema(input_schema)
+
+        # Create OpenAI-compatible function tool
+        openai_tool = {
+            "type": "function",
+            "function": {
+                "name": tool_dict["name"],
+                "description": tool_dict.get("description", ""),
+                "parameters": input_schema # Use potentially cleaned schema
+            }
+        }
+        if tool_dict.get("cache_control") and not is_gemini_model:
+            openai_tool["cache_control"] = tool_dict["cache_control"]
+        openai_tools.append(openai_tool)
+    return openai_tools
+
+def tools_digest(tools: List[Tool]) -> bytes:
+    """content_digest of a tool list, used as a key for in-process caches."""
+    return content_digest(pickle.dumps([tool.__dict__ for tool in tools], pickle.HIGHEST_PROTOCOL))
+
+def translate_tools(tools: List[Tool], is_gemini_model: bool = False) -> List[Dict[str, Any]]:
+    """Return the OpenAI tools array for a tool list, translating each distinct list only once.
+
+    The cached form is an immutable pickle, so every caller gets its own fresh copy:
+    LiteLLM edits tool schemas in place for some providers and must not touch shared data.
+    """
+    if tool_cache.max_entries <= 0:
+        return convert_tools_to_openai(tools, is_gemini_model)
+    
+    key = ("gemini" if is_gemini_model else "openai", tools_digest(tools))
+    frozen_tools = tool_cache.get(key)
+    if frozen_tools is None:
+        frozen_tools = pickle.dumps(convert_tools_to_openai(tools, is_gemini_model), pickle.HIGHEST_PROTOCOL)
+        tool_cache.put(key, frozen_tools)
+    return pickle.loads(frozen_tools)
+
+def convert_system_to_litellm(system: Optional[Union[str, List[SystemContent]]],
+                              cache_control: bool = False) -> Optional[Dict[str, Any]]:
+    """Convert an Anthropic system prompt to a LiteLLM system message (None if empty).
+
+    With cache_control, system blocks carrying a cache breakpoint are kept as separate
+    text parts with their breakpoints instead of being joined into one string.
+    """
+    if not system:
+        return None
+    # Handle different formats of system messages
+    if isinstance(system, str):
+        # Simple string format
+        return {"role": "system", "content": system}
+    elif isinstance(system, list):
+        if cache_control and any(getattr(block, "cache_control", None) for block in system):
+            parts = []
+            for block in system:
+                if getattr(block, "type", None) == "text" and block.text:
+                    part = {"type": "text", "text": block.text}
+                    if block.cache_control:
+                        part["cache_control"] = block.cache_control
+                    parts.append(part)
+            return {"role": "system", "content": parts}
+        # List of content blocks
+        system_text = ""
+        for block in system:
+            if hasattr(block, 'type') and block.type == "text":
+                system_text += block.text + "\n\n"
+            elif isinstance(block, dict) and block.get("type") == "text":
+                system_text += block.get("text", "") + "\n\n"
+        
+        if system_text:
+            return {"role": "system", "content": system_text.strip()}
+    return None
+
+def convert_anthropic_to_litellm(anthropic_request: MessagesRequest, flatten_for_openai: bool = False,
+                                 native_tool_calls: bool = False,
+                                 image_limits: Optional[tuple] = IMAGE_LIMITS) -> Dict[str, Any]:
+    """Convert Anthropic API request format to LiteLLM format (which follows OpenAI).
+
+    With flatten_for_openai, content blocks are flattened into plain strings for OpenAI models;
+    native_tool_calls then keeps tool calls and results as OpenAI tool_calls and tool messages.
+    Images are sent within image_limits, (max_dimension, max_bytes), or left out if None.
+    """
     # LiteLLM already handles Anthropic models when using the format model="anthropic/claude-3-opus-20240229"
     # So we just need to convert our Pydantic model to a dict in the expected format
     
     messages = []
     
+    # Prompt cache breakpoints are passed on; LiteLLM drops them for providers without
+    # prompt caching. Gemini is left out: LiteLLM would create a context cache for them.
+    cache_control = not anthropic_request.model.startswith("gemini/")
+    
     # Add system message if present
-    if anthropic_request.system:
-        # Handle different formats of system messages
-        if isinstance(anthropic_request.system, str):
-            # Simple string format
-            messages.append({"role": "system", "content": anthropic_request.system})
-        elif isinstance(anthropic_request.system, list):
-            # List of content blocks
-            system_text = ""
-            for block in anthropic_request.system:
-                if hasattr(block, 'type') and block.type == "text":
-                    system_text += block.text + "\n\n"
-                elif isinstance(block, dict) and block.get("type") == "text":
-                    system_text += block.get("text", "") + "\n\n"
-            
-            if system_text:
-                messages.append({"role": "system", "content": system_text.strip()})
+    system_message = convert_system_to_litellm(anthropic_request.system, cache_control)
+    if system_message:
+        messages.append(system_message)
     
-    # Add conversation messages
-    for idx, msg in enumerate(anthropic_request.messages):
-        content = msg.content
-        if isinstance(content, str):
-            messages.append({"role": msg.role, "content": content})
-        else:
-            # Special handling for tool_result in user messages
-            # OpenAI/LiteLLM format expects the assistant to call the tool, 
-            # and the user's next message to include the result as plain text
-            if msg.role == "user" and any(block.type == "tool_result" for block in content if hasattr(block, "type")):
-                # For user messages with tool_result, split into separate messages
-                text_content = ""
-                
-                # Extract all text parts and concatenate them
-                for block in content:
-                    if hasattr(block, "type"):
-                        if block.type == "text":
-                            text_content += block.text + "\n"
-                        elif block.type == "tool_result":
-                            # Add tool result as a message by itself - simulate the normal flow
-                            tool_id = block.tool_use_id if hasattr(block, "tool_use_id") else ""
-                            
-                            # Handle different formats of tool result content
-                            result_content = ""
-                            if hasattr(block, "content"):
-                                if isinstance(block.content, str):
-                                    result_content = block.content
-                                elif isinstance(block.content, list):
-                                    # If content is a list of blocks, extract text from each
-                                    for content_block in block.content:
-                                        if hasattr(content_block, "type") and content_block.type == "text":
-                                            result_content += content_block.text + "\n"
-                                        elif isinstance(content_block, dict) and content_block.get("type") == "text":
-                                            result_content += content_block.get("text", "") + "\n"
-                                        elif isinstance(content_block, dict):
-                                            # Handle any dict by trying to extract text or convert to JSON
-                                            if "text" in content_block:
-                                                result_content += content_block.get("text", "") + "\n"
-                                            else:
-                                                try:
-                                                    result_content += json.dumps(content_block) + "\n"
-                                                except:
-                                                    result_content += str(content_block) + "\n"
-                                elif isinstance(block.content, dict):
-                                    # Handle dictionary content
-                                    if block.content.get("type") == "text":
-                                        result_content = block.content.get("text", "")
-                                    else:
-                                        try:
-                                            result_content = json.dumps(block.content)
-                                        except:
-                                            result_content = str(block.content)
-                                else:
-                                    # Handle any other type by converting to string
-                                    try:
-                                        result_content = str(block.content)
-                                    except:
-                                        result_content = "Unparseable content"
-                            
-                            # In OpenAI format, tool results come from the user (rather than being content blocks)
-                            text_content += f"Tool result for {tool_id}:\n{result_content}\n"
-                
-                # Add as a single user message with all the content
-                messages.append({"role": "user", "content": text_content.strip()})
-            else:
-                # Regular handling for other message types
-                processed_content = []
-                for block in content:
-                    if hasattr(block, "type"):
-                        if block.type == "text":
-                            processed_content.append({"type": "text", "text": block.text})
-                        elif block.type == "image":
-                            processed_content.append({"type": "image", "source": block.source})
-                        elif block.type == "tool_use":
-                            # Handle tool use blocks if needed
-                            processed_content.append({
-                                "type": "tool_use",
-                                "id": block.id,
-                                "name": block.name,
-                                "input": block.input
-                            })
-                        elif block.type == "tool_result":
-                            # Handle different formats of tool result content
-                            processed_content_block = {
-                                "type": "tool_result",
-                                "tool_use_id": block.tool_use_id if hasattr(block, "tool_use_id") else ""
-                            }
-                            
-                            # Process the content field properly
-                            if hasattr(block, "content"):
-                                if isinstance(block.content, str):
-                                    # If it's a simple string, create a text block for it
-                                    processed_content_block["content"] = [{"type": "text", "text": block.content}]
-                                elif isinstance(block.content, list):
-                                    # If it's already a list of blocks, keep it
-                                    processed_content_block["content"] = block.content
-                                else:
-                                    # Default fallback
-                                    processed_content_block["content"] = [{"type": "text", "text": str(block.content)}]
-                            else:
-                                # Default empty content
-                                processed_content_block["content"] = [{"type": "text", "text": ""}]
-                                
-                            processed_content.append(processed_content_block)
-                
-                messages.append({"role": msg.role, "content": processed_content})
+    # Add conversation messages, reusing translations of messages seen on earlier turns
+    conversation = translate_conversation(anthropic_request.messages, flatten_for_openai, cache_control,
+                                          native_tool_calls, image_limits)
+    if native_tool_calls and flatten_for_openai:
+        conversation = pair_tool_messages(conversation)
+    messages.extend(conversation)
     
     # Cap max_tokens for OpenAI models to their limit of 16384
     max_tokens = anthropic_request.max_tokens
@@ -614,38 +2728,8 @@ def convert_anthropic_to_litellm(anthropic_request: MessagesRequest) -> Dict[str
     
     # Convert tools to OpenAI format
     if anthropic_request.tools:
-        openai_tools = []
         is_gemini_model = anthropic_request.model.startswith("gemini/")
-
-        for tool in anthropic_request.tools:
-            # Convert to dict if it's a pydantic model
-            if hasattr(tool, 'dict'):
-                tool_dict = tool.dict()
-            else:
-                # Ensure tool_dict is a dictionary, handle potential errors if 'tool' isn't dict-like
-                try:
-                    tool_dict = dict(tool) if not isinstance(tool, dict) else tool
-                except (TypeError, ValueError):
-                     logger.error(f"Could not convert tool to dict: {tool}")
-                     continue # Skip this tool if conversion fails
-
-            # Clean the schema if targeting a Gemini model
-            input_schema = tool_dict.get("input_schema", {})
-            if is_gemini_model:
-                 input_schema = clean_gemini_schema(input_schema)
-
-            # Create OpenAI-compatible function tool
-            openai_tool = {
-                "type": "function",
-                "function": {
-                    "name": tool_dict["name"],
-                    "description": tool_dict.get("description", ""),
-                    "parameters": input_schema # Use potentially cleaned schema
-                }
-            }
-            openai_tools.append(openai_tool)
-
-        litellm_request["tools"] = openai_tools
+        litellm_request["tools"] = translate_tools(anthropic_request.tools, is_gemini_model)
     
     # Convert tool_choice to OpenAI format if present
     if anthropic_request.tool_choice:
@@ -671,6 +2755,27 @@ def convert_anthropic_to_litellm(anthropic_request: MessagesRequest) -> Dict[str
     
     return litellm_request
 
+def anthropic_usage(usage_info: Any) -> Dict[str, int]:
+    """Anthropic usage counts from a LiteLLM (OpenAI format) usage object or dict.
+
+    OpenAI counts cached prompt tokens in prompt_tokens, while Anthropic's input_tokens
+    leaves out the tokens read from and written to the prompt cache.
+    """
+    def field(obj, name):
+        if obj is None:
+            return None
+        return obj.get(name) if isinstance(obj, dict) else getattr(obj, name, None)
+    details = field(usage_info, "prompt_tokens_details")
+    cache_read = field(usage_info, "cache_read_input_tokens") or field(details, "cached_tokens") or 0
+    cache_creation = field(usage_info, "cache_creation_input_tokens") or field(details, "cache_creation_tokens") or 0
+    prompt_tokens = field(usage_info, "prompt_tokens") or 0
+    return {
+        "input_tokens": max(0, prompt_tokens - cache_read - cache_creation),
+        "output_tokens": field(usage_info, "completion_tokens") or 0,
+        "cache_creation_input_tokens": cache_creation,
+        "cache_read_input_tokens": cache_read,
+    }
+
 def convert_litellm_to_anthropic(litellm_response: Union[Dict[str, Any], Any], 
                                  original_request: MessagesRequest) -> MessagesResponse:
     """Convert LiteLLM (OpenAI format) response to Anthropic API response format."""
@@ -832,12 +2937,7 @@ def convert_litellm_to_anthropic(litellm_response: Union[Dict[str, Any], Any],
                 content.append({"type": "text", "text": tool_text})
         
         # Get usage information - extract values safely from object or dict
-        if isinstance(usage_info, dict):
-            prompt_tokens = usage_info.get("prompt_tokens", 0)
-            completion_tokens = usage_info.get("completion_tokens", 0)
-        else:
-            prompt_tokens = getattr(usage_info, "prompt_tokens", 0)
-            completion_tokens = getattr(usage_info, "completion_tokens", 0)
+        usage = anthropic_usage(usage_info)
         
         # Map OpenAI finish_reason to Anthropic stop_reason
         stop_reason = None
@@ -862,10 +2962,7 @@ def convert_litellm_to_anthropic(litellm_response: Union[Dict[str, Any], Any],
             content=content,
             stop_reason=stop_reason,
             stop_sequence=None,
-            usage=Usage(
-                input_tokens=prompt_tokens,
-                output_tokens=completion_tokens
-            )
+            usage=Usage(**usage)
         )
         
         return anthropic_response
@@ -886,8 +2983,161 @@ def convert_litellm_to_anthropic(litellm_response: Union[Dict[str, Any], Any],
             usage=Usage(input_tokens=0, output_tokens=0)
         )
 
-async def handle_streaming(response_generator, original_request: MessagesRequest):
-    """Handle streaming responses from LiteLLM and convert to Anthropic format."""
+# Characters that change the nesting or string state of streamed tool arguments, outside strings
+TOOL_ARGUMENTS_STRUCTURE = re.compile(r'["{}\[\]]')
+# The rest of a JSON string, escapes included, up to its closing quote or a backslash ending the text
+TOOL_ARGUMENTS_STRING = re.compile(r'[^"\\]*(?:\\.[^"\\]*)*', re.DOTALL)
+
+class StreamedToolCall:
+    """One streamed tool call and the scanner state of its JSON arguments.
+
+    Fragments are scanned once as they arrive, strings consumed whole by a regular
+    expression and only quotes and brackets visited between them, so whether the
+    arguments are complete is known after every fragment in O(total bytes), without
+    parsing partial JSON. They are parsed once, by validate(), when the block closes.
+    """
+    def __init__(self, tool_id: Optional[str], name: Optional[str]):
+        self.id = tool_id or f"toolu_{uuid.uuid4().hex[:24]}"
+        self.name = name or ""
+        self.block_index: Optional[int] = None  # Anthropic content block, once started
+        self.pending: List[str] = []  # Fragments received before the block started
+        self.closed = False
+        self.fragments: List[str] = []
+        self.depth = 0
+        self.in_string = False
+        self.escaped = False  # The last fragment ended with a backslash inside a string
+        self.opened = False
+    
+    def feed(self, fragment: str):
+        self.fragments.append(fragment)
+        depth, in_string = self.depth, self.in_string
+        pos, end = 0, len(fragment)
+        if self.escaped and end:
+            self.escaped = False
+            pos = 1
+        while pos < end:
+            if in_string:
+                pos = TOOL_ARGUMENTS_STRING.match(fragment, pos).end()
+                if pos == end:
+                    break
+                if fragment[pos] == '"':
+                    in_string = False
+                    pos += 1
+                else:
+                    # A backslash ending the fragment escapes the first character of the next one
+                    self.escaped = True
+                    break
+            else:
+                match = TOOL_ARGUMENTS_STRUCTURE.search(fragment, pos)
+                if match is None:
+                    break
+                pos = match.end()
+                char = match.group()
+                if char == '"':
+                    in_string = True
+                elif char in "{[":
+                    depth += 1
+                    self.opened = True
+                else:
+                    depth -= 1
+        self.depth, self.in_string = depth, in_string
+    
+    @property
+    def complete(self) -> bool:
+        """The arguments form a closed JSON object or array."""
+        return self.opened and self.depth == 0 and not self.in_string
+    
+    def validate(self) -> bool:
+        """Parse the arguments: a JSON object, or nothing at all (no arguments)."""
+        if not self.fragments:
+            return True
+        if not self.complete:
+            return False
+        try:
+            return isinstance(json.loads("".join(self.fragments)), dict)
+        except ValueError:
+            return False
+
+class ToolCallStream:
+    """Turns streamed OpenAI tool call fragments into sequential Anthropic tool_use blocks.
+
+    Parallel calls may arrive interleaved by index, while Anthropic streams one content
+    block at a time. The first call streams as it arrives; fragments of later calls are
+    held until the open call's arguments are complete, which closes its block, and the
+    next call then starts with them, in order of first appearance.
+    """
+    def __init__(self, first_block_index: int, model: str):
+        self.next_block_index = first_block_index
+        self.model = model
+        self.calls: Dict[Any, StreamedToolCall] = {}  # By OpenAI tool call index
+        self.queue: deque = deque()  # Calls not started yet
+        self.active: Optional[StreamedToolCall] = None
+    
+    def __bool__(self) -> bool:
+        return bool(self.calls)
+    
+    def feed(self, index: Any, tool_id: Optional[str], name: Optional[str], fragment: str) -> List[tuple]:
+        """Add a fragment of call index; returns the events ready to be sent."""
+        call = self.calls.get(index)
+        if call is None or (tool_id and tool_id != call.id):
+            # A new call (some providers reuse index 0 for every call, with a new id)
+            call = self.calls[index] = StreamedToolCall(tool_id, name)
+            self.queue.append(call)
+        events = []
+        if fragment:
+            if call.closed:
+                logger.debug(f"Dropping arguments after the end of tool call {call.name}: {fragment[:100]!r}")
+            else:
+                call.feed(fragment)
+                if call is self.active:
+                    events.append(self._delta(call, fragment))
+                else:
+                    call.pending.append(fragment)
+        events.extend(self._advance(finishing=False))
+        return events
+    
+    def close(self) -> List[tuple]:
+        """Close the open call and stream the remaining ones; returns their events."""
+        return self._advance(finishing=True)
+    
+    def _advance(self, finishing: bool) -> List[tuple]:
+        events = []
+        while True:
+            if self.active is not None:
+                if not (finishing or self.active.complete):
+                    break
+                events.extend(self._stop(self.active))
+                self.active = None
+            if not self.queue:
+                break
+            self.active = self.queue.popleft()
+            events.extend(self._start(self.active))
+        return events
+    
+    def _delta(self, call: StreamedToolCall, partial_json: str) -> tuple:
+        return ("content_block_delta", {'type': 'content_block_delta', 'index': call.block_index, 'delta': {'type': 'input_json_delta', 'partial_json': partial_json}})
+    
+    def _start(self, call: StreamedToolCall) -> List[tuple]:
+        call.block_index = self.next_block_index
+        self.next_block_index += 1
+        events = [("content_block_start", {'type': 'content_block_start', 'index': call.block_index, 'content_block': {'type': 'tool_use', 'id': call.id, 'name': call.name, 'input': {}}})]
+        if call.pending:
+            events.append(self._delta(call, "".join(call.pending)))
+            call.pending = []
+        return events
+    
+    def _stop(self, call: StreamedToolCall) -> List[tuple]:
+        call.closed = True
+        if not call.validate():
+            STREAM_TOOL_ARGUMENTS_INVALID.inc((self.model,))
+            logger.warning(f"⚠️ Streamed arguments of tool call {call.name} ({call.id}) are not a complete JSON object")
+        return [("content_block_stop", {'type': 'content_block_stop', 'index': call.block_index})]
+
+async def stream_anthropic_events(response_generator, original_request: MessagesRequest):
+    """Convert streaming LiteLLM chunks into Anthropic (event type, data) pairs.
+
+    The event type None carries the final [DONE] marker.
+    """
     try:
         # Send message_start event
         message_id = f"msg_{uuid.uuid4().hex[:24]}"  # Format similar to Anthropic's IDs
@@ -910,41 +3160,33 @@ async def handle_streaming(response_generator, original_request: MessagesRequest
                 }
             }
         }
-        yield f"event: message_start\ndata: {json.dumps(message_data)}\n\n"
+        yield ("message_start", message_data)
         
         # Content block index for the first text block
-        yield f"event: content_block_start\ndata: {json.dumps({'type': 'content_block_start', 'index': 0, 'content_block': {'type': 'text', 'text': ''}})}\n\n"
+        yield ("content_block_start", {'type': 'content_block_start', 'index': 0, 'content_block': {'type': 'text', 'text': ''}})
         
         # Send a ping to keep the connection alive (Anthropic does this)
-        yield f"event: ping\ndata: {json.dumps({'type': 'ping'})}\n\n"
+        yield ("ping", {'type': 'ping'})
         
-        tool_index = None
-        current_tool_call = None
-        tool_content = ""
+        tool_calls = ToolCallStream(1, original_request.model)
         accumulated_text = ""  # Track accumulated text content
         text_sent = False  # Track if we've sent any text content
         text_block_closed = False  # Track if text block is closed
-        input_tokens = 0
-        output_tokens = 0
+        usage = {"output_tokens": 0}
         has_sent_stop_reason = False
-        last_tool_index = 0
-        last_ping = time.time()  # Track last ping time
-        PING_INTERVAL = 30  # Send ping every 30 seconds
+        stop_reason = "end_turn"
         
-        # Process each chunk
+        # Process each chunk (keep-alive pings are sent by stream_sse_events while waiting)
         async for chunk in response_generator:
             try:
-                # Send periodic keep-alive pings to prevent timeout
-                if time.time() - last_ping > PING_INTERVAL:
-                    yield f"event: ping\ndata: {json.dumps({'type': 'ping'})}\n\n"
-                    last_ping = time.time()
-                
                 # Check if this is the end of the response with usage data
                 if hasattr(chunk, 'usage') and chunk.usage is not None:
-                    if hasattr(chunk.usage, 'prompt_tokens'):
-                        input_tokens = chunk.usage.prompt_tokens
-                    if hasattr(chunk.usage, 'completion_tokens'):
-                        output_tokens = chunk.usage.completion_tokens
+                    usage = anthropic_usage(chunk.usage)
+                
+                # Chunks after the finish reason only matter for their usage, which
+                # OpenAI-compatible upstreams send in a chunk of its own
+                if has_sent_stop_reason:
+                    continue
                 
                 # Handle text content
                 if hasattr(chunk, 'choices') and len(chunk.choices) > 0:
@@ -974,9 +3216,9 @@ async def handle_streaming(response_generator, original_request: MessagesRequest
                         accumulated_text += delta_content
                         
                         # Always emit text deltas if no tool calls started
-                        if tool_index is None and not text_block_closed:
+                        if not tool_calls and not text_block_closed:
                             text_sent = True
-                            yield f"event: content_block_delta\ndata: {json.dumps({'type': 'content_block_delta', 'index': 0, 'delta': {'type': 'text_delta', 'text': delta_content}})}\n\n"
+                            yield ("content_block_delta", {'type': 'content_block_delta', 'index': 0, 'delta': {'type': 'text_delta', 'text': delta_content}})
                     
                     # Process tool calls
                     delta_tool_calls = None
@@ -990,24 +3232,24 @@ async def handle_streaming(response_generator, original_request: MessagesRequest
                     # Process tool calls if any
                     if delta_tool_calls:
                         # First tool call we've seen - need to handle text properly
-                        if tool_index is None:
+                        if not tool_calls:
                             # If we've been streaming text, close that text block
                             if text_sent and not text_block_closed:
                                 text_block_closed = True
-                                yield f"event: content_block_stop\ndata: {json.dumps({'type': 'content_block_stop', 'index': 0})}\n\n"
+                                yield ("content_block_stop", {'type': 'content_block_stop', 'index': 0})
                             # If we've accumulated text but not sent it, we need to emit it now
                             # This handles the case where the first delta has both text and a tool call
                             elif accumulated_text and not text_sent and not text_block_closed:
                                 # Send the accumulated text
                                 text_sent = True
-                                yield f"event: content_block_delta\ndata: {json.dumps({'type': 'content_block_delta', 'index': 0, 'delta': {'type': 'text_delta', 'text': accumulated_text}})}\n\n"
+                                yield ("content_block_delta", {'type': 'content_block_delta', 'index': 0, 'delta': {'type': 'text_delta', 'text': accumulated_text}})
                                 # Close the text block
                                 text_block_closed = True
-                                yield f"event: content_block_stop\ndata: {json.dumps({'type': 'content_block_stop', 'index': 0})}\n\n"
+                                yield ("content_block_stop", {'type': 'content_block_stop', 'index': 0})
                             # Close text block even if we haven't sent anything - models sometimes emit empty text blocks
                             elif not text_block_closed:
                                 text_block_closed = True
-                                yield f"event: content_block_stop\ndata: {json.dumps({'type': 'content_block_stop', 'index': 0})}\n\n"
+                                yield ("content_block_stop", {'type': 'content_block_stop', 'index': 0})
                                 
                         # Convert to list if it's not already
                         if not isinstance(delta_tool_calls, list):
@@ -1023,120 +3265,79 @@ async def handle_streaming(response_generator, original_request: MessagesRequest
                             else:
                                 current_index = 0
                             
-                            # Check if this is a new tool or a continuation
-                            if tool_index is None or current_index != tool_index:
-                                # New tool call - create a new tool_use block
-                                tool_index = current_index
-                                last_tool_index += 1
-                                anthropic_tool_index = last_tool_index
-                                
-                                # Extract function info
-                                if isinstance(tool_call, dict):
-                                    function = tool_call.get('function', {})
-                                    name = function.get('name', '') if isinstance(function, dict) else ""
-                                    tool_id = tool_call.get('id', f"toolu_{uuid.uuid4().hex[:24]}")
-                                else:
-                                    function = getattr(tool_call, 'function', None)
-                                    name = getattr(function, 'name', '') if function else ''
-                                    tool_id = getattr(tool_call, 'id', f"toolu_{uuid.uuid4().hex[:24]}")
-                                
-                                # Start a new tool_use block
-                                yield f"event: content_block_start\ndata: {json.dumps({'type': 'content_block_start', 'index': anthropic_tool_index, 'content_block': {'type': 'tool_use', 'id': tool_id, 'name': name, 'input': {}}})}\n\n"
-                                current_tool_call = tool_call
-                                tool_content = ""
-                            
-                            # Extract function arguments
-                            arguments = None
-                            if isinstance(tool_call, dict) and 'function' in tool_call:
-                                function = tool_call.get('function', {})
-                                arguments = function.get('arguments', '') if isinstance(function, dict) else ''
-                            elif hasattr(tool_call, 'function'):
+                            # Extract function info
+                            if isinstance(tool_call, dict):
+                                function = tool_call.get('function') or {}
+                                tool_id = tool_call.get('id')
+                                name = function.get('name') if isinstance(function, dict) else None
+                                arguments = function.get('arguments') if isinstance(function, dict) else None
+                            else:
                                 function = getattr(tool_call, 'function', None)
-                                arguments = getattr(function, 'arguments', '') if function else ''
+                                tool_id = getattr(tool_call, 'id', None)
+                                name = getattr(function, 'name', None)
+                                arguments = getattr(function, 'arguments', None)
+                            if isinstance(arguments, dict):
+                                arguments = json.dumps(arguments)
                             
-                            # If we have arguments, send them as a delta
-                            if arguments:
-                                # Try to detect if arguments are valid JSON or just a fragment
-                                try:
-                                    # If it's already a dict, use it
-                                    if isinstance(arguments, dict):
-                                        args_json = json.dumps(arguments)
-                                    else:
-                                        # Otherwise, try to parse it
-                                        json.loads(arguments)
-                                        args_json = arguments
-                                except (json.JSONDecodeError, TypeError):
-                                    # If it's a fragment, treat it as a string
-                                    args_json = arguments
-                                
-                                # Add to accumulated tool content
-                                tool_content += args_json if isinstance(args_json, str) else ""
-                                
-                                # Send the update
-                                yield f"event: content_block_delta\ndata: {json.dumps({'type': 'content_block_delta', 'index': anthropic_tool_index, 'delta': {'type': 'input_json_delta', 'partial_json': args_json}})}\n\n"
+                            # Fragments of interleaved calls are held until the open block is complete
+                            for event in tool_calls.feed(current_index, tool_id, name, arguments or ""):
+                                yield event
                     
                     # Process finish_reason - end the streaming response
                     if finish_reason and not has_sent_stop_reason:
                         has_sent_stop_reason = True
                         
-                        # Close any open tool call blocks
-                        if tool_index is not None:
-                            for i in range(1, last_tool_index + 1):
-                                yield f"event: content_block_stop\ndata: {json.dumps({'type': 'content_block_stop', 'index': i})}\n\n"
+                        # Close the open tool call block and stream any held back
+                        for event in tool_calls.close():
+                            yield event
                         
                         # If we accumulated text but never sent or closed text block, do it now
                         if not text_block_closed:
                             if accumulated_text and not text_sent:
                                 # Send the accumulated text
-                                yield f"event: content_block_delta\ndata: {json.dumps({'type': 'content_block_delta', 'index': 0, 'delta': {'type': 'text_delta', 'text': accumulated_text}})}\n\n"
+                                yield ("content_block_delta", {'type': 'content_block_delta', 'index': 0, 'delta': {'type': 'text_delta', 'text': accumulated_text}})
                             # Close the text block
-                            yield f"event: content_block_stop\ndata: {json.dumps({'type': 'content_block_stop', 'index': 0})}\n\n"
+                            yield ("content_block_stop", {'type': 'content_block_stop', 'index': 0})
                         
                         # Map OpenAI finish_reason to Anthropic stop_reason
-                        stop_reason = "end_turn"
                         if finish_reason == "length":
                             stop_reason = "max_tokens"
                         elif finish_reason == "tool_calls":
                             stop_reason = "tool_use"
-                        elif finish_reason == "stop":
-                            stop_reason = "end_turn"
-                        
-                        # Send message_delta with stop reason and usage
-                        usage = {"output_tokens": output_tokens}
                         
-                        yield f"event: message_delta\ndata: {json.dumps({'type': 'message_delta', 'delta': {'stop_reason': stop_reason, 'stop_sequence': None}, 'usage': usage})}\n\n"
-                        
-                        # Send message_stop event
-                        yield f"event: message_stop\ndata: {json.dumps({'type': 'message_stop'})}\n\n"
-                        
-                        # Send final [DONE] marker to match Anthropic's behavior
-                        yield "data: [DONE]\n\n"
-                        return
+                        # message_delta follows once the rest of the stream (its usage) is read
             except Exception as e:
                 # Log error but continue processing other chunks
                 logger.error(f"Error processing chunk: {str(e)}")
                 continue
         
+        if has_sent_stop_reason:
+            # Send message_delta with stop reason and the final usage, cached tokens included
+            yield ("message_delta", {'type': 'message_delta', 'delta': {'stop_reason': stop_reason, 'stop_sequence': None}, 'usage': usage})
+            
+            # Send message_stop event
+            yield ("message_stop", {'type': 'message_stop'})
+            
+            # Send final [DONE] marker to match Anthropic's behavior
+            yield (None, "[DONE]")
+        
         # If we didn't get a finish reason, close any open blocks
-        if not has_sent_stop_reason:
-            # Close any open tool call blocks
-            if tool_index is not None:
-                for i in range(1, last_tool_index + 1):
-                    yield f"event: content_block_stop\ndata: {json.dumps({'type': 'content_block_stop', 'index': i})}\n\n"
+        else:
+            # Close the open tool call block and stream any held back
+            for event in tool_calls.close():
+                yield event
             
             # Close the text content block
-            yield f"event: content_block_stop\ndata: {json.dumps({'type': 'content_block_stop', 'index': 0})}\n\n"
+            yield ("content_block_stop", {'type': 'content_block_stop', 'index': 0})
             
             # Send final message_delta with usage
-            usage = {"output_tokens": output_tokens}
-            
-            yield f"event: message_delta\ndata: {json.dumps({'type': 'message_delta', 'delta': {'stop_reason': 'end_turn', 'stop_sequence': None}, 'usage': usage})}\n\n"
+            yield ("message_delta", {'type': 'message_delta', 'delta': {'stop_reason': 'end_turn', 'stop_sequence': None}, 'usage': usage})
             
             # Send message_stop event
-            yield f"event: message_stop\ndata: {json.dumps({'type': 'message_stop'})}\n\n"
+            yield ("message_stop", {'type': 'message_stop'})
             
             # Send final [DONE] marker to match Anthropic's behavior
-            yield "data: [DONE]\n\n"
+            yield (None, "[DONE]")
     
     except Exception as e:
         import traceback
@@ -1145,27 +3346,823 @@ async def handle_streaming(response_generator, original_request: MessagesRequest
         logger.error(error_message)
         
         # Send error message_delta
-        yield f"event: message_delta\ndata: {json.dumps({'type': 'message_delta', 'delta': {'stop_reason': 'error', 'stop_sequence': None}, 'usage': {'output_tokens': 0}})}\n\n"
+        yield ("message_delta", {'type': 'message_delta', 'delta': {'stop_reason': 'error', 'stop_sequence': None}, 'usage': {'output_tokens': 0}})
         
         # Send message_stop event
-        yield f"event: message_stop\ndata: {json.dumps({'type': 'message_stop'})}\n\n"
+        yield ("message_stop", {'type': 'message_stop'})
         
         # Send final [DONE] marker
-        yield "data: [DONE]\n\n"
+        yield (None, "[DONE]")
+    
+    finally:
+        # Release the upstream connection promptly, e.g. when the client went away
+        aclose = getattr(response_generator, "aclose", None)
+        if aclose is not None:
+            try:
+                await aclose()
+            except Exception as e:
+                logger.debug(f"Error closing upstream stream: {e}")
+
+def format_sse(event_type: Optional[str], data: Any) -> str:
+    """Serialize one event as an SSE frame (event type None is the bare [DONE] marker)."""
+    if event_type is None:
+        return f"data: {data}\n\n"
+    return f"event: {event_type}\ndata: {json.dumps(data)}\n\n"
+
+class SSEDeltaCoalescer:
+    """Merges consecutive content_block_delta events for the same block into fewer SSE frames.
+    
+    A buffered delta is released as soon as any other event arrives, when it reaches
+    max_bytes of UTF-8 text, or when its first fragment has been held longer than the flush window.
+    Events are never reordered, so the Anthropic event sequence stays valid.
+    """
+    DELTA_FIELDS = {"text_delta": "text", "input_json_delta": "partial_json"}
+    
+    def __init__(self, window: float, max_bytes: int):
+        self.window = window
+        self.max_bytes = max_bytes
+        self.index = None
+        self.delta_type = None
+        self.parts: List[str] = []
+        self.size = 0
+        self.started = 0.0
+    
+    def push(self, event_type: Optional[str], data: Any) -> List[tuple]:
+        """Add an event; returns the events that are ready to be sent."""
+        delta = data.get("delta") if event_type == "content_block_delta" else None
+        field = self.DELTA_FIELDS.get(delta.get("type")) if isinstance(delta, dict) else None
+        if field is None:
+            # Anything else is a boundary: release the buffered delta first
+            return self.flush() + [(event_type, data)]
+        
+        ready = []
+        if self.parts and (data["index"] != self.index or delta["type"] != self.delta_type):
+            ready.extend(self.flush())
+        if not self.parts:
+            self.index = data["index"]
+            self.delta_type = delta["type"]
+            self.started = time.monotonic()
+        fragment = delta.get(field) or ""
+        self.parts.append(fragment)
+        # UTF-8 bytes; isascii() is O(1), so only non-ASCII text is encoded to count them
+        self.size += len(fragment) if fragment.isascii() else len(fragment.encode())
+        if self.size >= self.max_bytes or time.monotonic() - self.started >= self.window:
+            ready.extend(self.flush())
+        return ready
+    
+    def flush_if_due(self) -> List[tuple]:
+        """Release the buffered delta if its flush window has passed."""
+        if self.parts and time.monotonic() - self.started >= self.window:
+            return self.flush()
+        return []
+    
+    def flush(self) -> List[tuple]:
+        """Release the buffered delta, if any, as a single event."""
+        if not self.parts:
+            return []
+        field = self.DELTA_FIELDS[self.delta_type]
+        merged = ("content_block_delta", {
+            'type': 'content_block_delta',
+            'index': self.index,
+            'delta': {'type': self.delta_type, field: "".join(self.parts)}
+        })
+        self.parts = []
+        self.size = 0
+        return [merged]
 
-@app.post("/v1/messages")
-async def create_message(
-    request: MessagesRequest,
-    raw_request: Request
-):
+class StreamPumpStats:
+    """Process-wide counters for streaming pumps."""
+    def __init__(self):
+        self.streams = 0
+        self.active_streams = 0
+        self.queued_events = 0  # Events currently buffered across all streams
+        self.max_queue_depth = 0  # Deepest single-stream queue seen
+        self.producer_stall_seconds = 0.0  # Upstream reads paused by a slow client
+        self.consumer_wait_seconds = 0.0  # Client writes waiting on a slow upstream
+        self.idle_pings = 0
+
+stream_pump_stats = StreamPumpStats()
+
+PUMP_IDLE = object()  # Nothing arrived before the timeout
+PUMP_END = object()  # The source is exhausted
+
+class StreamPump:
+    """Runs an async event source on its own task, buffering into a bounded queue.
+    
+    The producer keeps reading upstream while the client is busy, up to max_events
+    or max_bytes buffered for this stream; beyond that it waits, which is the
+    backpressure towards upstream. The consumer waits with a timeout, so it gets
+    control back (for pings and flushes) even while upstream is silent.
+    """
+    def __init__(self, source, max_events: int, max_bytes: int, stats: StreamPumpStats = stream_pump_stats):
+        self.source = source
+        self.max_events = max_events
+        self.max_bytes = max_bytes
+        self.stats = stats
+        self.buffer = deque()
+        self.buffered_bytes = 0
+        self.max_depth = 0
+        self.done = False
+        self.error: Optional[BaseException] = None
+        self._data_ready = asyncio.Event()
+        self._space_ready = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+    
+    @staticmethod
+    def event_size(event: tuple) -> int:
+        """Rough memory footprint of a buffered event."""
+        event_type, data = event
+        if event_type == "content_block_delta":
+            delta = data.get("delta", {})
+            return 64 + len(delta.get("text") or delta.get("partial_json") or "")
+        return 64
+    
+    def start(self):
+        self.stats.streams += 1
+        self.stats.active_streams += 1
+        self._task = asyncio.create_task(self._produce())
+    
+    async def _produce(self):
+        try:
+            async for event in self.source:
+                size = self.event_size(event)
+                # Wait for the consumer while this stream is at its memory cap
+                while self.buffer and (len(self.buffer) >= self.max_events or self.buffered_bytes + size > self.max_bytes):
+                    self._space_ready.clear()
+                    stall_start = time.monotonic()
+                    await self._space_ready.wait()
+                    self.stats.producer_stall_seconds += time.monotonic() - stall_start
+                self.buffer.append((event, size))
+                self.buffered_bytes += size
+                self.stats.queued_events += 1
+                if len(self.buffer) > self.max_depth:
+                    self.max_depth = len(self.buffer)
+                    self.stats.max_queue_depth = max(self.stats.max_queue_depth, self.max_depth)
+                self._data_ready.set()
+        except Exception as e:
+            self.error = e
+        finally:
+            self.done = True
+            self._data_ready.set()
+    
+    async def get(self, timeout: Optional[float] = None):
+        """Next event, PUMP_IDLE if none arrived within timeout, or PUMP_END."""
+        if not self.buffer and not self.done:
+            self._data_ready.clear()
+            wait_start = time.monotonic()
+            try:
+                await asyncio.wait_for(self._data_ready.wait(), timeout)
+            except asyncio.TimeoutError:
+                return PUMP_IDLE
+            finally:
+                self.stats.consumer_wait_seconds += time.monotonic() - wait_start
+        if self.buffer:
+            event, size = self.buffer.popleft()
+            self.buffered_bytes -= size
+            self.stats.queued_events -= 1
+            self._space_ready.set()
+            return event
+        if self.error is not None:
+            raise self.error
+        return PUMP_END
+    
+    async def close(self):
+        """Stop the producer (closing the source) and drop anything still buffered."""
+        if self._task is not None and not self._task.done():
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+        self.stats.queued_events -= len(self.buffer)
+        self.buffer.clear()
+        if self._task is not None:
+            self.stats.active_streams -= 1
+            self._task = None
+        logger.debug(f"Stream pump closed: max queue depth {self.max_depth}")
+
+async def stream_sse_events(events):
+    """Write (event type, data) pairs from an async source as SSE frames.
+
+    The source is read on a separate pump task; this side writes frames, sends
+    keep-alive pings on a timer and flushes coalesced deltas.
+    """
+    pump = StreamPump(events, STREAM_QUEUE_MAX_EVENTS, STREAM_QUEUE_MAX_BYTES)
+    # Opt-in: merge small text/tool-input fragments into fewer, larger frames
+    coalescer = None
+    if SSE_COALESCE_WINDOW_MS > 0:
+        coalescer = SSEDeltaCoalescer(SSE_COALESCE_WINDOW_MS / 1000, SSE_COALESCE_MAX_BYTES)
+    pump.start()
     try:
-        # Debug: print the body to see what Claude Code is sending
-        body = await raw_request.body()
+        last_write = time.monotonic()
+        while True:
+            now = time.monotonic()
+            timeout = max(0.0, last_write + SSE_PING_INTERVAL - now)
+            if coalescer is not None and coalescer.parts:
+                timeout = min(timeout, max(0.0, coalescer.started + coalescer.window - now))
+            
+            event = await pump.get(timeout)
+            if event is PUMP_END:
+                break
+            if event is PUMP_IDLE:
+                ready = coalescer.flush_if_due() if coalescer is not None else []
+                if not ready and time.monotonic() - last_write >= SSE_PING_INTERVAL:
+                    # Send periodic keep-alive pings to prevent timeout, even if upstream is silent
+                    stream_pump_stats.idle_pings += 1
+                    ready = [("ping", {'type': 'ping'})]
+            elif coalescer is not None:
+                ready = coalescer.push(*event)
+            else:
+                ready = [event]
+            
+            for ready_event in ready:
+                yield format_sse(*ready_event)
+            if ready:
+                last_write = time.monotonic()
+        
+        if coalescer is not None:
+            for ready_event in coalescer.flush():
+                yield format_sse(*ready_event)
+    finally:
+        await pump.close()
+
+# Stop reasons of complete responses; anything else (errors, aborted streams) is not cached
+CACHEABLE_STOP_REASONS = {"end_turn", "max_tokens", "stop_sequence", "tool_use"}
+
+# Request fields that do not change the response
+FINGERPRINT_IGNORED_FIELDS = {"api_key", "api_base", "timeout", "request_timeout", "client"}
+
+def request_fingerprint(litellm_request: Dict[str, Any]) -> Optional[str]:
+    """SHA-256 of a translated request, or None if its response is not deterministic."""
+    if litellm_request.get("temperature") != 0:
+        return None
+    canonical = {k: v for k, v in litellm_request.items() if k not in FINGERPRINT_IGNORED_FIELDS}
+    payload = json.dumps(canonical, sort_keys=True, separators=(",", ":"), default=str)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+class ResponseCache:
+    """Responses to deterministic requests, in a memory LRU and an optional disk tier.
+    
+    Keys are request fingerprints, so they are stable across restarts. Entries hold either the stored
+    MessagesResponse or the Anthropic events of a complete stream, and expire after
+    ttl seconds. The disk tier keeps one JSON file per entry and evicts the oldest
+    files once it grows past max_disk_bytes.
+    """
+    def __init__(self, max_entries: int, directory: Optional[str], ttl: float, max_disk_bytes: int):
+        self.memory = LRUCache(max_entries)
+        self.directory = directory
+        self.ttl = ttl
+        self.max_disk_bytes = max_disk_bytes
+        self.disk_bytes: Optional[int] = None  # Measured on first write
+        # Disk reads and writes run in worker threads; size accounting and eviction take turns
+        self._disk_lock = threading.Lock()
+        self.disk_hits = 0
+        self.stores = 0
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+    
+    @property
+    def enabled(self) -> bool:
+        return self.memory.max_entries > 0 or bool(self.directory)
+    
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, f"{key}.json")
+    
+    def _fresh(self, entry: Dict[str, Any]) -> bool:
+        return time.time() - entry["created"] < self.ttl
+    
+    async def get(self, key: str) -> Optional[Dict[str, Any]]:
+        entry = self.memory.get(key)
+        if entry is not None:
+            if self._fresh(entry):
+                return entry
+            self.memory.pop(key)
+        if not self.directory:
+            return None
+        entry = await asyncio.to_thread(self._read_disk, key)
+        if entry is None:
+            return None
+        self.disk_hits += 1
+        self.memory.put(key, entry)
+        return entry
+    
+    async def put(self, key: str, entry: Dict[str, Any]):
+        entry = {**entry, "created": time.time()}
+        self.memory.put(key, entry)
+        self.stores += 1
+        if self.directory:
+            await asyncio.to_thread(self._write_disk, key, entry)
+    
+    def _read_disk(self, key: str) -> Optional[Dict[str, Any]]:
+        try:
+            with open(self._path(key), "r", encoding="utf-8") as f:
+                entry = json.load(f)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError) as e:
+            logger.warning(f"Unreadable response cache entry {key}: {e}")
+            return None
+        if not self._fresh(entry):
+            self._remove_disk(key)
+            return None
+        return entry
+    
+    def _write_disk(self, key: str, entry: Dict[str, Any]):
+        try:
+            data = json.dumps(entry).encode("utf-8")
+            # Write to a temporary file and rename, so readers never see a partial entry
+            fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            with self._disk_lock:
+                if self.disk_bytes is None:
+                    self.disk_bytes = sum(e.stat().st_size for e in os.scandir(self.directory) if e.name.endswith(".json"))
+                previous = os.path.getsize(self._path(key)) if os.path.exists(self._path(key)) else 0
+                os.replace(tmp_path, self._path(key))
+                self.disk_bytes += len(data) - previous
+                if self.disk_bytes > self.max_disk_bytes:
+                    self._evict_disk()
+        except OSError as e:
+            logger.warning(f"Could not write response cache entry {key}: {e}")
     
-        # Parse the raw body as JSON since it's bytes
-        body_json = json.loads(body.decode('utf-8'))
-        original_model = body_json.get("model", "unknown")
+    def _remove_disk(self, key: str):
+        with self._disk_lock:
+            self._unlink_disk(key)
+    
+    def _unlink_disk(self, key: str):
+        """Remove an entry file; the caller holds _disk_lock."""
+        try:
+            size = os.path.getsize(self._path(key))
+            os.remove(self._path(key))
+            if self.disk_bytes is not None:
+                self.disk_bytes -= size
+        except OSError:
+            pass
+    
+    def _evict_disk(self):
+        """Remove the oldest entries until the disk tier is back under 90% of its cap; the caller holds _disk_lock."""
+        files = sorted(
+            (e for e in os.scandir(self.directory) if e.name.endswith(".json")),
+            key=lambda e: e.stat().st_mtime
+        )
+        for entry in files:
+            if self.disk_bytes <= self.max_disk_bytes * 0.9:
+                break
+            self._unlink_disk(entry.name[:-len(".json")])
+    
+    def stats(self) -> Dict[str, Any]:
+        return {**self.memory.stats(), "disk_hits": self.disk_hits, "stores": self.stores, "disk_bytes": self.disk_bytes}
+
+response_cache = ResponseCache(
+    RESPONSE_CACHE_SIZE,
+    RESPONSE_CACHE_DIR,
+    RESPONSE_CACHE_TTL,
+    int(RESPONSE_CACHE_MAX_DISK_MB * 1024 * 1024)
+)
+
+async def record_stream_events(events, cache_key: str):
+    """Pass events through, storing them in the response cache if the stream completes."""
+    recorded = []
+    stop_reason = None
+    async for event in events:
+        recorded.append(event)
+        if event[0] == "message_delta":
+            stop_reason = event[1].get("delta", {}).get("stop_reason")
+        yield event
+    if stop_reason in CACHEABLE_STOP_REASONS:
+        await response_cache.put(cache_key, {"events": recorded})
+
+def with_fresh_message_id(event: tuple) -> tuple:
+    """Give a replayed message_start event a new message id."""
+    event_type, data = event
+    if event_type == "message_start":
+        data = {**data, "message": {**data["message"], "id": f"msg_{uuid.uuid4().hex[:24]}"}}
+    return (event_type, data)
+
+async def replay_stream_events(events: List[Any]):
+    """Replay cached stream events under a fresh message id."""
+    for event in events:
+        yield with_fresh_message_id(event)
+
+# Sent to clients of a broadcast whose upstream stream ended without message_stop
+STREAM_INTERRUPTED_EVENT = ("error", {'type': 'error', 'error': {'type': 'api_error', 'message': 'Upstream stream ended unexpectedly'}})
+
+class BroadcastReader:
+    """One client's position in a StreamBroadcast.
+    
+    It holds the broadcast open from the moment it is created, before the upstream
+    stream is even open. It lets go when its events() iterator finishes, or is
+    dropped without ever being iterated.
+    """
+    def __init__(self, broadcast: "StreamBroadcast", fresh_message_id: bool):
+        self.broadcast = broadcast
+        self.fresh_message_id = fresh_message_id
+        self.position = 0  # Index of the next event in the whole stream
+        self.closed = False
+        broadcast.readers.add(self)
+    
+    def events(self):
+        events = self._events()
+        weakref.finalize(events, self.close)
+        return events
+    
+    async def _events(self):
+        broadcast = self.broadcast
+        try:
+            while True:
+                if self.position < broadcast.base + len(broadcast.events):
+                    event = broadcast.events[self.position - broadcast.base]
+                    self.position += 1
+                    broadcast.advanced()
+                    yield with_fresh_message_id(event) if self.fresh_message_id else event
+                elif broadcast.done:
+                    return
+                else:
+                    broadcast.changed.clear()
+                    await broadcast.changed.wait()
+        finally:
+            self.close()
+    
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            self.broadcast.detach(self)
+
+class StreamBroadcast:
+    """Reads one stream's events on its own task and replays them to every reader.
+    
+    While the stream fits in max_events / max_bytes, every event is kept, so readers
+    that join late start from the first one. Once it outgrows them, on_closed is
+    called (no more readers may join) and events are dropped as soon as every reader
+    has them; upstream reads then wait for the slowest reader, as in StreamPump. The
+    upstream stream is closed once the last reader goes away.
+    """
+    def __init__(self, open_events, on_closed, max_events: int = STREAM_QUEUE_MAX_EVENTS, max_bytes: int = STREAM_QUEUE_MAX_BYTES):
+        self.events: List[tuple] = []
+        self.sizes: deque = deque()
+        self.base = 0  # Index in the whole stream of events[0]
+        self.buffered_bytes = 0
+        self.max_events = max_events
+        self.max_bytes = max_bytes
+        self.joinable = True
+        self.done = False
+        self.readers: set = set()
+        self.ready = asyncio.get_running_loop().create_future()  # Set once upstream is open
+        self.changed = asyncio.Event()
+        self._on_closed = on_closed
+        self._space = asyncio.Event()
+        self._space.set()  # Cleared while upstream reads wait for the slowest reader
+        self._task = asyncio.create_task(self._run(open_events))
+    
+    async def _run(self, open_events):
+        source = None
+        stopped = False
+        try:
+            try:
+                source = await open_events()
+            except Exception as e:
+                self.ready.set_exception(e)
+                return
+            self.ready.set_result(None)
+            async for event in source:
+                size = StreamPump.event_size(event)
+                if self.joinable and self._full(size):
+                    self.joinable = False
+                    self._on_closed(self)
+                while self._full(size):
+                    self._trim()
+                    if not self._full(size):
+                        break
+                    self._space.clear()
+                    await self._space.wait()
+                self.events.append(event)
+                self.sizes.append(size)
+                self.buffered_bytes += size
+                stopped = stopped or event[0] == "message_stop"
+                self.changed.set()
+        except Exception as e:
+            logger.error(f"Broadcast stream failed: {e}")
+        finally:
+            if source is not None and not stopped:
+                self.events.append(STREAM_INTERRUPTED_EVENT)
+                self.sizes.append(StreamPump.event_size(STREAM_INTERRUPTED_EVENT))
+            self.done = True
+            self.joinable = False
+            self.changed.set()
+            self._on_closed(self)
+            if source is not None and hasattr(source, "aclose"):
+                await source.aclose()
+    
+    def _full(self, size: int) -> bool:
+        return bool(self.events) and (len(self.events) >= self.max_events or self.buffered_bytes + size > self.max_bytes)
+    
+    def _trim(self):
+        """Drop the events every reader has, once no reader can join any more."""
+        if self.joinable or not self.readers:
+            return
+        drop = min(reader.position for reader in self.readers) - self.base
+        if drop > 0:
+            del self.events[:drop]
+            for _ in range(drop):
+                self.buffered_bytes -= self.sizes.popleft()
+            self.base += drop
+            self._space.set()
+    
+    def advanced(self):
+        # Only while upstream reads wait for space, so a fast stream is not trimmed event by event
+        if not self._space.is_set():
+            self._trim()
+    
+    def detach(self, reader: BroadcastReader):
+        self.readers.discard(reader)
+        if not self.readers and not self.done:
+            self._task.cancel()
+        else:
+            self._trim()
+
+class SingleFlight:
+    """Shares one upstream call between identical requests that are in flight together."""
+    def __init__(self):
+        self.calls: Dict[str, asyncio.Task] = {}
+        self.streams: Dict[str, StreamBroadcast] = {}
+        self.upstream_calls = 0
+        self.coalesced_calls = 0  # Upstream calls saved
+    
+    async def call(self, key: str, func) -> tuple:
+        """Run func() once per key in flight; returns (result, whether this caller ran it)."""
+        task = self.calls.get(key)
+        leader = task is None
+        if leader:
+            task = asyncio.create_task(func())
+            self.calls[key] = task
+            self.upstream_calls += 1
+            task.add_done_callback(functools.partial(self._call_done, key))
+        else:
+            self.coalesced_calls += 1
+            logger.debug(f"🔗 Joined in-flight request {key[:12]}")
+        # Shielded: a caller that goes away does not cancel the call for the others
+        return await asyncio.shield(task), leader
+    
+    def _call_done(self, key: str, task: asyncio.Task):
+        if self.calls.get(key) is task:
+            del self.calls[key]
+        if not task.cancelled():
+            task.exception()  # Retrieved here in case every caller went away
+    
+    async def stream(self, key: str, open_events) -> tuple:
+        """Attach to the broadcast for key, starting it with open_events() if there is none.
         
+        Returns (this caller's events, whether it started the broadcast) once upstream is open.
+        """
+        broadcast = self.streams.get(key)
+        leader = broadcast is None
+        if leader:
+            broadcast = StreamBroadcast(open_events, functools.partial(self._stream_done, key))
+            self.streams[key] = broadcast
+            self.upstream_calls += 1
+        else:
+            self.coalesced_calls += 1
+            logger.debug(f"🔗 Joined in-flight stream {key[:12]}")
+        # Attached before waiting, so the leader going away cannot close upstream under it
+        reader = BroadcastReader(broadcast, fresh_message_id=not leader)
+        try:
+            await asyncio.shield(broadcast.ready)
+        except BaseException:
+            reader.close()
+            raise
+        return reader.events(), leader
+    
+    def _stream_done(self, key: str, broadcast: StreamBroadcast):
+        if self.streams.get(key) is broadcast:
+            del self.streams[key]
+    
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "in_flight": len(self.calls) + len(self.streams),
+            "upstream_calls": self.upstream_calls,
+            "coalesced_calls": self.coalesced_calls,
+        }
+
+single_flight = SingleFlight()
+
+# Token counts of single translated messages keyed by (model, image limits, message
+# digest), and of whole count_tokens requests keyed by (model, body digest)
+message_token_cache = LRUCache(TOKEN_COUNT_CACHE_SIZE)
+token_count_request_cache = LRUCache(TOKEN_COUNT_REQUEST_CACHE_SIZE)
+_token_count_adjustments: Dict[str, int] = {}
+
+def count_litellm_tokens(model: str, message_groups: List[List[Dict[str, Any]]]) -> List[int]:
+    """Count the tokens of each group of LiteLLM messages separately."""
+    from litellm import token_counter
+    return [token_counter(model=model, messages=group) for group in message_groups]
+
+def token_count_adjustment(model: str) -> int:
+    """Per-message correction when summing separately counted messages.
+
+    Each token_counter call adds the reply priming once, so counting messages one
+    by one over-counts by a constant for every message after the first.
+    """
+    if model not in _token_count_adjustments:
+        first = {"role": "user", "content": "a"}
+        second = {"role": "user", "content": "b"}
+        pair, single_first, single_second = count_litellm_tokens(model, [[first, second], [first], [second]])
+        _token_count_adjustments[model] = pair - single_first - single_second
+    return _token_count_adjustments[model]
+
+def estimate_message_chars(messages: List[Dict[str, Any]]) -> int:
+    """Rough size of a group of LiteLLM messages, used to decide where to tokenize it."""
+    total = 0
+    for message in messages:
+        content = message.get("content")
+        if isinstance(content, str):
+            total += len(content)
+        elif isinstance(content, list):
+            for block in content:
+                if isinstance(block, dict):
+                    total += len(block.get("text") or "")
+                    nested = block.get("content")
+                    if isinstance(nested, str):
+                        total += len(nested)
+                    elif nested is not None:
+                        total += estimate_message_chars([{"content": nested}])
+    return total
+
+def preload_tokenizers(models: List[str]):
+    """Load the tokenizers for the given models by counting a tiny message with each."""
+    for model in models:
+        try:
+            count_litellm_tokens(model, [[{"role": "user", "content": "warm up"}]])
+            token_count_adjustment(model)
+        except Exception as e:
+            logger.warning(f"Could not preload tokenizer for {model}: {e}")
+
+class TokenizerEngine:
+    """Token counting with preloaded tokenizers; large jobs run in a process pool.
+    
+    Small jobs are counted inline, where a pool round trip would cost more than the
+    tokenization itself. If the pool is disabled or breaks, everything falls back
+    to LiteLLM's token_counter on the event loop.
+    """
+    def __init__(self, workers: int, inline_max_chars: int):
+        self.workers = workers
+        self.inline_max_chars = inline_max_chars
+        self.pool: Optional[ProcessPoolExecutor] = None
+        self.inline_jobs = 0
+        self.offloaded_jobs = 0
+        self.pool_failures = 0
+    
+    def start(self, models: List[str]):
+        """Preload tokenizers here and in the worker processes."""
+        preload_tokenizers(models)
+        if self.workers > 0 and self.pool is None:
+            try:
+                # spawn: forking a process that runs an event loop and threads is not safe
+                self.pool = ProcessPoolExecutor(
+                    max_workers=self.workers,
+                    mp_context=multiprocessing.get_context("spawn"),
+                    initializer=preload_tokenizers,
+                    initargs=(models,)
+                )
+                logger.info(f"🔢 Tokenizer pool started with {self.workers} workers for {', '.join(models)}")
+            except Exception as e:
+                logger.warning(f"Could not start tokenizer process pool, counting inline: {e}")
+                self.pool = None
+    
+    def shutdown(self):
+        if self.pool is not None:
+            self.pool.shutdown(wait=False, cancel_futures=True)
+            self.pool = None
+    
+    async def count(self, model: str, message_groups: List[List[Dict[str, Any]]]) -> List[int]:
+        """Count the tokens of each group of LiteLLM messages."""
+        pool = self.pool
+        if pool is not None and sum(estimate_message_chars(group) for group in message_groups) > self.inline_max_chars:
+            try:
+                loop = asyncio.get_running_loop()
+                counts = await loop.run_in_executor(pool, count_litellm_tokens, model, message_groups)
+                self.offloaded_jobs += 1
+                return counts
+            except (BrokenProcessPool, pickle.PicklingError, OSError, RuntimeError) as e:
+                self.pool_failures += 1
+                logger.warning(f"Tokenizer pool failed ({e}), falling back to inline counting")
+                if pool is self.pool:
+                    self.shutdown()
+        self.inline_jobs += 1
+        return count_litellm_tokens(model, message_groups)
+
+tokenizer_engine = TokenizerEngine(TOKENIZER_PROCESS_WORKERS, TOKENIZER_INLINE_MAX_CHARS)
+
+async def count_message_tokens(model: str, system: Optional[Union[str, List[SystemContent]]], messages: List[Message],
+                               image_limits: Optional[tuple] = IMAGE_LIMITS) -> int:
+    """Count prompt tokens as a sum of per-message counts, only tokenizing messages not seen before.
+
+    Images are counted as they are sent within image_limits, see route_image_limits.
+    """
+    units = []  # (cache key, message) for the system prompt and every conversation message
+    system_message = convert_system_to_litellm(system)
+    if system_message:
+        units.append(((model, "system", content_digest(system_message["content"].encode())), system_message))
+    for msg in messages:
+        digest = content_digest(pickle.dumps(message_key(msg), pickle.HIGHEST_PROTOCOL))
+        units.append(((model, image_limits, digest), msg))
+    
+    counts = [message_token_cache.get(key) for key, _ in units]
+    missing = [i for i, count in enumerate(counts) if count is None]
+    if missing:
+        await prepare_images([units[i][1] for i in missing if not isinstance(units[i][1], dict)], image_limits)
+        groups = []
+        for i in missing:
+            unit = units[i][1]
+            groups.append([unit] if isinstance(unit, dict) else translate_conversation([unit], image_limits=image_limits))
+        for i, count in zip(missing, await tokenizer_engine.count(model, groups)):
+            counts[i] = count
+            message_token_cache.put(units[i][0], count)
+    
+    if not counts:
+        return count_litellm_tokens(model, [[]])[0]
+    return sum(counts) + token_count_adjustment(model) * (len(counts) - 1)
+
+def route_image_limits(route: Route) -> Optional[tuple]:
+    """(max_dimension, max_bytes) of the images sent to route, None if it gets none."""
+    if not (route.image_input if route.image_input is not None else IMAGE_INPUT):
+        return None
+    return (
+        route.image_max_dimension if route.image_max_dimension is not None else IMAGE_MAX_DIMENSION,
+        route.image_max_bytes if route.image_max_bytes is not None else IMAGE_MAX_BYTES,
+    )
+
+def compact_route_messages(messages: List[Message], route: Route) -> tuple:
+    """compact_tool_results within route's budget; returns (messages, {action: tokens saved})."""
+    compaction = route.tool_result_compaction if route.tool_result_compaction is not None else TOOL_RESULT_COMPACTION
+    if not compaction:
+        return messages, {}
+    max_tokens = route.tool_result_max_tokens or TOOL_RESULT_MAX_TOKENS
+    return compact_tool_results(messages, max_tokens, TOOL_RESULT_KEEP_TURNS, TOOL_RESULT_STALE_TURNS)
+
+def compact_request(request: MessagesRequest, route: Route) -> MessagesRequest:
+    """request with its old tool results compacted for route, once per client request and target.
+    
+    The copy keeps the client's messages, so that fallback targets start from them
+    with their own budget.
+    """
+    client_messages = request._client_messages or request.messages
+    messages, saved = compact_route_messages(client_messages, route)
+    if not saved:
+        return request
+    for action, tokens in saved.items():
+        TOOL_RESULT_TOKENS_SAVED.inc((route.model, action), tokens)
+    logger.info(f"🗜️ Tool result compaction saved ~{sum(saved.values())} tokens for {route.model} ({saved})")
+    compacted = request.model_copy(update={"messages": messages})
+    compacted._client_messages = client_messages
+    return compacted
+
+def build_upstream_request(request: MessagesRequest, route: Route) -> tuple:
+    """Translate request for route's model and add the call parameters.
+    
+    Returns (litellm_request, route), the route narrowed to the api_base the load
+    balancer picked for this call.
+    """
+    translation_start = time.perf_counter()
+    
+    # Convert Anthropic request to LiteLLM format
+    # For OpenAI models, content blocks are flattened to plain strings as they go
+    litellm_request = convert_anthropic_to_litellm(
+        request,
+        flatten_for_openai="openai" in request.model,
+        native_tool_calls=route.native_tool_calls if route.native_tool_calls is not None else OPENAI_NATIVE_TOOL_CALLS,
+        image_limits=route_image_limits(route)
+    )
+    TRANSLATION_TIME.observe(("request", request.model), time.perf_counter() - translation_start)
+    
+    # Add timeout configuration for long conversations
+    litellm_request["timeout"] = REQUEST_TIMEOUT
+    litellm_request["request_timeout"] = REQUEST_TIMEOUT
+    # The OpenAI SDK would otherwise retry twice on its own, outside the retry budget
+    litellm_request["max_retries"] = 0
+    # OpenAI-compatible streams only report usage (with cached tokens) when asked to
+    if request.stream and "openai" in (route.provider, route.custom_llm_provider):
+        litellm_request["stream_options"] = {"include_usage": True}
+    
+    # Provider, API key and custom API base come from the resolved model route; routes
+    # with several api_bases get the one the load balancer picks for this request
+    if route.api_bases:
+        route = route.model_copy(update={"api_base": upstream_balancer.pick(route)})
+    litellm_request.update(route.litellm_params())
+    
+    # Async calls share a long-lived connection pool per api_base (the thread mode
+    # uses LiteLLM's synchronous clients)
+    if request.stream or UPSTREAM_CALL_MODE == "async":
+        pooled_client = upstream_pools.client_for(route)
+        if pooled_client is not None:
+            litellm_request["client"] = pooled_client
+    return litellm_request, route
+
+@app.post("/v1/messages", openapi_extra=request_body_openapi(MessagesRequest))
+async def create_message(raw_request: Request):
+    # Decode and validate the body in a single pass; this also keeps the original model name
+    request = await parse_request_body(raw_request, MessagesRequest)
+    try:
+        original_model = request.original_model or request.model
         
         # Get the display name for logging, just the model name without provider prefix
         display_model = original_model
@@ -1180,166 +4177,22 @@ async def create_message(
             clean_model = clean_model[len("openai/"):]
         
         
-        # Convert Anthropic request to LiteLLM format
-        litellm_request = convert_anthropic_to_litellm(request)
-        
-        # Add timeout configuration for long conversations
-        litellm_request["timeout"] = 600  # 10 minutes
-        litellm_request["request_timeout"] = 600
-        
-        # Determine which API key to use based on the model
-        if request.model.startswith("openai/"):
-            litellm_request["api_key"] = OPENAI_API_KEY
-            # Add custom API base URL if provided
-            if OPENAI_API_BASE:
-                litellm_request["api_base"] = OPENAI_API_BASE
-        elif request.model.startswith("gemini/"):
-            litellm_request["api_key"] = GEMINI_API_KEY
-        elif request.model.startswith("anthropic/"):
-            # For Anthropic models routed through litellm proxy, use OpenAI credentials
-            litellm_request["api_key"] = OPENAI_API_KEY
-            if OPENAI_API_BASE:
-                litellm_request["api_base"] = OPENAI_API_BASE
-            # Force the provider to be openai so litellm uses OpenAI-compatible endpoints
-            litellm_request["custom_llm_provider"] = "openai"
-        else:
-            litellm_request["api_key"] = ANTHROPIC_API_KEY
+        # Old tool results may be shrunk first, once per request (fallback targets are
+        # compacted for their own budget only if needed)
+        request = compact_request(request, request.route)
         
-        # For OpenAI models - modify request format to work with limitations
-        if "openai" in litellm_request["model"] and "messages" in litellm_request:
-            
-            # For OpenAI models, we need to convert content blocks to simple strings
-            # and handle other requirements
-            for i, msg in enumerate(litellm_request["messages"]):
-                # Special case - handle message content directly when it's a list of tool_result
-                # This is a specific case we're seeing in the error
-                if "content" in msg and isinstance(msg["content"], list):
-                    is_only_tool_result = True
-                    for block in msg["content"]:
-                        if not isinstance(block, dict) or block.get("type") != "tool_result":
-                            is_only_tool_result = False
-                            break
-                    
-                    if is_only_tool_result and len(msg["content"]) > 0:
-                        logger.warning(f"Found message with only tool_result content - special handling required")
-                        # Extract the content from all tool_result blocks
-                        all_text = ""
-                        for block in msg["content"]:
-                            all_text += "Tool Result:\n"
-                            result_content = block.get("content", [])
-                            
-                            # Handle different formats of content
-                            if isinstance(result_content, list):
-                                for item in result_content:
-                                    if isinstance(item, dict) and item.get("type") == "text":
-                                        all_text += item.get("text", "") + "\n"
-                                    elif isinstance(item, dict):
-                                        # Fall back to string representation of any dict
-                                        try:
-                                            item_text = item.get("text", json.dumps(item))
-                                            all_text += item_text + "\n"
-                                        except:
-                                            all_text += str(item) + "\n"
-                            elif isinstance(result_content, str):
-                                all_text += result_content + "\n"
-                            else:
-                                try:
-                                    all_text += json.dumps(result_content) + "\n"
-                                except:
-                                    all_text += str(result_content) + "\n"
-                        
-                        # Replace the list with extracted text
-                        litellm_request["messages"][i]["content"] = all_text.strip() or "..."
-                        logger.warning(f"Converted tool_result to plain text: {all_text.strip()[:200]}...")
-                        continue  # Skip normal processing for this message
-                
-                # 1. Handle content field - normal case
-                if "content" in msg:
-                    # Check if content is a list (content blocks)
-                    if isinstance(msg["content"], list):
-                        # Convert complex content blocks to simple string
-                        text_content = ""
-                        for block in msg["content"]:
-                            if isinstance(block, dict):
-                                # Handle different content block types
-                                if block.get("type") == "text":
-                                    text_content += block.get("text", "") + "\n"
-                                
-                                # Handle tool_result content blocks - extract nested text
-                                elif block.get("type") == "tool_result":
-                                    tool_id = block.get("tool_use_id", "unknown")
-                                    text_content += f"[Tool Result ID: {tool_id}]\n"
-                                    
-                                    # Extract text from the tool_result content
-                                    result_content = block.get("content", [])
-                                    if isinstance(result_content, list):
-                                        for item in result_content:
-                                            if isinstance(item, dict) and item.get("type") == "text":
-                                                text_content += item.get("text", "") + "\n"
-                                            elif isinstance(item, dict):
-                                                # Handle any dict by trying to extract text or convert to JSON
-                                                if "text" in item:
-                                                    text_content += item.get("text", "") + "\n"
-                                                else:
-                                                    try:
-                                                        text_content += json.dumps(item) + "\n"
-                                                    except:
-                                                        text_content += str(item) + "\n"
-                                    elif isinstance(result_content, dict):
-                                        # Handle dictionary content
-                                        if result_content.get("type") == "text":
-                                            text_content += result_content.get("text", "") + "\n"
-                                        else:
-                                            try:
-                                                text_content += json.dumps(result_content) + "\n"
-                                            except:
-                                                text_content += str(result_content) + "\n"
-                                    elif isinstance(result_content, str):
-                                        text_content += result_content + "\n"
-                                    else:
-                                        try:
-                                            text_content += json.dumps(result_content) + "\n"
-                                        except:
-                                            text_content += str(result_content) + "\n"
-                                
-                                # Handle tool_use content blocks
-                                elif block.get("type") == "tool_use":
-                                    tool_name = block.get("name", "unknown")
-                                    tool_id = block.get("id", "unknown")
-                                    tool_input = json.dumps(block.get("input", {}))
-                                    text_content += f"[Tool: {tool_name} (ID: {tool_id})]\nInput: {tool_input}\n\n"
-                                
-                                # Handle image content blocks
-                                elif block.get("type") == "image":
-                                    text_content += "[Image content - not displayed in text format]\n"
-                        
-                        # Make sure content is never empty for OpenAI models
-                        if not text_content.strip():
-                            text_content = "..."
-                        
-                        litellm_request["messages"][i]["content"] = text_content.strip()
-                    # Also check for None or empty string content
-                    elif msg["content"] is None:
-                        litellm_request["messages"][i]["content"] = "..." # Empty content not allowed
-                
-                # 2. Remove any fields OpenAI doesn't support in messages
-                for key in list(msg.keys()):
-                    if key not in ["role", "content", "name", "tool_call_id", "tool_calls"]:
-                        logger.warning(f"Removing unsupported field from message: {key}")
-                        del msg[key]
-            
-            # 3. Final validation - check for any remaining invalid values and dump full message details
-            for i, msg in enumerate(litellm_request["messages"]):
-                
-                # If content is still a list or None, replace with placeholder
-                if isinstance(msg.get("content"), list):
-                    logger.warning(f"CRITICAL: Message {i} still has list content after processing: {json.dumps(msg.get('content'))}")
-                    # Last resort - stringify the entire content as JSON
-                    litellm_request["messages"][i]["content"] = f"Content as JSON: {json.dumps(msg.get('content'))}"
-                elif msg.get("content") is None:
-                    logger.warning(f"Message {i} has None content - replacing with placeholder")
-                    litellm_request["messages"][i]["content"] = "..." # Fallback placeholder
+        # Translate for the mapped model; fallback targets are translated only if needed
+        await prepare_images(request.messages, route_image_limits(request.route))
+        litellm_request, route = build_upstream_request(request, request.route)
         
+        # Deterministic requests may be answered from the response cache or share an
+        # identical request already in flight
+        fingerprint = request_fingerprint(litellm_request) if (response_cache.enabled or SINGLE_FLIGHT) else None
+        cache_key = fingerprint if response_cache.enabled else None
+        flight_key = fingerprint if SINGLE_FLIGHT else None
+        cached = await response_cache.get(cache_key) if cache_key is not None else None
+        if cached is not None:
+            logger.debug(f"💾 Response cache hit for {display_model} ({cache_key[:12]})")
         
         # Handle streaming mode
         if request.stream:
@@ -1355,9 +4208,6 @@ async def create_message(
                 num_tools,
                 200  # Assuming success at this point
             )
-            # Ensure we use the async version for streaming
-            response_generator = await litellm.acompletion(**litellm_request)
-            
             # Add streaming-specific headers to prevent buffering
             headers = {
                 "Cache-Control": "no-cache",
@@ -1365,8 +4215,41 @@ async def create_message(
                 "X-Accel-Buffering": "no"  # Disable nginx buffering
             }
             
+            if cached is not None:
+                return StreamingResponse(
+                    stream_sse_events(replay_stream_events(cached["events"])),
+                    media_type="text/event-stream",
+                    headers=headers
+                )
+            
+            async def open_stream(target_request, target_litellm_request, target_route, has_next):
+                response_generator = await stream_hedger.open(target_litellm_request, target_route)
+                if has_next:
+                    # Wait for the first chunk so that a target failing before it can still
+                    # be replaced: nothing has been sent to the client yet
+                    response_generator = resume_stream(*await with_fallback_timeout(
+                        read_first_chunk(response_generator), has_next
+                    ))
+                return target_request, response_generator
+            
+            async def open_events():
+                target_request, response_generator = await call_with_fallbacks(request, open_stream, (litellm_request, route))
+                events = stream_anthropic_events(response_generator, target_request)
+                # Only answers of the mapped model itself are cached
+                if cache_key is not None and target_request is request:
+                    events = record_stream_events(events, cache_key)
+                return events
+            
+            if flight_key is not None:
+                events, leader = await single_flight.stream(flight_key, open_events)
+                return StreamingResponse(
+                    stream_sse_events(events),
+                    media_type="text/event-stream",
+                    headers=headers
+                )
+            
             return StreamingResponse(
-                handle_streaming(response_generator, request),
+                stream_sse_events(await open_events()),
                 media_type="text/event-stream",
                 headers=headers
             )
@@ -1383,15 +4266,58 @@ async def create_message(
                 num_tools,
                 200  # Assuming success at this point
             )
-            start_time = time.time()
-            litellm_response = litellm.completion(**litellm_request)
+            if cached is not None:
+                return MessagesResponse(**{**cached["response"], "id": f"msg_{uuid.uuid4()}"})
             
-            # Convert LiteLLM response to Anthropic format
-            anthropic_response = convert_litellm_to_anthropic(litellm_response, request)
+            async def complete_target(target_request, target_litellm_request, target_route, has_next):
+                slot = await upstream_limiters.acquire(target_route)
+                upstream_start = time.perf_counter()
+                upstream_balancer.start(target_route)
+                try:
+                    litellm_response = await with_fallback_timeout(
+                        call_litellm_completion(target_litellm_request), has_next
+                    )
+                except BaseException as e:
+                    upstream_balancer.finish(target_route, failed=is_upstream_failure(e))
+                    raise
+                finally:
+                    if slot is not None:
+                        slot.release()
+                upstream_balancer.finish(target_route, ttft=time.perf_counter() - upstream_start)
+                translation_start = time.perf_counter()
+                
+                # Convert LiteLLM response to Anthropic format
+                anthropic_response = convert_litellm_to_anthropic(litellm_response, target_request)
+                
+                TRANSLATION_TIME.observe(("response", target_request.model), time.perf_counter() - translation_start)
+                output_tokens = anthropic_response.usage.output_tokens
+                if output_tokens and translation_start > upstream_start:
+                    OUTPUT_TOKENS_PER_SECOND.observe(
+                        (target_route.model, target_route.provider),
+                        output_tokens / (translation_start - upstream_start)
+                    )
+                return target_request, anthropic_response
             
+            async def complete():
+                target_request, anthropic_response = await call_with_fallbacks(
+                    request, complete_target, (litellm_request, route)
+                )
+                # Only answers of the mapped model itself are cached
+                if (cache_key is not None and target_request is request
+                        and anthropic_response.stop_reason in CACHEABLE_STOP_REASONS):
+                    await response_cache.put(cache_key, {"response": anthropic_response.model_dump()})
+                return anthropic_response
             
+            if flight_key is None:
+                return await complete()
+            anthropic_response, leader = await single_flight.call(flight_key, complete)
+            if not leader:
+                anthropic_response = anthropic_response.model_copy(update={"id": f"msg_{uuid.uuid4()}"})
             return anthropic_response
-                
+    
+    except UpstreamOverloaded as e:
+        logger.warning(f"🚦 Shed request for {request.model} ({e.reason}): {e}")
+        return overloaded_response(e)
     except Exception as e:
         import traceback
         error_traceback = traceback.format_exc()
@@ -1444,11 +4370,9 @@ async def create_message(
         status_code = error_details.get('status_code', 500)
         raise HTTPException(status_code=status_code, detail=error_message)
 
-@app.post("/v1/messages/count_tokens")
-async def count_tokens(
-    request: TokenCountRequest,
-    raw_request: Request
-):
+@app.post("/v1/messages/count_tokens", openapi_extra=request_body_openapi(TokenCountRequest))
+async def count_tokens(raw_request: Request):
+    request = await parse_request_body(raw_request, TokenCountRequest)
     try:
         # Log the incoming token count request
         original_model = request.original_model or request.model
@@ -1465,42 +4389,34 @@ async def count_tokens(
         elif clean_model.startswith("openai/"):
             clean_model = clean_model[len("openai/"):]
         
-        # Convert the messages to a format LiteLLM can understand
-        converted_request = convert_anthropic_to_litellm(
-            MessagesRequest(
-                model=request.model,
-                max_tokens=100,  # Arbitrary value not used for token counting
-                messages=request.messages,
-                system=request.system,
-                tools=request.tools,
-                tool_choice=request.tool_choice,
-                thinking=request.thinking
-            )
-        )
-        
         # Use LiteLLM's token_counter function
         try:
-            # Import token_counter function
-            from litellm import token_counter
-            
             # Log the request beautifully
             num_tools = len(request.tools) if request.tools else 0
+            num_messages = len(request.messages) + (1 if request.system else 0)
             
             log_request_beautifully(
                 "POST",
                 raw_request.url.path,
                 display_model,
-                converted_request.get('model'),
-                len(converted_request['messages']),
+                request.model,
+                num_messages,
                 num_tools,
                 200  # Assuming success at this point
             )
             
-            # Count tokens
-            token_count = token_counter(
-                model=converted_request["model"],
-                messages=converted_request["messages"],
-            )
+            # Identical requests are answered from the whole-request cache
+            body = await raw_request.body()
+            request_key = (request.model, content_digest(body))
+            token_count = token_count_request_cache.get(request_key)
+            if token_count is None:
+                # Count tokens, reusing the counts of messages seen in earlier requests
+                # Messages as they would be sent upstream, old tool results compacted
+                messages, _ = compact_route_messages(request.messages, request.route)
+                token_count = await count_message_tokens(request.model, request.system, messages,
+                                                         route_image_limits(request.route))
+                token_count_request_cache.put(request_key, token_count)
+            logger.debug(f"Token count caches: requests {token_count_request_cache.stats()}, messages {message_token_cache.stats()}")
             
             # Return Anthropic-style response
             return TokenCountResponse(input_tokens=token_count)
@@ -1516,6 +4432,108 @@ async def count_tokens(
         logger.error(f"Error counting tokens: {str(e)}\n{error_traceback}")
         raise HTTPException(status_code=500, detail=f"Error counting tokens: {str(e)}")
 
+def component_metrics() -> List[Metric]:
+    """Cache, stream, single-flight, upstream pool, limit, load balancer and tokenizer counters, read at scrape time."""
+    cache_entries = Gauge("proxy_cache_entries", "Entries held per cache.", ("cache",))
+    cache_hits = Counter("proxy_cache_hits_total", "Cache lookups that hit.", ("cache",))
+    cache_misses = Counter("proxy_cache_misses_total", "Cache lookups that missed.", ("cache",))
+    caches = {
+        "translation": translation_cache,
+        "tools": tool_cache,
+        "images": image_cache,
+        "token_count_messages": message_token_cache,
+        "token_count_requests": token_count_request_cache,
+        "response": response_cache.memory,
+    }
+    for name, cache in caches.items():
+        stats = cache.stats()
+        cache_entries.set((name,), stats["entries"])
+        cache_hits.inc((name,), stats["hits"])
+        cache_misses.inc((name,), stats["misses"])
+    response_disk_hits = Counter("proxy_response_cache_disk_hits_total", "Response cache hits served from disk.")
+    response_disk_hits.inc((), response_cache.disk_hits)
+    
+    client_streams = Gauge("proxy_client_streams", "Client SSE streams currently open.")
+    client_streams.set((), stream_pump_stats.active_streams)
+    client_streams_total = Counter("proxy_client_streams_total", "Client SSE streams started.")
+    client_streams_total.inc((), stream_pump_stats.streams)
+    queued_events = Gauge("proxy_stream_queued_events", "Translated events buffered ahead of clients.")
+    queued_events.set((), stream_pump_stats.queued_events)
+    max_queue_depth = Gauge("proxy_stream_max_queue_depth", "Deepest event queue any single stream has reached.")
+    max_queue_depth.set((), stream_pump_stats.max_queue_depth)
+    producer_stall = Counter("proxy_stream_producer_stall_seconds_total", "Time upstream reads waited for slow clients.")
+    producer_stall.inc((), stream_pump_stats.producer_stall_seconds)
+    consumer_wait = Counter("proxy_stream_consumer_wait_seconds_total", "Time client writes waited for upstream events.")
+    consumer_wait.inc((), stream_pump_stats.consumer_wait_seconds)
+    idle_pings = Counter("proxy_stream_idle_pings_total", "Keep-alive pings sent while upstream was silent.")
+    idle_pings.inc((), stream_pump_stats.idle_pings)
+    
+    flight = single_flight.stats()
+    upstream_calls = Counter("proxy_single_flight_upstream_calls_total", "Deterministic requests that made their own upstream call.")
+    upstream_calls.inc((), flight["upstream_calls"])
+    coalesced_calls = Counter("proxy_single_flight_coalesced_total", "Upstream calls saved by joining an identical request in flight.")
+    coalesced_calls.inc((), flight["coalesced_calls"])
+    
+    pool_connections = Gauge("proxy_upstream_pool_connections", "Upstream connections per pool and state.", ("api_base", "state"))
+    pool_requests = Counter("proxy_upstream_pool_requests_total", "Requests sent through each upstream pool.", ("api_base",))
+    pool_new_connections = Counter("proxy_upstream_pool_new_connections_total", "Connections opened by each upstream pool.", ("api_base",))
+    pool_reuse = Gauge("proxy_upstream_pool_reuse_ratio", "Share of requests that reused an open connection.", ("api_base",))
+    for api_base, stats in upstream_pools.stats().items():
+        pool_connections.set((api_base, "active"), stats["active_connections"])
+        pool_connections.set((api_base, "idle"), stats["idle_connections"])
+        pool_requests.inc((api_base,), stats["requests"])
+        pool_new_connections.inc((api_base,), stats["new_connections"])
+        pool_reuse.set((api_base,), stats["reuse_ratio"])
+    
+    upstream_inflight = Gauge("proxy_upstream_inflight_requests", "Upstream calls holding a concurrency slot.", ("mapped_model", "api_base"))
+    upstream_queued = Gauge("proxy_upstream_queue_depth", "Requests waiting for an upstream concurrency slot.", ("mapped_model", "api_base"))
+    upstream_limit = Gauge("proxy_upstream_max_inflight", "Concurrency limit per mapped model and api_base.", ("mapped_model", "api_base"))
+    for labels, stats in upstream_limiters.stats().items():
+        upstream_inflight.set(labels, stats["in_flight"])
+        upstream_queued.set(labels, stats["queued"])
+        upstream_limit.set(labels, stats["max_inflight"])
+    
+    base_ttft = Gauge("proxy_upstream_base_ewma_ttft_seconds", "EWMA time to first token per load balanced api_base.", ("api_base",))
+    base_errors = Gauge("proxy_upstream_base_error_rate", "EWMA error rate per load balanced api_base.", ("api_base",))
+    base_ejected = Gauge("proxy_upstream_base_ejected", "1 while an api_base is ejected from rotation.", ("api_base",))
+    base_picks = Counter("proxy_upstream_base_picks_total", "Requests sent to each load balanced api_base.", ("api_base",))
+    base_ejections = Counter("proxy_upstream_base_ejections_total", "Times each api_base was ejected.", ("api_base",))
+    for api_base, stats in upstream_balancer.stats().items():
+        if stats["ewma_ttft"] is not None:
+            base_ttft.set((api_base,), stats["ewma_ttft"])
+        base_errors.set((api_base,), stats["error_rate"])
+        base_ejected.set((api_base,), int(stats["ejected"]))
+        base_picks.inc((api_base,), stats["picks"])
+        base_ejections.inc((api_base,), stats["ejections"])
+    
+    circuit_open = Gauge("proxy_upstream_circuit_open", "1 while the circuit of a mapped model is open.", ("mapped_model",))
+    circuit_openings = Counter("proxy_upstream_circuit_openings_total", "Times the circuit of each mapped model opened.", ("mapped_model",))
+    for model, stats in circuit_breakers.stats().items():
+        circuit_open.set((model,), int(stats["open"]))
+        circuit_openings.inc((model,), stats["openings"])
+    
+    tokenizer_jobs = Counter("proxy_tokenizer_jobs_total", "Token counting jobs by where they ran.", ("mode",))
+    tokenizer_jobs.inc(("inline",), tokenizer_engine.inline_jobs)
+    tokenizer_jobs.inc(("process",), tokenizer_engine.offloaded_jobs)
+    
+    return [
+        cache_entries, cache_hits, cache_misses, response_disk_hits,
+        client_streams, client_streams_total, queued_events, max_queue_depth, producer_stall, consumer_wait, idle_pings,
+        upstream_calls, coalesced_calls,
+        pool_connections, pool_requests, pool_new_connections, pool_reuse,
+        upstream_inflight, upstream_queued, upstream_limit,
+        base_ttft, base_errors, base_ejected, base_picks, base_ejections,
+        circuit_open, circuit_openings,
+        tokenizer_jobs,
+    ]
+
+metrics.collectors.append(component_metrics)
+
+@app.get("/metrics")
+async def metrics_endpoint():
+    """Prometheus text exposition of the proxy metrics."""
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
+
 @app.get("/")
 async def root():
     return {"message": "Anthropic Proxy for LiteLLM"}